@@ -0,0 +1,75 @@
+'''
+Module :mod:`esgfpy.publish.batching`
+=====================================
+
+Module containing classes that determine how many records are sent to the publishing service in each request.
+'''
+
+import logging
+
+class BatchSizer(object):
+    """
+    Class that limits the number of records and the payload size of each request sent to one Solr core.
+    The record limit starts small and adapts to the observed response latency:
+    it grows while the latency stays flat, and is halved on slow responses or when the server rejects a request as too large.
+    """
+
+    def __init__(self, maxRecords=1000, maxBytes=1024*1024, initialRecords=10, minRecords=1,
+                 growth=10, slowdown=2.0, smoothing=0.3):
+        """
+        :param maxRecords: maximum number of records per request
+        :param maxBytes: maximum payload size per request (a single larger record is still sent on its own)
+        :param initialRecords: number of records per request before any latency is observed
+        :param minRecords: minimum number of records per request
+        :param growth: number of records added to the batch size after each request with flat latency
+        :param slowdown: a request is considered slow if its latency is this many times the average latency
+        :param smoothing: weight of the latest request in the running average latency (0-1)
+        """
+
+        self.maxRecords = maxRecords
+        self.maxBytes = maxBytes
+        self.minRecords = minRecords
+        self.growth = growth
+        self.slowdown = slowdown
+        self.smoothing = smoothing
+
+        # current limits
+        self.numRecords = max(minRecords, min(initialRecords, maxRecords))
+        self.numBytes = maxBytes
+
+        # running average of the response latency per request
+        self.latency = None
+
+    def isFull(self, numRecords, numBytes):
+        '''Returns True if a batch with this number of records and bytes must be sent.'''
+
+        return numRecords >= self.numRecords or numBytes >= self.numBytes
+
+    def fits(self, numRecords, numBytes, recordBytes):
+        '''Returns True if a record of the given size can be appended to a non-empty batch.'''
+
+        return numRecords == 0 or numBytes + recordBytes <= self.numBytes
+
+    def update(self, numRecords, seconds):
+        '''Adapts the batch size after a request with the given number of records has completed in the given time.'''
+
+        if self.latency is not None and seconds > self.slowdown * self.latency:
+            self._shrink()
+            logging.debug("Slow response (%.2fs): batch size reduced to %s records" % (seconds, self.numRecords))
+        elif numRecords >= self.numRecords:
+            self.numRecords = min(self.maxRecords, self.numRecords + self.growth)
+
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = self.smoothing * seconds + (1 - self.smoothing) * self.latency
+
+    def tooLarge(self, numBytes):
+        '''Shrinks the batch size after a request of the given payload size was rejected as too large (HTTP 413).'''
+
+        self._shrink()
+        self.numBytes = max(1, min(self.numBytes, numBytes // 2))
+        logging.warn("Request too large: batch size reduced to %s records, %s bytes" % (self.numRecords, self.numBytes))
+
+    def _shrink(self):
+        self.numRecords = max(self.minRecords, self.numRecords // 2)
@@ -0,0 +1,3 @@
+'''
+Package containing benchmarks of the publishing client.
+'''
\ No newline at end of file
@@ -0,0 +1,195 @@
+'''
+Module :mod:`esgfpy.publish.benchmark.datatree`
+===============================================
+
+Generator of a synthetic directory tree of small granules, laid out as <root>/<instrument>/<version>/<granule>,
+in the formats and with the variable names expected by the OCO-2, ACOS and TES metadata parsers,
+plus the XML metadata files of each instrument directory and (optionally) of each granule.
+
+Usage: python -m esgfpy.publish.benchmark.datatree <directory> [--datasets N] [--files N] [--soundings N]
+'''
+
+import os
+import argparse
+import datetime as dt
+import numpy as np
+import h5py
+
+# template of the dataset directories: <root>/<instrument>/<version>
+SUBDIRS = [['instrument', 'version']]
+
+# name of the (empty) metadata mapping file written at the root of the tree
+MAPPING_FILENAME = "metadata-mapping.cfg"
+
+# fill value of the missing coordinates
+MISSING_VALUE = -999999.
+
+# date of the first granule of each dataset
+START_DATE = dt.datetime(2015, 1, 1)
+
+UNIX_DATETIME_START = dt.datetime(1970, 1, 1)
+TAI93_DATETIME_START = dt.datetime(1993, 1, 1)
+
+def _writeOco2LtCO2(h5file, day, lats, lons, seconds):
+    h5file['latitude'] = lats
+    h5file['longitude'] = lons
+    h5file['time'] = _unixTimes(day, seconds)
+    h5file['xco2'] = np.random.uniform(390, 410, len(seconds)).astype(np.float32)
+
+def _writeOco2L2Std(h5file, day, lats, lons, seconds):
+    h5file['RetrievalGeometry/retrieval_latitude'] = lats
+    h5file['RetrievalGeometry/retrieval_longitude'] = lons
+    h5file['RetrievalHeader/retrieval_time_string'] = _timeStrings(day, seconds)
+    h5file['RetrievalHeader/sounding_operation_mode'] = np.array(["GL"] * len(seconds), dtype="S2")
+    h5file['RetrievalResults/xco2'] = np.random.uniform(390e-6, 410e-6, len(seconds)).astype(np.float32)
+
+def _writeOco2LtSIF(h5file, day, lats, lons, seconds):
+    h5file['Geolocation/latitude'] = lats
+    h5file['Geolocation/longitude'] = lons
+    h5file['Geolocation/time_tai93'] = _tai93Times(day, seconds)
+    h5file['Science/SIF_757nm'] = np.random.uniform(-1, 3, len(seconds)).astype(np.float32)
+
+def _writeXco2(h5file, day, lats, lons, seconds):
+    h5file['latitude'] = np.linspace(-89.5, 89.5, 180).astype(np.float32)
+    h5file['longitude'] = np.linspace(-179.5, 179.5, 360).astype(np.float32)
+    h5file['XCO2'] = np.random.uniform(390, 410, (180, 360)).astype(np.float32)
+
+def _writeAcos(h5file, day, lats, lons, seconds):
+    h5file['SoundingGeometry/sounding_latitude'] = lats
+    h5file['SoundingGeometry/sounding_longitude'] = lons
+    h5file['RetrievalHeader/sounding_time_string'] = _timeStrings(day, seconds)
+    h5file['RetrievalResults/xco2'] = np.random.uniform(390e-6, 410e-6, len(seconds)).astype(np.float32)
+
+def _writeAcosLite(h5file, day, lats, lons, seconds):
+    h5file['latitude'] = lats
+    h5file['longitude'] = lons
+    h5file['time'] = _unixTimes(day, seconds)
+    h5file['xco2'] = np.random.uniform(390, 410, len(seconds)).astype(np.float32)
+
+def _writeTesLite(h5file, day, lats, lons, seconds):
+    h5file['Latitude'] = lats
+    h5file['Longitude'] = lons
+    h5file['Time'] = _tai93Times(day, seconds) + 35
+    h5file['Characterization/AveragingKernel'] = np.random.uniform(0, 1, (len(seconds), 4)).astype(np.float32)
+    h5file['Retrieval/CO2'] = np.random.uniform(390e-6, 410e-6, len(seconds)).astype(np.float32)
+    h5file['Geolocation/SurfaceElevStandardDeviation'] = np.random.uniform(0, 100, len(seconds)).astype(np.float32)
+
+def _writeTes(h5file, day, lats, lons, seconds):
+    swath = 'HDFEOS/SWATHS/CO2NadirSwath/'
+    h5file[swath + 'Geolocation Fields/Latitude'] = lats
+    h5file[swath + 'Geolocation Fields/Longitude'] = lons
+    h5file[swath + 'Geolocation Fields/Time'] = _tai93Times(day, seconds) + 35
+    h5file[swath + 'Data Fields/CO2'] = np.random.uniform(390e-6, 410e-6, len(seconds)).astype(np.float32)
+    h5file[swath + 'Data Fields/Pressure'] = np.random.uniform(0, 1000, (len(seconds), 4)).astype(np.float32)
+
+# synthetic products: (instrument, version, filename template, writer of the granule content)
+# the filename templates are filled with the date of the granule (yymmdd, yymmdd2 one week later, yyyy-mm-dd),
+# its index within the dataset, and a processing time stamp
+PRODUCTS = [ ('OCO2', 'B7101A', "oco2_LtCO2_%(yymmdd)s_B7101A_%(stamp)ss.nc4", _writeOco2LtCO2),
+             ('ACOS', 'B9200_r01', "acos_L2s_%(yymmdd)s_%(nn)02d_B9200_PolB_%(stamp)s.h5", _writeAcos),
+             ('TES', 'v007', "TES-Aura_L2-CO2-Nadir_%(yyyy-mm-dd)s_v007_Lite-v02.00.nc", _writeTesLite),
+             ('OCO2', 'B6000r', "oco2_L2StdGL_%(index)05da_%(yymmdd)s_B6000r_%(stamp)s.h5", _writeOco2L2Std),
+             ('OCO2-SIF', 'B10206r', "oco2_LtSIF_%(yymmdd)s_B10206r_%(stamp)ss.nc4", _writeOco2LtSIF),
+             ('ACOS', 'B9213A', "acos_LtCO2_%(yymmdd)s_v205205_B9213A_%(stamp)ss.nc4", _writeAcosLite),
+             ('TES', 'v008', "TES-Aura_L2-CO2-Nadir_r%(index)010d_F08_12.he5", _writeTes),
+             ('OCO2-OCO3', 'B8101', "ocoX_L3CO2_%(yymmdd)s_%(yymmdd2)s_B8101_a7310Ao7305Br_%(stamp)ss.nc4", _writeXco2) ]
+
+# regular expressions matching the granules of all products (and not the XML metadata files)
+FILENAME_PATTERNS = [ "oco2_LtCO2_.+\.nc4$", "acos_L2s_.+\.h5$", "TES-Aura_L2-CO2-Nadir_.+\.nc$", "oco2_L2StdGL.+\.h5$",
+                      "oco2_LtSIF_.+\.nc4$", "acos_LtCO2_.+\.nc4$", "TES-Aura_L2-CO2-Nadir_.+\.he5$", "ocoX_L3CO2_.+\.nc4$" ]
+
+def generateTree(rootDirectory, numDatasets=8, numFiles=25, numSoundings=1000, sidecarInterval=2, seed=0):
+    """
+    Generates a synthetic data tree: one dataset directory per product (cycling through PRODUCTS,
+    with a numbered version once all products have been used), each containing one granule per day.
+
+    :param rootDirectory: root of the tree (created if not existing)
+    :param numDatasets: number of dataset directories
+    :param numFiles: number of granules per dataset
+    :param numSoundings: number of soundings (coordinates and times) per granule
+    :param sidecarInterval: one granule out of this number has its own XML metadata file (0 for none)
+    :param seed: seed of the random coordinates and values
+    :return: (number of datasets, number of granules, total size of the granules in bytes)
+    """
+
+    np.random.seed(seed)
+    if not os.path.isdir(rootDirectory):
+        os.makedirs(rootDirectory)
+    with open(os.path.join(rootDirectory, MAPPING_FILENAME), "w") as f:
+        f.write("[keys]\n\n[values]\n")
+
+    numBytes = 0
+    for i in range(numDatasets):
+        (instrument, version, template, writer) = PRODUCTS[i % len(PRODUCTS)]
+        if i >= len(PRODUCTS):
+            version = "%s_%02d" % (version, i // len(PRODUCTS))
+        instrumentDirectory = os.path.join(rootDirectory, instrument)
+        datasetDirectory = os.path.join(instrumentDirectory, version)
+        if not os.path.isdir(datasetDirectory):
+            os.makedirs(datasetDirectory)
+
+        # metadata of all datasets of the instrument
+        _writeXml(os.path.join(instrumentDirectory, instrument + ".xml"),
+                  [('mission', instrument.split('-')[0]), ('institute', 'NASA/JPL'), ('processing_level', 'L2')])
+
+        for j in range(numFiles):
+            day = START_DATE + dt.timedelta(days=j)
+            filename = template % { 'yymmdd': day.strftime("%y%m%d"),
+                                    'yymmdd2': (day + dt.timedelta(days=7)).strftime("%y%m%d"),
+                                    'yyyy-mm-dd': day.strftime("%Y-%m-%d"),
+                                    'index': j, 'nn': j % 100,
+                                    'stamp': (day + dt.timedelta(days=60, seconds=j)).strftime("%y%m%d%H%M%S") }
+            filepath = os.path.join(datasetDirectory, filename)
+
+            h5file = h5py.File(filepath, 'w')
+            try:
+                writer(h5file, day, *_soundings(numSoundings))
+            finally:
+                h5file.close()
+            numBytes += os.path.getsize(filepath)
+
+            if sidecarInterval > 0 and j % sidecarInterval == 0:
+                _writeXml(filepath + ".xml", [('product', "%s %s" % (instrument, version)), ('orbit', str(j))])
+
+    return (numDatasets, numDatasets * numFiles, numBytes)
+
+def _soundings(numSoundings):
+    '''Returns the (latitudes, longitudes, seconds of the day) of the soundings of a granule, with a few missing coordinates.'''
+
+    lats = np.random.uniform(-90, 90, numSoundings).astype(np.float32)
+    lons = np.random.uniform(-180, 180, numSoundings).astype(np.float32)
+    seconds = np.sort(np.random.uniform(0, 86400, numSoundings))
+    lats[::97] = MISSING_VALUE
+    lons[::89] = MISSING_VALUE
+    return (lats, lons, seconds)
+
+def _unixTimes(day, seconds):
+    return (day - UNIX_DATETIME_START).total_seconds() + seconds
+
+def _tai93Times(day, seconds):
+    return (day - TAI93_DATETIME_START).total_seconds() + seconds
+
+def _timeStrings(day, seconds):
+    return np.array([(day + dt.timedelta(seconds=s)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:23] + "Z" for s in seconds],
+                    dtype="S24")
+
+def _writeXml(filepath, items):
+    with open(filepath, "w") as f:
+        f.write("<metadata>\n")
+        for (key, value) in items:
+            f.write("  <%s>%s</%s>\n" % (key, value, key))
+        f.write("</metadata>\n")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generates a synthetic data tree for the publishing benchmarks")
+    parser.add_argument("directory", help="root directory of the tree")
+    parser.add_argument("--datasets", type=int, default=8, help="number of datasets")
+    parser.add_argument("--files", type=int, default=25, help="number of granules per dataset")
+    parser.add_argument("--soundings", type=int, default=1000, help="number of soundings per granule")
+    parser.add_argument("--sidecars", type=int, default=2, help="one granule out of N has an XML metadata file (0 for none)")
+    args = parser.parse_args()
+
+    (numDatasets, numFiles, numBytes) = generateTree(args.directory, numDatasets=args.datasets, numFiles=args.files,
+                                                     numSoundings=args.soundings, sidecarInterval=args.sidecars)
+    print "Generated %s datasets, %s files, %s bytes in %s" % (numDatasets, numFiles, numBytes, args.directory)
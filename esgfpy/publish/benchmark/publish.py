@@ -0,0 +1,254 @@
+'''
+Module :mod:`esgfpy.publish.benchmark.publish`
+==============================================
+
+End-to-end benchmark of publishing: generates a synthetic data tree (see :mod:`esgfpy.publish.benchmark.datatree`),
+publishes it with a FileSystemIndexer and a PublishingClient to a local stand-in Solr
+(see :mod:`esgfpy.publish.benchmark.solr`), and reports the files and records published per second,
+the bytes posted, the peak memory and the time spent in each stage:
+
+- walk: traversing the directory tree and generating the dataset records
+- process: parsing the files and generating the file records
+- serialize: serializing the records into update documents
+- post: sending the update requests (including the response time of the stand-in Solr)
+
+When the stages run concurrently (with --posters), their times are summed over all threads
+and may add up to more than the elapsed time. When the requests are streamed (with --streaming),
+the records are serialized while they are sent, so the post time includes the serialize time.
+
+Usage: python -m esgfpy.publish.benchmark.publish [--datasets N] [--files N] [--soundings N] [--format xml|json]
+                                                  [--posters N] [--processes N] [--cache cache.db] [--checksums]
+                                                  [--output results.json]
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import resource
+import threading
+import argparse
+import logging
+
+from esgfpy.publish.benchmark.datatree import generateTree, SUBDIRS, MAPPING_FILENAME, FILENAME_PATTERNS
+from esgfpy.publish.benchmark.solr import StandInSolr
+from esgfpy.publish.factories import DirectoryDatasetRecordFactory, FilepathFileRecordFactory
+from esgfpy.publish.services import FileSystemIndexer, PublishingClient
+from esgfpy.publish.pipeline import PipelinedPublishingClient
+from esgfpy.publish.connections import ConnectionPool
+from esgfpy.publish.consts import FORMAT_XML, FORMAT_JSON
+from esgfpy.publish.instrumentation import stats
+from esgfpy.publish.parsers import (XMLMetadataFileParser, AcosFileParser, AcosLiteFileParser_v9,
+                                    Oco2L2StdFileParser, Oco2LtCO2FileParser, Oco2LtSIFFileParser, Xco2FileParser,
+                                    TesFileParser, TesFileParserLite, MetadataCache)
+
+STAGES = ['walk', 'process', 'serialize', 'post']
+
+class StageTimer(object):
+    '''Accumulates the time spent in, and the number of items produced by, each stage (from any thread).'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = dict( (stage, 0.0) for stage in STAGES )
+        self.items = dict( (stage, 0) for stage in STAGES )
+
+    def add(self, stage, seconds, numItems=0):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.items[stage] += numItems
+
+    def timeCalls(self, function, stage, countItems=lambda result: 1):
+        '''Returns a wrapper of the function that times each call.'''
+
+        def wrapper(*args, **kwargs):
+            startTime = time.time()
+            result = function(*args, **kwargs)
+            self.add(stage, time.time() - startTime, countItems(result))
+            return result
+        return wrapper
+
+    def timeGenerator(self, function, stage):
+        '''Returns a wrapper of the generator function that times the production of each item (not their consumption).'''
+
+        def wrapper(*args, **kwargs):
+            iterator = iter(function(*args, **kwargs))
+            while True:
+                startTime = time.time()
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    self.add(stage, time.time() - startTime)
+                    return
+                self.add(stage, time.time() - startTime, 1)
+                yield item
+        return wrapper
+
+def buildIndexer(rootDirectory, numProcesses=1, metadataCache=None, generateChecksum=False):
+    '''Returns a FileSystemIndexer for the synthetic data tree, configured like the CO2 publishing driver.'''
+
+    mappingFile = os.path.join(rootDirectory, MAPPING_FILENAME)
+    hostname = "localhost"
+
+    datasetRecordFactory = DirectoryDatasetRecordFactory("bench.co2", rootDirectory=rootDirectory, subDirs=SUBDIRS,
+                                                         fields={ "project": ["CO2-BENCH"],
+                                                                  "index_node": [hostname],
+                                                                  "data_node": [hostname] },
+                                                         addVersion=False)
+    datasetRecordFactory.metadataParsers[1] = XMLMetadataFileParser(metadata_mapping_file=mappingFile,
+                                                                    startDirectory=rootDirectory)
+
+    fileRecordFactory = FilepathFileRecordFactory(fields={ "index_node": [hostname], "data_node": [hostname] },
+                                                  rootDirectory=rootDirectory,
+                                                  filenamePatterns=FILENAME_PATTERNS,
+                                                  baseUrls={ "http://%s/data" % hostname: "HTTPServer" },
+                                                  numProcesses=numProcesses,
+                                                  metadataCache=metadataCache,
+                                                  generateChecksum=generateChecksum)
+    fileRecordFactory.metadataParsers = [AcosFileParser(), AcosLiteFileParser_v9(),
+                                         Oco2L2StdFileParser(), Oco2LtCO2FileParser(), Oco2LtSIFFileParser(), Xco2FileParser(),
+                                         TesFileParser(), TesFileParserLite(),
+                                         XMLMetadataFileParser(metadata_mapping_file=mappingFile)]
+
+    datasetMetadataKeysToCopy = dict( (key, False) for key in ['project', 'instrument', 'version', 'institute',
+                                                                'processing_level', 'mission'] )
+    return FileSystemIndexer(datasetRecordFactory, fileRecordFactory,
+                             fileMetadataKeysToCopy={}, datasetMetadataKeysToCopy=datasetMetadataKeysToCopy)
+
+def runBenchmark(rootDirectory, solrUrl, format=FORMAT_XML, streaming=False, numPosters=0, numProcesses=1,
+                 compressRequests=False, metadataCache=None, generateChecksum=False):
+    """
+    Publishes the synthetic data tree to the given Solr URL, and returns the measured statistics as a dictionary.
+
+    :param numPosters: if greater than 0, publish with a PipelinedPublishingClient with this number of poster threads
+    :param metadataCache: optional MetadataCache of the metadata extracted from the data files
+    :param generateChecksum: True to compute the checksums of the files
+    """
+
+    indexer = buildIndexer(rootDirectory, numProcesses=numProcesses, metadataCache=metadataCache,
+                           generateChecksum=generateChecksum)
+    connectionPool = ConnectionPool(maxConnections=max(4, numPosters), compressRequests=compressRequests)
+    if numPosters > 0:
+        client = PipelinedPublishingClient(indexer, solrUrl, numPosters=numPosters, reportInterval=0,
+                                           connectionPool=connectionPool, format=format)
+    else:
+        client = PublishingClient(indexer, solrUrl, connectionPool=connectionPool, format=format, streaming=streaming)
+
+    # time each stage, by wrapping the methods of the indexer and client instances
+    timer = StageTimer()
+    indexer.walk = timer.timeGenerator(indexer.walk, 'walk')
+    indexer.process = timer.timeCalls(indexer.process, 'process',
+                                      countItems=lambda records: len(records[1]) if records is not None else 0)
+    client._serialize = timer.timeGenerator(client._serialize, 'serialize')
+    client._post_body = timer.timeCalls(client._post_body, 'post')
+
+    startTime = time.time()
+    try:
+        client.publish(rootDirectory)
+    finally:
+        indexer.fileRecordFactory.close()
+        connectionPool.close()
+    elapsed = time.time() - startTime
+
+    numFiles = timer.items['process']
+    numRecords = timer.items['serialize']
+    return { 'elapsed': elapsed,
+             'files': numFiles,
+             'records': numRecords,
+             'files_per_second': numFiles / elapsed if elapsed > 0 else 0,
+             'records_per_second': numRecords / elapsed if elapsed > 0 else 0,
+             'stages': dict( (stage, { 'seconds': timer.seconds[stage], 'items': timer.items[stage] }) for stage in STAGES ) }
+
+def getPeakMemory():
+    '''Returns the peak resident set size (in kilobytes, on Linux) of this process and of its terminated child processes.'''
+
+    return { 'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss }
+
+def printResults(results):
+
+    print "Published %s files, %s records in %.2f seconds" % (results['files'], results['records'], results['elapsed'])
+    print "%12.1f files/sec" % results['files_per_second']
+    print "%12.1f records/sec" % results['records_per_second']
+    print "%12s bytes posted in %s requests (%s bytes decoded)" % (results['bytes_posted'], results['requests'],
+                                                                  results['bytes_decoded'])
+    print "%12s KB peak RSS (%s KB child processes)" % (results['peak_rss_kb']['self'], results['peak_rss_kb']['children'])
+    for stage in STAGES:
+        print "%12.2f seconds %-10s (%s items)" % (results['stages'][stage]['seconds'], stage,
+                                                   results['stages'][stage]['items'])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of publishing a synthetic data tree to a stand-in Solr")
+    parser.add_argument("--directory", default=None,
+                        help="location of the synthetic data tree (by default, a temporary directory removed afterwards)")
+    parser.add_argument("--reuse", action="store_true", help="publish the existing tree in --directory without generating it")
+    parser.add_argument("--datasets", type=int, default=8, help="number of datasets")
+    parser.add_argument("--files", type=int, default=25, help="number of files per dataset")
+    parser.add_argument("--soundings", type=int, default=1000, help="number of soundings per file")
+    parser.add_argument("--sidecars", type=int, default=2, help="one file out of N has an XML metadata file (0 for none)")
+    parser.add_argument("--format", choices=[FORMAT_XML, FORMAT_JSON], default=FORMAT_XML, help="wire format of the updates")
+    parser.add_argument("--streaming", action="store_true", help="stream the update requests (without --posters)")
+    parser.add_argument("--compress", action="store_true", help="gzip-compress the update requests")
+    parser.add_argument("--posters", type=int, default=0, help="publish with a pipeline of N poster threads")
+    parser.add_argument("--processes", type=int, default=1, help="number of processes parsing the files")
+    parser.add_argument("--cache", default=None,
+                        help="sqlite file caching the metadata extracted from the data files (run twice to measure a warm cache)")
+    parser.add_argument("--checksums", action="store_true", help="compute the checksums of the files")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added by the stand-in Solr to each update request")
+    parser.add_argument("--output", default="benchmark-publish.json", help="file where the results are written as JSON")
+    parser.add_argument("--stats", default=None,
+                        help="also collect the detailed timings of the instrumentation, written to this JSON or '.prom' file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the publishing client")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
+
+    rootDirectory = args.directory or tempfile.mkdtemp(prefix="esgfpy-benchmark-")
+    if not args.reuse:
+        startTime = time.time()
+        (numDatasets, numFiles, numBytes) = generateTree(rootDirectory, numDatasets=args.datasets, numFiles=args.files,
+                                                         numSoundings=args.soundings, sidecarInterval=args.sidecars)
+        print "Generated %s datasets, %s files, %s bytes in %.2f seconds" % (numDatasets, numFiles, numBytes,
+                                                                            time.time() - startTime)
+
+    if args.stats:
+        stats.enable()
+
+    metadataCache = MetadataCache(args.cache) if args.cache else None
+
+    standIn = StandInSolr(latency=args.latency)
+    solrUrl = standIn.start()
+    stdout = sys.stdout
+    try:
+        # the publishing client prints each record
+        if not args.verbose:
+            sys.stdout = open(os.devnull, "w")
+        results = runBenchmark(rootDirectory, solrUrl, format=args.format, streaming=args.streaming,
+                               numPosters=args.posters, numProcesses=args.processes, compressRequests=args.compress,
+                               metadataCache=metadataCache, generateChecksum=args.checksums)
+    finally:
+        sys.stdout = stdout
+        standIn.stop()
+        if metadataCache is not None:
+            metadataCache.close()
+        if args.directory is None:
+            shutil.rmtree(rootDirectory)
+
+    statistics = standIn.getStatistics()
+    results.update({ 'parameters': vars(args),
+                     'bytes_posted': statistics['bytes'],
+                     'bytes_decoded': statistics['decodedBytes'],
+                     'requests': statistics['requests'],
+                     'cores': statistics['cores'],
+                     'peak_rss_kb': getPeakMemory() })
+
+    printResults(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print "Results written to %s" % args.output
+
+    if args.stats:
+        print stats.summary()
+        stats.write(args.stats)
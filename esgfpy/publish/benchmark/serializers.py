@@ -0,0 +1,78 @@
+'''
+Module :mod:`esgfpy.publish.benchmark.serializers`
+==================================================
+
+Benchmark of the serialization of records into Solr update documents:
+compares the ElementTree path (Record.toXML() + tostring()) with the XML and JSON record serializers.
+
+Usage: python -m esgfpy.publish.benchmark.serializers [--records N] [--fields N] [--values N]
+'''
+
+import argparse
+import json
+import time
+from xml.etree.ElementTree import tostring, fromstring
+
+from esgfpy.publish.models import DatasetRecord, FileRecord, XmlRecordSerializer, JsonRecordSerializer
+
+def makeRecords(numRecords, numFields, numValues):
+    '''Returns a list of synthetic File records with the given number of multi-valued fields.'''
+
+    datasetRecord = DatasetRecord("bench.dataset.v1|localhost", "Benchmark Dataset", fields={})
+    records = []
+    for i in range(numRecords):
+        fields = {}
+        for j in range(numFields):
+            fields["field_%s" % j] = ["value <%s> & %s.%s" % (i, j, k) for k in range(numValues)]
+        fields["north_degrees"] = [45.0 + i % 45]
+        records.append( FileRecord(datasetRecord, "bench.dataset.v1.file_%s.nc|localhost" % i,
+                                   "file_%s.nc" % i, fields=fields) )
+    return records
+
+def elementTreeSerialize(records):
+    return [tostring(record.toXML()) for record in records]
+
+def serializerSerialize(serializer):
+    def serialize(records):
+        return [serializer.serialize(record) for record in records]
+    return serialize
+
+def run(name, serialize, records, repeat):
+    '''Times the serialization of all records (best of the repeated runs), returns the records per second.'''
+
+    best = None
+    for i in range(repeat):
+        startTime = time.time()
+        docs = serialize(records)
+        elapsed = time.time() - startTime
+        if best is None or elapsed < best:
+            best = elapsed
+    numBytes = sum(len(doc) for doc in docs)
+    recordsPerSecond = len(records) / best if best > 0 else float('inf')
+    print "%-20s %12.1f records/sec %12s bytes" % (name, recordsPerSecond, numBytes)
+    return (recordsPerSecond, docs)
+
+def _fields(docEl):
+    return sorted( (el.attrib['name'], el.text) for el in docEl )
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark of the Solr record serializers")
+    parser.add_argument("--records", type=int, default=1000, help="number of records")
+    parser.add_argument("--fields", type=int, default=200, help="number of multi-valued fields per record")
+    parser.add_argument("--values", type=int, default=3, help="number of values per field")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs (the best one is reported)")
+    args = parser.parse_args()
+
+    records = makeRecords(args.records, args.fields, args.values)
+    print "Serializing %s records with %s fields of %s values" % (args.records, args.fields, args.values)
+
+    (baseline, etDocs) = run("ElementTree", elementTreeSerialize, records, args.repeat)
+    (xmlSpeed, xmlDocs) = run("XmlRecordSerializer", serializerSerialize(XmlRecordSerializer()), records, args.repeat)
+    (jsonSpeed, jsonDocs) = run("JsonRecordSerializer", serializerSerialize(JsonRecordSerializer()), records, args.repeat)
+    print "Speedup: xml=%.1fx json=%.1fx" % (xmlSpeed / baseline, jsonSpeed / baseline)
+
+    # check that all serializations carry the same content
+    for etDoc, xmlDoc, jsonDoc in zip(etDocs, xmlDocs, jsonDocs):
+        assert _fields(fromstring(etDoc)) == _fields(fromstring(xmlDoc))
+        assert json.loads(jsonDoc)['id'] == fromstring(etDoc).find("field").text
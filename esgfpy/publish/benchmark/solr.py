@@ -0,0 +1,154 @@
+'''
+Module :mod:`esgfpy.publish.benchmark.solr`
+===========================================
+
+Local in-process stand-in for the Solr update and select API, used by the publishing benchmarks:
+it accepts update requests in any wire format (chunked and/or gzip-encoded), counts the requests and bytes received
+by each Solr core, and answers all queries with an empty result.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import zlib
+import json
+import time
+
+UPDATE_RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>\n<response><lst name="responseHeader">'
+                   '<int name="status">0</int><int name="QTime">0</int></lst></response>\n')
+
+SELECT_RESPONSE = json.dumps({ "responseHeader": {"status": 0, "QTime": 0},
+                               "response": {"numFound": 0, "start": 0, "docs": []},
+                               "facet_counts": {"facet_fields": {"dataset_id": []}},
+                               "facets": {"count": 0} })
+
+class StandInSolr(object):
+    """
+    HTTP server running in a background thread of the current process, one thread per connection
+    (keep-alive connections are supported, as used by the ConnectionPool).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on (0 to use any free port)
+        :param latency: number of seconds added to the processing of each update request, to simulate a slower Solr
+        """
+
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._cores = {}
+
+        self._server = _ThreadingHTTPServer((host, port), _StandInRequestHandler)
+        self._server.standIn = self
+        self._thread = None
+
+    def getUrl(self):
+        '''Returns the base Solr URL of this server (without trailing '/').'''
+
+        (host, port) = self._server.server_address
+        return "http://%s:%s/solr" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.getUrl()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def getStatistics(self):
+        """
+        Returns the number of requests and bytes received so far, as a dictionary:
+        { 'requests': N, 'bytes': N, 'decodedBytes': N, 'cores': {<core>/<handler>: {'requests': N, 'bytes': N, 'decodedBytes': N}} }
+        where 'bytes' are the bytes of the request bodies as sent on the wire (compressed, if so),
+        and 'decodedBytes' the bytes of the decompressed request bodies.
+        """
+
+        with self._lock:
+            cores = dict( (path, dict(counts)) for (path, counts) in self._cores.items() )
+        totals = { 'requests': 0, 'bytes': 0, 'decodedBytes': 0 }
+        for counts in cores.values():
+            for key in totals:
+                totals[key] += counts[key]
+        totals['cores'] = cores
+        return totals
+
+    def _record(self, path, numBytes, numDecodedBytes):
+        with self._lock:
+            if path not in self._cores:
+                self._cores[path] = { 'requests': 0, 'bytes': 0, 'decodedBytes': 0 }
+            counts = self._cores[path]
+            counts['requests'] += 1
+            counts['bytes'] += numBytes
+            counts['decodedBytes'] += numDecodedBytes
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    # send each response in one piece (flushed after each request), without delay
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('')
+
+    def do_POST(self):
+        self._handle(self._readBody())
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, body):
+
+        standIn = self.server.standIn
+        path = urlparse.urlsplit(self.path).path
+
+        numBytes = len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        standIn._record(path, numBytes, len(body))
+
+        if path.endswith('/update'):
+            if standIn.latency > 0:
+                time.sleep(standIn.latency)
+            self._reply(UPDATE_RESPONSE, 'application/xml; charset=UTF-8')
+        elif path.endswith('/select'):
+            self._reply(SELECT_RESPONSE, 'application/json; charset=UTF-8')
+        else:
+            self.send_error(404)
+
+    def _readBody(self):
+        '''Reads the request body, with either a Content-Length or chunked transfer encoding.'''
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0].strip(), 16)
+                if size == 0:
+                    # skip the trailer, up to the empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return "".join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, body, contentType):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,292 @@
+'''
+Module :mod:`esgfpy.publish.checksums`
+======================================
+
+Module containing the computation of the checksums of the published files: all the requested algorithms
+(by default MD5 and SHA256) are computed in a single pass over each file, read in large blocks into a buffer
+reused by each thread, in a pool of threads (hashlib releases the GIL while hashing), with a maximum number of
+concurrent reads per file system. The checksums are cached by (device, inode, size, modification time),
+so that unchanged files are never hashed again.
+
+The checksums that already come with a file are trusted, and the file is not read at all:
+the checksums of its sidecar files (<file>.md5, <file>.sha256, as written by the production pipelines),
+or else the checksums embedded in its metadata (for example, in the TES granule XML files). Example:
+
+    engine = ChecksumEngine(numThreads=8, ioConcurrency={"/nfs/data": 2}, cache=ChecksumCache("~/.esgfpy/checksums.db"))
+    print engine.checksums("/nfs/data/file.nc") # {'MD5': '...', 'SHA256': '...'}
+'''
+
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from esgfpy.publish.consts import CHECKSUM, CHECKSUM_TYPE
+from esgfpy.publish.instrumentation import stats
+from esgfpy.publish.walker import listings
+
+# checksum algorithms computed by default (the first one is the checksum expected by ESGF clients)
+DEFAULT_ALGORITHMS = ('MD5', 'SHA256')
+
+# size of the blocks read at once
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# checksum sidecar files: <file>.<extension>, whose first word is the hexadecimal checksum (as written by md5sum)
+SIDECAR_EXTENSIONS = [('md5', 'MD5'), ('sha256', 'SHA256')]
+
+# endings of the names of the sidecar files (which are not published themselves)
+SIDECAR_SUFFIXES = tuple( '.%s' % extension for (extension, algorithm) in SIDECAR_EXTENSIONS )
+
+# number of hexadecimal digits of the checksums of each algorithm
+HEX_LENGTHS = { 'MD5': 32, 'SHA1': 40, 'SHA224': 56, 'SHA256': 64, 'SHA384': 96, 'SHA512': 128 }
+
+_HEX_PATTERN = re.compile(r'^[0-9a-f]+$')
+
+def hashFile(path, algorithms=DEFAULT_ALGORITHMS, blockSize=BLOCK_SIZE):
+    '''Returns a dictionary of algorithm name --> hashlib object, updated with the content of the file in a single pass.'''
+
+    hashes = dict( (algorithm, hashlib.new(algorithm.lower())) for algorithm in algorithms )
+    buffer = _buffers.get(blockSize)
+    view = memoryview(buffer)
+    numBytes = 0
+    with open(path, 'rb', 0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            block = view[0:size]
+            for h in hashes.values():
+                h.update(block)
+            numBytes += size
+    stats.count('checksum.bytes', numBytes)
+    return hashes
+
+def computeChecksums(path, algorithms=DEFAULT_ALGORITHMS, blockSize=BLOCK_SIZE):
+    '''Returns a dictionary of algorithm name --> hexadecimal checksum of the file.'''
+
+    return dict( (algorithm, h.hexdigest()) for (algorithm, h) in hashFile(path, algorithms, blockSize).items() )
+
+def readSidecarChecksums(path):
+    '''Returns the dictionary of algorithm --> checksum read from the sidecar files of the file (invalid checksums are ignored).'''
+
+    checksums = {}
+    for (extension, algorithm) in SIDECAR_EXTENSIONS:
+        sidecar = "%s.%s" % (path, extension)
+        if listings.exists(sidecar):
+            with open(sidecar, 'r') as f:
+                words = f.read(1024).split()
+            checksum = normalizeChecksum(words[0] if len(words) > 0 else '', algorithm)
+            if checksum is not None:
+                checksums[algorithm] = checksum
+            else:
+                logging.warn("Invalid %s checksum in file: %s" % (algorithm, sidecar))
+    return checksums
+
+def getMetadataChecksums(metadata):
+    '''Returns the dictionary of algorithm --> checksum of the CHECKSUM and CHECKSUM_TYPE metadata values (invalid checksums are ignored).'''
+
+    checksums = {}
+    for (checksum, algorithm) in zip(metadata.get(CHECKSUM) or [], metadata.get(CHECKSUM_TYPE) or []):
+        algorithm = normalizeAlgorithm(algorithm)
+        checksum = normalizeChecksum(checksum, algorithm)
+        if checksum is not None:
+            checksums[algorithm] = checksum
+    return checksums
+
+def normalizeAlgorithm(algorithm):
+    '''Returns the algorithm name in the form used by ESGF (for example: 'sha-256' --> 'SHA256').'''
+
+    return str(algorithm).strip().upper().replace('-', '')
+
+def normalizeChecksum(checksum, algorithm):
+    '''Returns the checksum in lower case hexadecimal digits, or None if it is not a valid checksum of the algorithm.'''
+
+    checksum = str(checksum).strip().lower()
+    if len(checksum) != HEX_LENGTHS.get(algorithm, len(checksum)) or not _HEX_PATTERN.match(checksum):
+        return None
+    return checksum
+
+class ChecksumCache(object):
+    """
+    Cache of the checksums of files, keyed by (device, inode), and valid for the size and modification time
+    of the file they were computed for: in memory, or in a local sqlite database (to persist across runs).
+    """
+
+    def __init__(self, dbpath=None):
+        """
+        :param dbpath: optional location of the sqlite database file (created if not existing), None to cache in memory
+        """
+
+        self.dbpath = dbpath
+        self._lock = threading.Lock()
+        self._entries = {} # (device, inode) --> (size, mtime, dictionary of algorithm --> checksum)
+        self._conn = None
+        if dbpath is not None:
+            self._conn = sqlite3.connect(os.path.expanduser(dbpath), timeout=60, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                               "device INTEGER, inode INTEGER, size INTEGER, mtime REAL, algorithm TEXT, checksum TEXT, "
+                               "PRIMARY KEY (device, inode, algorithm))")
+            self._conn.commit()
+
+    def get(self, stat, algorithms):
+        '''Returns the checksums of the file with the given stat() result for all the algorithms, or None if any is missing.'''
+
+        with self._lock:
+            if self._conn is None:
+                entry = self._entries.get( (stat.st_dev, stat.st_ino) )
+                if entry is None or entry[0:2] != (stat.st_size, stat.st_mtime):
+                    return None
+                checksums = entry[2]
+            else:
+                rows = self._conn.execute("SELECT algorithm, checksum FROM checksums WHERE device=? AND inode=? AND size=? AND mtime=?",
+                                          (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)).fetchall()
+                checksums = dict( (str(algorithm), str(checksum)) for (algorithm, checksum) in rows )
+
+        if not all(algorithm in checksums for algorithm in algorithms):
+            return None
+        return dict( (algorithm, checksums[algorithm]) for algorithm in algorithms )
+
+    def put(self, stat, checksums):
+        '''Stores the checksums (dictionary of algorithm --> checksum) of the file with the given stat() result.'''
+
+        with self._lock:
+            if self._conn is None:
+                entry = self._entries.get( (stat.st_dev, stat.st_ino) )
+                if entry is not None and entry[0:2] == (stat.st_size, stat.st_mtime):
+                    checksums = dict(entry[2], **checksums)
+                self._entries[(stat.st_dev, stat.st_ino)] = (stat.st_size, stat.st_mtime, checksums)
+            else:
+                # discard the checksums computed for a previous version of the file
+                self._conn.execute("DELETE FROM checksums WHERE device=? AND inode=? AND (size!=? OR mtime!=?)",
+                                   (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime))
+                self._conn.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                                       [ (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime, algorithm, checksum)
+                                         for (algorithm, checksum) in checksums.items() ])
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._entries = {}
+
+class ChecksumEngine(object):
+    """
+    Computes the checksums of files in a pool of threads, started on demand.
+    The number of files read concurrently from each file system (device) is limited, so that the number of threads
+    can be tuned for the fastest file systems, without overloading the slower ones.
+    The checksums of a file are taken from the first of these sources that has any: the sidecar files,
+    the metadata of the file, the cache, and finally the content of the file.
+    """
+
+    def __init__(self, algorithms=DEFAULT_ALGORITHMS, numThreads=4, blockSize=BLOCK_SIZE,
+                 ioConcurrency=None, defaultIoConcurrency=None, cache=None, useSidecars=True, useMetadata=True):
+        """
+        :param algorithms: names of the hashlib algorithms computed for each file
+        :param numThreads: number of threads computing checksums
+        :param blockSize: size of the blocks read at once
+        :param ioConcurrency: optional dictionary of directory --> maximum number of files read concurrently
+                              from the file system of that directory
+        :param defaultIoConcurrency: maximum number of files read concurrently from any other file system
+                                     (by default, the number of threads)
+        :param cache: optional ChecksumCache (by default, the checksums are cached in memory)
+        :param useSidecars: True to trust the checksums of the sidecar files
+        :param useMetadata: True to trust the checksums embedded in the metadata of the files
+        """
+
+        self.algorithms = tuple(algorithms)
+        self.numThreads = numThreads
+        self.blockSize = blockSize
+        self.defaultIoConcurrency = defaultIoConcurrency or numThreads
+        self.cache = cache if cache is not None else ChecksumCache()
+        self.useSidecars = useSidecars
+        self.useMetadata = useMetadata
+
+        # maximum number of concurrent reads, and their semaphores, by device
+        self._ioConcurrency = {}
+        for (directory, concurrency) in (ioConcurrency or {}).items():
+            self._ioConcurrency[os.stat(directory).st_dev] = concurrency
+        self._semaphores = {}
+
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def getKnownChecksums(self, path, metadata=None):
+        '''Returns the trusted checksums that come with the file (from its sidecar files, or else its metadata), or None.'''
+
+        if self.useSidecars:
+            checksums = readSidecarChecksums(path)
+            if len(checksums) > 0:
+                stats.count('checksum.sidecar')
+                return checksums
+        if self.useMetadata and metadata is not None:
+            checksums = getMetadataChecksums(metadata)
+            if len(checksums) > 0:
+                stats.count('checksum.metadata')
+                return checksums
+        return None
+
+    def sortAlgorithms(self, checksums):
+        '''Returns the algorithms of the checksums: the ones of this engine first, in its order, then the others.'''
+
+        return ( [algorithm for algorithm in self.algorithms if algorithm in checksums]
+                 + sorted(algorithm for algorithm in checksums if algorithm not in self.algorithms) )
+
+    def checksums(self, path, stat=None):
+        '''Returns the dictionary of algorithm --> hexadecimal checksum of the file (computed in the current thread if not cached).'''
+
+        if stat is None:
+            stat = os.stat(path)
+        checksums = self.cache.get(stat, self.algorithms)
+        if checksums is None:
+            with self._getSemaphore(stat.st_dev):
+                with stats.timer('checksum', path):
+                    checksums = computeChecksums(path, self.algorithms, self.blockSize)
+            self.cache.put(stat, checksums)
+        else:
+            stats.count('checksum.cached')
+        return checksums
+
+    def submit(self, path, stat=None):
+        '''Schedules the computation of the checksums of the file: returns an AsyncResult whose get() returns the checksums.'''
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.numThreads)
+            pool = self._pool
+        return pool.apply_async(self.checksums, (path, stat))
+
+    def close(self):
+        '''Terminates the pool of threads, if started (the engine may still be used afterwards).'''
+
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _getSemaphore(self, device):
+        with self._lock:
+            semaphore = self._semaphores.get(device)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore( self._ioConcurrency.get(device, self.defaultIoConcurrency) )
+                self._semaphores[device] = semaphore
+            return semaphore
+
+class _ReadBuffers(threading.local):
+    '''Read buffer reused by all the files hashed by the current thread.'''
+
+    def __init__(self):
+        self._buffer = None
+
+    def get(self, size):
+        if self._buffer is None or len(self._buffer) != size:
+            self._buffer = bytearray(size)
+        return self._buffer
+
+_buffers = _ReadBuffers()
@@ -0,0 +1,231 @@
+'''
+Module :mod:`esgfpy.publish.connections`
+========================================
+
+Module containing a pool of persistent HTTP connections to the publishing service.
+'''
+
+import httplib
+import urlparse
+import urllib2
+import socket
+import threading
+import gzip
+import zlib
+import StringIO
+import logging
+
+class ConnectionPool(object):
+    """
+    Pool of keep-alive HTTP/HTTPS connections, reused by all requests sent to the same server
+    (i.e. shared by all Solr cores hosted by that server).
+    Responses may be gzip-encoded, request bodies are optionally gzip-compressed,
+    and the number of requests in flight at any time is bounded by the maximum number of connections.
+    Request bodies given as iterables of strings are streamed with chunked transfer encoding,
+    so that they never need to be held in memory at once.
+    """
+
+    def __init__(self, maxConnections=4, timeout=120, compressRequests=False, compressLevel=6, chunkSize=64*1024):
+        """
+        :param maxConnections: maximum number of connections (and of concurrent requests) per pool
+        :param timeout: socket timeout in seconds
+        :param compressRequests: True to send gzip-compressed request bodies
+                                 (the server must accept 'Content-Encoding: gzip')
+        :param compressLevel: gzip compression level for request bodies (1-9)
+        :param chunkSize: minimum size of each chunk of a streamed request body (smaller pieces are coalesced)
+        """
+
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.compressRequests = compressRequests
+        self.compressLevel = compressLevel
+        self.chunkSize = chunkSize
+
+        # bounds the number of requests in flight
+        self._semaphore = threading.BoundedSemaphore(maxConnections)
+
+        # idle connections, keyed by (scheme, host:port)
+        self._lock = threading.Lock()
+        self._idleConnections = {}
+
+    def request(self, method, url, body=None, headers={}):
+        """
+        Executes an HTTP request and returns the (decoded) response body.
+        Raises urllib2.HTTPError if the server returns an error status.
+
+        :param method: HTTP method ('GET', 'POST')
+        :param url: full request URL
+        :param body: optional request body: a string, or an iterable of strings to be streamed in chunks
+        :param headers: optional dictionary of request headers
+        """
+
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        if query:
+            path = "%s?%s" % (path, query)
+        key = (scheme, netloc)
+
+        headers = dict(headers)
+        headers['Accept-Encoding'] = 'gzip'
+        streaming = body is not None and not isinstance(body, basestring)
+        if streaming:
+            headers['Transfer-Encoding'] = 'chunked'
+            if self.compressRequests:
+                body = compressPieces(body, self.compressLevel)
+                headers['Content-Encoding'] = 'gzip'
+        elif body is not None and self.compressRequests:
+            body = compress(body, self.compressLevel)
+            headers['Content-Encoding'] = 'gzip'
+
+        self._semaphore.acquire()
+        try:
+            if streaming:
+                (response, data) = self._stream(key, method, path, body, headers)
+            else:
+                (response, data) = self._execute(key, method, path, body, headers)
+        finally:
+            self._semaphore.release()
+
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            data = decompress(data)
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO.StringIO(data))
+
+        return data
+
+    def close(self):
+        """Closes all idle connections."""
+
+        with self._lock:
+            for connections in self._idleConnections.values():
+                for conn in connections:
+                    conn.close()
+            self._idleConnections = {}
+
+    def _execute(self, key, method, path, body, headers):
+        '''Sends the request on an idle connection, retrying once on a new connection if the server closed it.'''
+
+        (conn, reused) = self._acquire(key)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped the idle connection: try again on a fresh one
+            logging.debug("Re-opening connection to %s://%s after error: %s" % (key[0], key[1], e))
+            conn = self._connect(key)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        return (response, data)
+
+    def _stream(self, key, method, path, body, headers):
+        '''
+        Streams the request body in chunks on a new connection
+        (a streamed body cannot be sent again if an idle connection turns out to be closed).
+        '''
+
+        conn = self._connect(key)
+        try:
+            conn.putrequest(method, path, skip_accept_encoding=True)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.endheaders()
+            for chunk in _chunks(body, self.chunkSize):
+                conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+            conn.send("0\r\n\r\n")
+            response = conn.getresponse()
+            data = response.read()
+        except:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        return (response, data)
+
+    def _acquire(self, key):
+        '''Returns a tuple (connection, reused) for the given server.'''
+
+        with self._lock:
+            connections = self._idleConnections.get(key, [])
+            if len(connections) > 0:
+                return (connections.pop(), True)
+        return (self._connect(key), False)
+
+    def _release(self, key, conn):
+        '''Returns a connection to the pool of idle connections.'''
+
+        with self._lock:
+            connections = self._idleConnections.setdefault(key, [])
+            if len(connections) < self.maxConnections:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, key):
+        '''Opens a new connection to the given server.'''
+
+        (scheme, netloc) = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            return httplib.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise Exception("Unsupported URL scheme: %s" % scheme)
+
+def compress(data, level=6):
+    '''Compresses a string into gzip format.'''
+
+    buf = StringIO.StringIO()
+    gzfile = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level)
+    gzfile.write(data)
+    gzfile.close()
+    return buf.getvalue()
+
+def compressPieces(pieces, level=6):
+    '''Generator that compresses an iterable of strings into gzip format, one piece at a time.'''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _chunks(pieces, chunkSize):
+    '''Generator that coalesces an iterable of strings into non-empty chunks of at least chunkSize bytes (except the last).'''
+
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunkSize:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if size > 0:
+        yield ''.join(buf)
+
+def decompress(data):
+    '''Decompresses a string in gzip format.'''
+
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
@@ -22,6 +22,10 @@ SOLR_CORES = {
               TYPE_AGGREGATION: 'aggregations'
              }
 
+# wire formats of Solr update requests
+FORMAT_XML = 'xml'
+FORMAT_JSON = 'json'
+
 SUBTYPE_IMAGE = "image"
 SUBTYPE_MOVIE = "movie"
 SUBTYPE_DOCUMENT = "document"
@@ -24,8 +24,12 @@ SUBDIRS = instrument, version
 
 from esgfpy.publish.factories import DirectoryDatasetRecordFactory, FilepathFileRecordFactory
 from esgfpy.publish.services import FileSystemIndexer, PublishingClient
+from esgfpy.publish.manifest import FileStateManifest
+from esgfpy.publish.spool import Outbox
+from esgfpy.publish.instrumentation import stats
+from esgfpy.publish.pipeline import PipelinedPublishingClient
 from esgfpy.publish.metadata_mappers import ConfigFileMetadataMapper
-from esgfpy.publish.consts import SERVICE_HTTP, SERVICE_OPENDAP, SERVICE_THREDDS
+from esgfpy.publish.consts import SERVICE_HTTP, SERVICE_OPENDAP, SERVICE_THREDDS, FORMAT_XML
 from esgfpy.publish.utils import str2bool
 import sys, os
 import ConfigParser
@@ -155,6 +159,7 @@ if __name__ == '__main__':
 
     # Files records factory
     maxDaysPast = int(os.getenv('MAX_DAYS_PAST', -1)) # optional environment to harvest only the most recent files
+    numProcesses = int(os.getenv('NUM_PROCESSES', 1)) # optional environment to parse files in parallel
     myFileRecordFactory = FilepathFileRecordFactory(fields=fileFields,
                                                     rootDirectory=ROOT_DIR,
                                                     filenamePatterns=FILENAME_PATTERNS,
@@ -162,7 +167,8 @@ if __name__ == '__main__':
                                                                SERVICE_OPENDAP : BASE_URL_OPENDAP },
                                                     generateChecksum=False,
                                                     metadataMapper=metadataMapper,
-                                                    maxDaysPast=maxDaysPast
+                                                    maxDaysPast=maxDaysPast,
+                                                    numProcesses=numProcesses
                                                     )
     # use special list of metadata parsers
     myFileRecordFactory.metadataParsers = [AcosLiteFileParser_v34r03(), AcosLiteFileParser_v35r02(), AcosFileParser(),
@@ -178,15 +184,60 @@ if __name__ == '__main__':
     datasetMetadataKeysToCopy = {'project':append, 'instrument':append, 'version':append, "institute":append,
                                  "processing_level":append, 'mission':append, 'collection':append, 'product':append }
 
+    # optional environment to only publish the files that changed since the last run
+    manifestFile = os.getenv('MANIFEST_FILE', None)
+    manifest = FileStateManifest(manifestFile) if manifestFile else None
+
     indexer = FileSystemIndexer(myDatasetRecordFactory, myFileRecordFactory,
-                                fileMetadataKeysToCopy=fileMetadataKeysToCopy, datasetMetadataKeysToCopy=datasetMetadataKeysToCopy)
+                                fileMetadataKeysToCopy=fileMetadataKeysToCopy, datasetMetadataKeysToCopy=datasetMetadataKeysToCopy,
+                                manifest=manifest)
     maxRecords = -1 # publish all records
-    publisher = PublishingClient(indexer, SOLR_URL, maxRecords=maxRecords)
+    numPosters = int(os.getenv('NUM_POSTERS', 0)) # optional environment to run the pipelined publisher with N poster threads
+    updateFormat = os.getenv('UPDATE_FORMAT', FORMAT_XML) # optional environment to send the records as 'xml' or 'json'
+    # optional environment to quarantine the records rejected by Solr into a local file, instead of aborting
+    rejectFile = os.getenv('REJECT_FILE', None)
+    # optional environment to spool the update requests into a local directory while Solr is unavailable
+    # (to be replayed with: python -m esgfpy.publish.spool <OUTBOX_DIR> <SOLR_URL>)
+    outboxDir = os.getenv('OUTBOX_DIR', None)
+    outbox = Outbox(outboxDir) if outboxDir else None
+    # optional environment to recompute the number of files (and total size) of the published datasets
+    updateDatasets = str2bool(os.getenv('UPDATE_DATASETS', 'false'))
+    updateSizes = str2bool(os.getenv('UPDATE_SIZES', 'false'))
+    if outbox is not None and updateDatasets:
+        # the dataset counts would be queried from the index before the spooled records are added to it
+        sys.exit("ERROR: UPDATE_DATASETS cannot be combined with OUTBOX_DIR")
+    if numPosters > 0:
+        # queue depths are reported through logging.info every 30 seconds
+        publisher = PipelinedPublishingClient(indexer, SOLR_URL, numPosters=numPosters, maxRecords=maxRecords,
+                                              format=updateFormat, updateDatasets=updateDatasets, updateSizes=updateSizes,
+                                              rejectFile=rejectFile, outbox=outbox)
+    else:
+        # optional environment to stream each batch of records in a single chunked request
+        streaming = str2bool(os.getenv('STREAM_REQUESTS', 'false'))
+        publisher = PublishingClient(indexer, SOLR_URL, maxRecords=maxRecords, format=updateFormat, streaming=streaming,
+                                     updateDatasets=updateDatasets, updateSizes=updateSizes, rejectFile=rejectFile,
+                                     outbox=outbox)
     startDirectory = os.path.join(ROOT_DIR, relativeDirectory)
 
+    # optional environment to time the stages of publishing, and write the timings to a JSON or Prometheus ('.prom') file
+    statsFile = os.getenv('STATS_FILE', None)
+    if statsFile:
+        stats.enable()
+
     if publish:
-        print 'Publishing...(maxDaysPast=%s)' % maxDaysPast
+        print 'Publishing...(maxDaysPast=%s, numProcesses=%s)' % (maxDaysPast, numProcesses)
         publisher.publish(startDirectory)
     else:
-        print 'Un-Publishing...'
-        publisher.unpublish(startDirectory)
+        # optional environment to unpublish all datasets in the directory by identifier ('query'),
+        # instead of only the records of the accepted files, found by parsing the files again ('parse', the default)
+        unpublishMode = os.getenv('UNPUBLISH_MODE', 'parse')
+        dryRun = str2bool(os.getenv('DRY_RUN', 'false')) # optional environment to only count the records to unpublish
+        print 'Un-Publishing...(mode=%s, dryRun=%s)' % (unpublishMode, dryRun)
+        if unpublishMode == 'query':
+            publisher.unpublishByUri(startDirectory, dryRun=dryRun)
+        else:
+            publisher.unpublish(startDirectory)
+
+    if statsFile:
+        print stats.summary()
+        stats.write(statsFile)
@@ -1,10 +1,15 @@
 import string
 import os
+import itertools
 
-from esgfpy.publish.models import DatasetRecord
+from esgfpy.publish.models import DatasetRecord, RecordFields, freezeFields
 from esgfpy.publish.parsers import XMLMetadataFileParser, DirectoryMetadataParser
 from esgfpy.publish.factories.utils import generateUrls
 from esgfpy.publish.factories.utils import generateId
+from esgfpy.publish.instrumentation import stats
+from esgfpy.publish.walker import listings
+from esgfpy.publish.templates import DirectoryTemplates
+import logging
 import abc
 
 
@@ -22,20 +27,45 @@ class AbstractDatasetRecordFactory(object):
         """
         raise NotImplementedError
 
+    def getIdentifierPrefix(self, uri):
+        """
+        Returns the common prefix of the identifiers of all datasets generated from the given resource URI
+        and the resources it contains, without generating them (or None if not supported).
+        """
+        return None
+
+    def containsIdentifier(self, uri, identifier):
+        """
+        Returns True if a dataset with the given identifier (before version and data node, i.e. its 'master_id')
+        may have been generated from the given resource URI or the resources it contains.
+        The default implementation accepts the identifiers that extend getIdentifierPrefix() with '.' separated parts.
+        """
+        prefix = self.getIdentifierPrefix(uri)
+        return prefix is not None and (identifier == prefix or identifier.startswith(prefix + "."))
+
+    def canContainDatasets(self, uri):
+        """
+        Returns False if no dataset can be generated from the given resource URI, nor from any resource it contains,
+        so that they do not need to be visited (the default implementation always returns True).
+        """
+        return True
+
 class DirectoryDatasetRecordFactory(AbstractDatasetRecordFactory):
     """
     Class that generates DatasetRecord objects
     from a structured directory tree.
     """
 
-    def __init__(self, rootId, rootDirectory="/", subDirs=[], fields={},
+    def __init__(self, rootId, rootDirectory="/", subDirs=[], fields=None,
                  metadataMapper=None, baseUrls={}, addVersion=True):
         """
         :param rootId: root of assigned dataset identifiers
         :param rootDirectory: root filepath removed before parsing for subdirectories
         :param subDirs: list of one or more directory templates.
                         Datasets and files will be published only if they are stored in a directory that matches one of the templates.
-        :param fields: constants metadata fields as (key, values) pairs
+                        Each template element may constrain the sub-directory name with a regular expression: 'key=regex'
+                        (see DirectoryTemplates); the sub-trees that cannot match any template are not walked.
+        :param fields: constants metadata fields as (key, values) pairs (shared by all Dataset records, not copied)
         :param metadataMapper: optional class to map metadata values to controlled vocabulary
         :param baseUrls: map of (base server URL, server name) to create dataset access URLs
         :param addVersion: True to add version information to dataset identifier (if not included already from directory structure)
@@ -43,7 +73,8 @@ class DirectoryDatasetRecordFactory(AbstractDatasetRecordFactory):
         self.rootId = rootId
         self.rootDirectory = rootDirectory
         self.subDirs = subDirs
-        self.fields = fields
+        self.templates = DirectoryTemplates(subDirs)
+        self.fields = freezeFields(fields, metadataMapper)
         self.metadataMapper = metadataMapper
         self.baseUrls = baseUrls
         self.addVersion = addVersion
@@ -60,7 +91,7 @@ class DirectoryDatasetRecordFactory(AbstractDatasetRecordFactory):
         (otherwise None is returned).
         """
 
-        if os.path.isdir(directory):
+        if listings.isDirectory(directory):
 
             if self.rootDirectory in directory:
 
@@ -69,17 +100,18 @@ class DirectoryDatasetRecordFactory(AbstractDatasetRecordFactory):
                 if directory.startswith("/"):
                     directory = directory[1:]
                 parts = directory.split(os.sep)
-                for subDirs in self.subDirs:
+                for subDirs in self.templates.matching(parts):
                     if len(parts) == len(subDirs):
 
                         print 'Parsing directory: %s'  % directory
 
                         # add dataset-level metadata from configured parsers to fixed metadata fields
-                        metadata = self.fields.copy()
+                        metadata = RecordFields(shared=self.fields)
                         dirpath = os.path.join(self.rootDirectory, directory)
                         for parser in self.metadataParsers:
-                            met = parser.parseMetadata(dirpath)
-                            metadata = dict(metadata.items() + met.items()) # NOTE: met items override metadata items
+                            with stats.timer('parse.%s' % parser.__class__.__name__, dirpath):
+                                met = parser.parseMetadata(dirpath)
+                            metadata.update(met) # NOTE: met items override metadata items
 
                         # add dataset-level access URLs
                         urls = generateUrls(self.baseUrls, self.rootDirectory, directory)
@@ -100,13 +132,75 @@ class DirectoryDatasetRecordFactory(AbstractDatasetRecordFactory):
 
                         # optional mapping of metadata values
                         if self.metadataMapper is not None:
-                            for key, values in metadata.items():
-                                for i, value in enumerate(values):
-                                    values[i] = self.metadataMapper.mappit(key, value)
+                            metadata.mapValues(self.metadataMapper)
 
                         # create and return one Dataset record
                         return DatasetRecord(id, title, metadata)
 
         # no Dataset record created - return None
-        print "Directory %s does NOT match any sub-directory template" % directory
-        return None
\ No newline at end of file
+        logging.debug("Directory %s does NOT match any sub-directory template" % directory)
+        return None
+
+    def getIdentifierPrefix(self, directory):
+        """
+        Returns the identifier (before version and data node) shared by all datasets in the given directory and its
+        sub-directories, built from the directory parts as in create(), provided the directory matches the beginning
+        of one of the templates (otherwise None is returned).
+        """
+
+        directory = directory.replace(self.rootDirectory,"").strip("/")
+        parts = directory.split(os.sep) if len(directory) > 0 else []
+        if self.templates.canContain(parts):
+            return "".join([self.rootId] + [".%s" % part for part in parts])
+        return None
+
+    def containsIdentifier(self, directory, identifier):
+        """
+        Returns True if the identifier extends the prefix of the directory with the sub-directory names
+        that complete one of the templates, so that the datasets of sibling directories whose name extends
+        the directory name after a '.' (for example, '.../v3.5' for '.../v3') are not mistaken for the datasets
+        of the directory. Since the sub-directory names may contain '.', all the ways to split the rest of the identifier
+        into sub-directory names are tried.
+        """
+
+        prefix = self.getIdentifierPrefix(directory)
+        if prefix is None:
+            return False
+        if identifier == prefix:
+            tokens = []
+        elif identifier.startswith(prefix + "."):
+            tokens = identifier[len(prefix) + 1:].split(".")
+        else:
+            return False
+
+        directory = directory.replace(self.rootDirectory,"").strip("/")
+        parts = directory.split(os.sep) if len(directory) > 0 else []
+        if len(tokens) == 0:
+            return len(self.templates.matching(parts)) > 0
+        for numParts in set(len(keys) - len(parts) for keys in self.templates.keys):
+            if 0 < numParts <= len(tokens):
+                # all the choices of split points between the tokens
+                for splits in itertools.combinations(range(1, len(tokens)), numParts - 1):
+                    bounds = (0,) + splits + (len(tokens),)
+                    names = [".".join(tokens[bounds[i]:bounds[i+1]]) for i in range(numParts)]
+                    if len(self.templates.matching(parts + names)) > 0:
+                        return True
+        return False
+
+    def canContainDatasets(self, directory):
+        """
+        Returns False if neither the given directory nor any of its sub-directories can match a template
+        (it is deeper than all templates, or a sub-directory name does not satisfy the template constraints),
+        so that the walker does not list it.
+        """
+
+        rootDirectory = self.rootDirectory.rstrip("/")
+        directory = directory.rstrip("/")
+
+        # the root directory, or one of its parents
+        if directory == rootDirectory or rootDirectory.startswith(directory + "/"):
+            return True
+        # outside of the root directory
+        elif not directory.startswith(rootDirectory + "/"):
+            return False
+        return self.templates.canContain(directory[len(rootDirectory) + 1:].split(os.sep))
\ No newline at end of file
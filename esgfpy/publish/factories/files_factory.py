@@ -1,17 +1,23 @@
 import string
 import os
-import re
 
-from esgfpy.publish.models import FileRecord
+from esgfpy.publish.models import FileRecord, RecordFields, freezeFields
 from esgfpy.publish.consts import (FILE_SUBTYPES, SUBTYPE_IMAGE, THUMBNAIL_EXT,
                                    CHECKSUM, CHECKSUM_TYPE, TRACKING_ID, SIZE)
 
 from esgfpy.publish.factories.utils import generateUrls
-from esgfpy.publish.parsers import NetcdfMetadataFileParser, XMLMetadataFileParser, FilenameMetadataParser
+from esgfpy.publish.parsers import (NetcdfMetadataFileParser, XMLMetadataFileParser, FilenameMetadataParser, ParserRegistry,
+                                    CachingMetadataFileParser)
 from esgfpy.publish.factories.utils import generateId
 from esgfpy.publish.consts import MASTER_ID
-import hashlib
+from esgfpy.publish.instrumentation import stats
+from esgfpy.publish.walker import FileEntry
+from esgfpy.publish.matching import FilenameMatcher
+from esgfpy.publish.checksums import ChecksumEngine, hashFile, BLOCK_SIZE
 import logging
+import multiprocessing
+from multiprocessing.util import Finalize
+from collections import deque
 from uuid import uuid4
 import datetime as dt
 import abc
@@ -31,147 +37,337 @@ class AbstractFileRecordFactory(object):
         """
         raise NotImplementedError
 
+    def createRecords(self, datasetRecord, uris, fileEntries={}):
+        """
+        Generates the FileRecords for a sequence of resource URIs belonging to the same parent Dataset record.
+        The default implementation invokes create() on each URI in turn, subclasses may process the URIs concurrently.
+        :param datasetRecord: parent dataset record
+        :param uris: list of source URIs for generating file records
+        :param fileEntries: optional dictionary of URI to directory entry (as returned by scandir() while walking the tree),
+                            that subclasses may use instead of querying the file system again (ignored by default)
+        :return: generator of (URI, FileRecord object) tuples, in the same order as the URIs (URIs that generate no record are skipped)
+        """
+        for uri in uris:
+            record = self.create(datasetRecord, uri)
+            if record is not None:
+                yield (uri, record)
+
+    def canCreate(self, uri):
+        """
+        Returns False if no record can be generated from the given resource URI, whatever its content or age
+        (for example, because its name does not match the configured patterns). The default implementation returns True.
+        """
+        return True
+
+    def close(self):
+        """Releases any resources held by this factory (it may still be used afterwards)."""
+        pass
+
 class FilepathFileRecordFactory(AbstractFileRecordFactory):
     """Class that generates FileRecord objects from a filepath in the local file system."""
 
-    def __init__(self, fields={}, rootDirectory=None, filenamePatterns=[], baseUrls={},
+    def __init__(self, fields=None, rootDirectory=None, filenamePatterns=[], baseUrls={},
                  generateThumbnails=False, generateChecksum=False, generateTrackingId=False, metadataMapper=None,
-                 maxDaysPast=-1):
+                 maxDaysPast=-1, numProcesses=1, metadataCache=None, checksumEngine=None):
         """
-        :param fields: constants metadata fields as (key, values) pairs
+        :param fields: constants metadata fields as (key, values) pairs (shared by all File records, not copied)
         :param rootDirectory: root directory of file location, will be removed when creating the file access URL
         :param filenamePatterns: optional list of matching filename patterns (with named groups)
         :param baseUrls: map of (base server URL, server name) to create file access URLs
         :param generateThumbnails: set to True to automatically generate thumbnails when publishing image files
         :param metadataMapper: optional class to map metadata values to controlled vocabulary
         :param maxDaysPast: optional parameter to process only files more recent than N days old 
+        :param numProcesses: number of worker processes used by createRecords() to parse the file metadata in parallel
+                             (1 to parse all files in the current process)
+        :param metadataCache: optional MetadataCache of the metadata extracted by the CACHEABLE parsers,
+                              so that unchanged files are not parsed again
+        :param checksumEngine: optional ChecksumEngine used if generateChecksum=True
+                               (by default, one computing the MD5 and SHA256 checksums in 4 threads,
+                               unless they are available from the sidecar files or the metadata of the file)
         """
 
-        self.fields = fields
+        self.fields = freezeFields(fields, metadataMapper)
         self.rootDirectory = rootDirectory
         self.filenamePatterns = filenamePatterns
+        self.filenameMatcher = FilenameMatcher(filenamePatterns)
         self.baseUrls = baseUrls
         self.generateThumbnails = generateThumbnails
         self.generateChecksum = generateChecksum
+        self.checksumEngine = checksumEngine
         self.generateTrackingId = generateTrackingId
         self.metadataMapper = metadataMapper
         self.maxDaysPast = maxDaysPast
+        self.numProcesses = numProcesses
+        self.metadataCache = metadataCache
 
-        # define list of metadata parsers
-        self.metadataParsers = [ FilenameMetadataParser(self.filenamePatterns),
+        # pool of metadata parsing processes, started on demand
+        self._pool = None
+
+        # define list of metadata parsers (each file is only passed to the parsers claiming it, see ParserRegistry)
+        self.metadataParsers = [ FilenameMetadataParser(self.filenameMatcher),
                                  NetcdfMetadataFileParser(),
                                  XMLMetadataFileParser() ]
+        self._parserRegistry = None
+        self._registeredParsers = None
 
-    def create(self, datasetRecord, filepath):
-
-        if os.path.isfile(filepath):
-            
-            dir, filename = os.path.split(filepath)
-            if self._matches(filename):
-                
-                # optional limit on file age
-                lastModDateTime = dt.datetime.fromtimestamp( os.path.getmtime(filepath) )
-                if self.maxDaysPast < 0 or (dt.datetime.now() - lastModDateTime).days <= self.maxDaysPast:
-                    
-                    name, extension = os.path.splitext(filename)
-                    ext =  extension[1:] # remove '.' from file extension
-        
-                    fields = {}
-                    fields['format'] = [ext]
-                    isImage = False
-                    for subtype, values in FILE_SUBTYPES.items():
-                        if ext in values:
-                            fields['subtype'] = [subtype]
-                            if subtype==SUBTYPE_IMAGE:
-                                isImage=True
-        
-                    # create image thumbnail ?
-                    if self.generateThumbnails and isImage:
-                        thumbnailPath = os.path.join(dir, "%s.%s" % (name, THUMBNAIL_EXT) )
-                        self._generateThumbnail(filepath, thumbnailPath)
-        
-                    # add file access URLs
-                    urls = generateUrls(self.baseUrls, self.rootDirectory, filepath, isImage=isImage)
-                    if len(urls)>0:
-                        fields["url"] = urls
-        
-                    # add file-level metadata from configured parsers to fixed metadata
-                    metadata = self.fields.copy()
-                    metadata = dict(metadata.items() + fields.items()) # FIXME
-                    for parser in self.metadataParsers:
-                        met = parser.parseMetadata(filepath)
-                        metadata = dict(metadata.items() + met.items()) # NOTE: met items override metadata items
-        
-                    # build 'id', 'instance_id, 'master_id'
-                    # start from dataset 'master_id' since it has no version, data_node information
-                    identifier = string.join( [datasetRecord.fields[MASTER_ID][0], filename], '.')
-                    id = generateId(identifier, metadata)
-        
-                    # set record title to filename - rename 'title' global attribute if found
-                    try:
-                        title = metadata['title'][0]
-                        metadata['file title'] = [ title ]
-                        del metadata['title']
-                    except KeyError:
-                        pass
-                    title = filename
-                    
-                    # file size
-                    metadata[SIZE] = [ os.path.getsize(filepath) ]
-        
-                    # create Md5 checksum ?
-                    if self.generateChecksum:
-                        logging.debug('Computing Md5 checksum for file: %s ...' % filepath)
-                        md5 = md5_for_file(filepath, hr=True)
-                        logging.debug('...Md5 checksum=%s' % md5)
-                        metadata[CHECKSUM] = [md5]
-                        metadata[CHECKSUM_TYPE] = ['MD5']
-        
-                    # generate tracking ID ?
-                    if self.generateTrackingId:
-                        metadata[TRACKING_ID] = [str(uuid4())]                    
-                        
-                    # optional mapping of metadata values
-                    if self.metadataMapper is not None:
-                        for key, values in metadata.items():
-                            for i, value in enumerate(values):
-                                values[i] = self.metadataMapper.mappit(key, value)
-        
-                    return FileRecord(datasetRecord, id, title, metadata)
-        
-            # create no record
-            return None
+    def create(self, datasetRecord, filepath, entry=None):
+        """
+        :param entry: optional directory entry of the file (as returned by scandir()), whose cached stat() result is used
+                      instead of querying the file system again
+        """
+
+        if entry is None:
+            entry = FileEntry(filepath)
+        if self._accepts(entry):
+            with stats.timer('create.file', filepath):
+                return self._createRecord(datasetRecord, filepath, parseFileMetadata(self._getParserRegistry(), filepath), entry)
+
+        # create no record
+        return None
+
+    def createRecords(self, datasetRecord, filepaths, fileEntries={}):
+        """
+        Overridden superclass method to use the directory entries of the files (each file is stat'ed at most once),
+        to parse the metadata of the accepted files in a pool of worker processes, and to compute their checksums
+        in the threads of the checksum engine while the metadata of the next files is parsed.
+        The checksums are only computed for the files that have none in their sidecar files or metadata,
+        which is only known once the file is parsed: the records are created a few files behind the parsing.
+        The records are streamed back in the order of the filepaths.
+        """
+
+        fileEntries = dict( (filepath, fileEntries.get(filepath) or FileEntry(filepath)) for filepath in filepaths )
+        filepaths = [filepath for filepath in filepaths if self._accepts(fileEntries[filepath])]
+
+        # files parsed, whose record is not yet created: (filepath, metadata, checksums or pending checksums)
+        window = deque()
+        windowSize = self._getChecksumEngine().numThreads if self.generateChecksum else 0
+
+        for (filepath, metadata) in self._parseFiles(filepaths):
+            checksums = None
+            if self.generateChecksum:
+                engine = self._getChecksumEngine()
+                checksums = engine.getKnownChecksums(filepath, metadata)
+                if checksums is None:
+                    checksums = engine.submit(filepath, fileEntries[filepath].stat())
+            window.append( (filepath, metadata, checksums) )
+
+            while len(window) > windowSize:
+                (filepath, metadata, checksums) = window.popleft()
+                yield (filepath, self._createRecord(datasetRecord, filepath, metadata, fileEntries[filepath], checksums))
+
+        while len(window) > 0:
+            (filepath, metadata, checksums) = window.popleft()
+            yield (filepath, self._createRecord(datasetRecord, filepath, metadata, fileEntries[filepath], checksums))
+
+    def _parseFiles(self, filepaths):
+        '''Generator of the (filepath, metadata) tuples of the files, parsed in the current process or in the pool of worker processes.'''
+
+        if self.numProcesses <= 1:
+            for filepath in filepaths:
+                with stats.timer('create.file', filepath):
+                    metadata = parseFileMetadata(self._getParserRegistry(), filepath)
+                yield (filepath, metadata)
 
         else:
-            raise Exception("%s is not a file" % filepath)
-        
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.numProcesses, initializer=_initMetadataParsers,
+                                                  initargs=(self._getParserRegistry(), stats.enabled))
+            for filepath, (metadata, observations) in zip(filepaths, self._pool.imap(_parseFileMetadata, filepaths)):
+                # add the parser timings observed in the worker process
+                if observations is not None:
+                    stats.merge(observations)
+                yield (filepath, metadata)
+
+    def _getParserRegistry(self):
+        """
+        Returns the dispatch index of the metadata parsers, rebuilt whenever the list of parsers has changed.
+        If a metadata cache is configured, the CACHEABLE parsers are wrapped with it.
+        """
+
+        if self._parserRegistry is None or self._registeredParsers != self.metadataParsers:
+            self._registeredParsers = list(self.metadataParsers)
+            parsers = self.metadataParsers
+            if self.metadataCache is not None:
+                parsers = [ CachingMetadataFileParser(parser, self.metadataCache) if getattr(parser, 'CACHEABLE', False) else parser
+                            for parser in parsers ]
+            self._parserRegistry = ParserRegistry(parsers)
+        return self._parserRegistry
+
+    def _getChecksumEngine(self):
+        """Returns the engine computing the checksums, created on demand."""
+
+        if self.checksumEngine is None:
+            self.checksumEngine = ChecksumEngine()
+        return self.checksumEngine
+
+    def close(self):
+        """
+        Terminates the pool of metadata parsing processes and the threads of the checksum engine, if started,
+        and writes the pending updates of the metadata cache.
+        """
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self.checksumEngine is not None:
+            self.checksumEngine.close()
+        if self.metadataCache is not None:
+            self.metadataCache.flush()
+
+    def canCreate(self, filepath):
+        """Returns True if the name of the file matches one of the configured patterns."""
+
+        return self._matches(os.path.basename(filepath))
+
+    def _accepts(self, entry):
+        """Returns True if a record must be created for the file with the given directory entry."""
+
+        # only the files with a matching name are stat'ed
+        if self._matches(entry.name):
+
+            if not entry.is_file():
+                raise Exception("%s is not a file" % entry.path)
+
+            # optional limit on file age
+            if self.maxDaysPast >= 0:
+                lastModDateTime = dt.datetime.fromtimestamp( entry.stat().st_mtime )
+                return (dt.datetime.now() - lastModDateTime).days <= self.maxDaysPast
+            return True
+
+        return False
+
+    def _createRecord(self, datasetRecord, filepath, parsedMetadata, entry, pendingChecksums=None):
+        """
+        Creates the FileRecord for an accepted file, given its directory entry and the metadata extracted by the configured parsers.
+        :param pendingChecksums: optional checksums of the file (dictionary of algorithm --> checksum),
+                                 or AsyncResult of the checksums submitted to the checksum engine
+        """
+
+        dir, filename = os.path.split(filepath)
+        name, extension = os.path.splitext(filename)
+        ext =  extension[1:] # remove '.' from file extension
+
+        fields = {}
+        fields['format'] = [ext]
+        isImage = False
+        for subtype, values in FILE_SUBTYPES.items():
+            if ext in values:
+                fields['subtype'] = [subtype]
+                if subtype==SUBTYPE_IMAGE:
+                    isImage=True
+
+        # create image thumbnail ?
+        if self.generateThumbnails and isImage:
+            thumbnailPath = os.path.join(dir, "%s.%s" % (name, THUMBNAIL_EXT) )
+            self._generateThumbnail(filepath, thumbnailPath)
+
+        # add file access URLs
+        urls = generateUrls(self.baseUrls, self.rootDirectory, filepath, isImage=isImage)
+        if len(urls)>0:
+            fields["url"] = urls
+
+        # add file-level metadata from configured parsers to fixed metadata (referenced, not copied)
+        metadata = RecordFields(fields, shared=self.fields)
+        metadata.update(parsedMetadata) # NOTE: parsed items override metadata items
+
+        # build 'id', 'instance_id, 'master_id'
+        # start from dataset 'master_id' since it has no version, data_node information
+        identifier = string.join( [datasetRecord.fields[MASTER_ID][0], filename], '.')
+        id = generateId(identifier, metadata)
+
+        # set record title to filename - rename 'title' global attribute if found
+        try:
+            title = metadata['title'][0]
+            metadata['file title'] = [ title ]
+            del metadata['title']
+        except KeyError:
+            pass
+        title = filename
+
+        # file size
+        metadata[SIZE] = [ entry.stat().st_size ]
+
+        # create checksums (MD5 first) ?
+        # the checksums of the sidecar files, or of the metadata, are used as is (the missing algorithms are not computed)
+        if self.generateChecksum:
+            engine = self._getChecksumEngine()
+            checksums = pendingChecksums
+            if checksums is None:
+                checksums = engine.getKnownChecksums(filepath, parsedMetadata)
+            if checksums is None:
+                logging.debug('Computing checksums for file: %s ...' % filepath)
+                checksums = engine.checksums(filepath, entry.stat())
+            elif not isinstance(checksums, dict):
+                checksums = checksums.get()
+            logging.debug('...checksums=%s' % checksums)
+            algorithms = engine.sortAlgorithms(checksums)
+            metadata[CHECKSUM] = [checksums[algorithm] for algorithm in algorithms]
+            metadata[CHECKSUM_TYPE] = algorithms
+
+        # generate tracking ID ?
+        if self.generateTrackingId:
+            metadata[TRACKING_ID] = [str(uuid4())]
+
+        # optional mapping of metadata values
+        if self.metadataMapper is not None:
+            metadata.mapValues(self.metadataMapper)
+
+        return FileRecord(datasetRecord, id, title, metadata)
+
     def _matches(self, filename):
         '''Returns True if the file name matches one of the configured file patterns.'''
         
-        match = False
-        for pattern in self.filenamePatterns:
-            match = re.match(pattern, filename)
-            if match:
-                return True
-            
-        if not match:
-            logging.debug('\tNo matching pattern found for filename: %s' % filename)
+        if self.filenameMatcher.match(filename):
+            return True
 
+        logging.debug('\tNo matching pattern found for filename: %s' % filename)
         return False
 
-def md5_for_file(path, block_size=256*128, hr=False):
+def parseFileMetadata(parsers, filepath):
     '''
-    Function to compute the Md5 checksum of a file.
+    Function to merge the metadata extracted from a file by a list of parsers (later parsers override earlier ones).
+    :param parsers: list of metadata parsers, or ParserRegistry (only the parsers claiming the file are invoked)
+    '''
+
+    if not isinstance(parsers, ParserRegistry):
+        parsers = ParserRegistry(parsers)
+
+    metadata = {}
+    for parser in parsers.getParsers(filepath):
+        with stats.timer('parse.%s' % parser.__class__.__name__, filepath):
+            met = parser.parseMetadata(filepath)
+        metadata = dict(metadata.items() + met.items()) # NOTE: met items override metadata items
+    return metadata
+
+# metadata parsers (ParserRegistry) used by each worker process of FilepathFileRecordFactory
+_workerMetadataParsers = []
+
+def _initMetadataParsers(parsers, instrumented=False):
+    '''Initializes a worker process with its own copy of the metadata parsers, and of the instrumentation state.'''
 
-    Block size directly depends on the block size of your filesystem to avoid performances issues.
-    Here I have blocks of 4096 octets (Default NTFS).
+    global _workerMetadataParsers
+    _workerMetadataParsers = parsers
+    stats.reset()
+    stats.enable(instrumented)
 
-    Acknowledgment: http://stackoverflow.com/questions/1131220/get-md5-hash-of-big-files-in-python
+    # write the metadata cached by this process when it exits
+    caches = set( parser.cache for parser in parsers.parsers if isinstance(parser, CachingMetadataFileParser) )
+    for cache in caches:
+        Finalize(cache, cache.flush, exitpriority=10)
+
+def _parseFileMetadata(filepath):
+    '''Parses a file in a worker process. Returns the metadata, and the timings observed since the last file (if enabled).'''
+
+    metadata = parseFileMetadata(_workerMetadataParsers, filepath)
+    return (metadata, stats.snapshot(reset=True) if stats.enabled else None)
+
+def md5_for_file(path, block_size=BLOCK_SIZE, hr=False):
+    '''
+    Function to compute the Md5 checksum of a file (see :mod:`esgfpy.publish.checksums` to compute several checksums at once).
+    :param hr: True to return the hexadecimal digest, False for the binary digest
     '''
-    md5 = hashlib.md5()
-    with open(path,'rb') as f:
-        for chunk in iter(lambda: f.read(block_size), b''):
-            md5.update(chunk)
+    md5 = hashFile(path, ['MD5'], block_size)['MD5']
     if hr:
         return md5.hexdigest()
     return md5.digest()
\ No newline at end of file
@@ -0,0 +1,129 @@
+'''
+Module :mod:`esgfpy.publish.failures`
+=====================================
+
+Module containing classes that handle the failures of the requests sent to the publishing service:
+retries of transient errors, and quarantine of the records rejected by the server.
+'''
+
+import urllib2
+import httplib
+import socket
+import random
+import time
+import datetime
+import json
+import re
+import threading
+import logging
+
+class RetryPolicy(object):
+    """
+    Class that retries the requests failing with transient errors
+    (connection errors, or the server being temporarily unavailable),
+    waiting a random ("jittered") and exponentially increasing time between attempts,
+    so that many clients do not all retry at the same time.
+    """
+
+    # HTTP status codes of transient server errors
+    TRANSIENT_STATUS_CODES = [429, 502, 503, 504]
+
+    def __init__(self, maxRetries=5, initialDelay=1.0, maxDelay=60.0):
+        """
+        :param maxRetries: maximum number of retries of each request (0 to disable)
+        :param initialDelay: maximum number of seconds to wait before the first retry
+        :param maxDelay: maximum number of seconds to wait before any retry
+        """
+
+        self.maxRetries = maxRetries
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+
+    def call(self, function, *args, **kwargs):
+        '''Invokes the function, retrying it on transient errors. Returns its result, or raises the last error.'''
+
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.maxRetries or not self.isTransient(e):
+                    raise
+                delay = self.getDelay(attempt, e)
+                logging.warn("Transient error: %s, retrying in %.1f seconds (%s/%s)" % (e, delay, attempt+1, self.maxRetries))
+                time.sleep(delay)
+                attempt += 1
+
+    def isTransient(self, e):
+        '''Returns True if the request that raised this exception may succeed if sent again.'''
+
+        if isinstance(e, urllib2.HTTPError):
+            return e.code in RetryPolicy.TRANSIENT_STATUS_CODES
+        return isinstance(e, (urllib2.URLError, httplib.HTTPException, socket.error))
+
+    def getDelay(self, attempt, e=None):
+        '''Returns the number of seconds to wait before the given retry (starting from 0).'''
+
+        # "full jitter": uniformly distributed up to the exponentially increasing limit
+        delay = random.uniform(0, min(self.maxDelay, self.initialDelay * 2 ** attempt))
+
+        # wait at least as long as requested by the server
+        if isinstance(e, urllib2.HTTPError) and e.hdrs is not None:
+            try:
+                delay = max(delay, min(self.maxDelay, float(e.hdrs.get('Retry-After', 0))))
+            except ValueError:
+                pass
+        return delay
+
+class RejectFile(object):
+    """
+    Class that quarantines the serialized records rejected by the publishing service into a local file,
+    one JSON object per line with the record identifier, the serialized record and the error returned by the server,
+    so that they can be inspected and published again later.
+    """
+
+    # HTTP status codes of the requests rejected because of their records (any other error aborts publishing):
+    # 400 Bad Request (invalid record), 413 Request Entity Too Large (for a single record)
+    REJECTED_STATUS_CODES = [400, 413]
+
+    def __init__(self, filepath):
+        """
+        :param filepath: location of the reject file (records are appended if it exists already)
+        """
+
+        self.filepath = filepath
+        self.numberOfRecords = 0
+
+        # the file may be written by the different threads of a publishing pipeline
+        self._lock = threading.Lock()
+
+    def write(self, url, recordId, doc, error):
+        '''Appends a rejected record to the file.'''
+
+        line = json.dumps({ "time": datetime.datetime.utcnow().isoformat(),
+                            "url": url,
+                            "id": recordId,
+                            "error": error,
+                            "doc": doc })
+        with self._lock:
+            with open(self.filepath, "a") as f:
+                f.write(line + "\n")
+            self.numberOfRecords += 1
+        logging.error("Rejected record id=%s: %s" % (recordId, error))
+
+def getErrorMessage(e):
+    '''Returns the error message of a failed request, including the message returned by Solr if available.'''
+
+    if isinstance(e, urllib2.HTTPError):
+        try:
+            body = e.read()
+        except Exception:
+            body = ""
+        # Solr/JSON error: {"error":{"msg":...}}, Solr/XML error: <str name="msg">...</str>
+        try:
+            message = json.loads(body)["error"]["msg"]
+        except Exception:
+            match = re.search(r'<str name="msg">(.*?)</str>', body, re.DOTALL)
+            message = match.group(1) if match else body[:1000]
+        return "HTTP Error %s: %s: %s" % (e.code, e.msg, message)
+    return str(e)
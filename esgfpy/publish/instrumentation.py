@@ -0,0 +1,218 @@
+'''
+Module :mod:`esgfpy.publish.instrumentation`
+============================================
+
+Module containing the timers and counters of the stages of publishing
+(walking the directory tree, creating the records, running each metadata parser, serializing and posting the records),
+with latency histograms and the slowest files, reported at the end of a run as a summary table,
+a JSON file or a Prometheus textfile.
+
+Instrumentation is disabled by default: all stages use the module-level Instrumentation object 'stats',
+which only records anything after stats.enable() has been invoked. Example:
+
+    from esgfpy.publish.instrumentation import stats
+    stats.enable()
+    publisher.publish(startDirectory)
+    print stats.summary()
+    stats.write("/var/lib/node_exporter/esgfpy_publish.prom")
+'''
+
+import os
+import time
+import json
+import heapq
+import bisect
+import threading
+
+class Instrumentation(object):
+    """
+    Thread-safe collection of timers and counters, keyed by name.
+    Each timer accumulates the number of observations, their total and maximum duration, and a histogram of the durations.
+    The observations made for a given file (or other resource) are also candidates for the list of slowest outliers.
+    """
+
+    # upper bounds (in seconds) of the histogram buckets of all timers (the last bucket is unbounded)
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+
+    def __init__(self, numOutliers=10):
+        """
+        :param numOutliers: number of slowest observations (with a key) that are kept
+        """
+
+        self.enabled = False
+        self.numOutliers = numOutliers
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        '''Discards all observations.'''
+
+        with self._lock:
+            self._timers = {}
+            self._counters = {}
+            self._outliers = []
+
+    def timer(self, name, key=None):
+        """
+        Returns a context manager that times the enclosed block as an observation of the named timer.
+        :param key: optional identifier of the resource being processed (for example, the file path), reported if slow
+        """
+
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, key)
+
+    def observe(self, name, seconds, key=None):
+        '''Records an observation of the named timer.'''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self._timers:
+                self._timers[name] = { 'count': 0, 'seconds': 0.0, 'max': 0.0,
+                                       'buckets': [0] * (len(Instrumentation.BUCKETS) + 1) }
+            timer = self._timers[name]
+            timer['count'] += 1
+            timer['seconds'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['buckets'][bisect.bisect_left(Instrumentation.BUCKETS, seconds)] += 1
+            if key is not None:
+                self._addOutlier( (seconds, name, key) )
+
+    def count(self, name, value=1):
+        '''Increments the named counter.'''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self, reset=False):
+        '''Returns a copy of all observations, as a dictionary of plain values (optionally, discarding them).'''
+
+        with self._lock:
+            snapshot = { 'timers': dict( (name, dict(timer, buckets=list(timer['buckets'])))
+                                         for (name, timer) in self._timers.items() ),
+                         'counters': dict(self._counters),
+                         'outliers': [ {'seconds': seconds, 'name': name, 'key': key}
+                                       for (seconds, name, key) in sorted(self._outliers, reverse=True) ] }
+        if reset:
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        '''Adds the observations of a snapshot (for example, taken in a worker process) to these observations.'''
+
+        with self._lock:
+            for (name, other) in snapshot['timers'].items():
+                if name not in self._timers:
+                    self._timers[name] = { 'count': 0, 'seconds': 0.0, 'max': 0.0, 'buckets': [0] * len(other['buckets']) }
+                timer = self._timers[name]
+                timer['count'] += other['count']
+                timer['seconds'] += other['seconds']
+                timer['max'] = max(timer['max'], other['max'])
+                timer['buckets'] = [a + b for (a, b) in zip(timer['buckets'], other['buckets'])]
+            for (name, value) in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+            for outlier in snapshot['outliers']:
+                self._addOutlier( (outlier['seconds'], outlier['name'], outlier['key']) )
+
+    def summary(self):
+        '''Returns a table of all timers, counters and outliers, as a printable string.'''
+
+        snapshot = self.snapshot()
+        lines = [ "%-40s %10s %12s %12s %12s" % ("timer", "count", "total (s)", "mean (ms)", "max (ms)") ]
+        for (name, timer) in sorted(snapshot['timers'].items()):
+            lines.append( "%-40s %10s %12.3f %12.3f %12.3f" % (name, timer['count'], timer['seconds'],
+                                                              1000 * timer['seconds'] / max(1, timer['count']),
+                                                              1000 * timer['max']) )
+        if len(snapshot['counters']) > 0:
+            lines.append( "%-40s %10s" % ("counter", "value") )
+            for (name, value) in sorted(snapshot['counters'].items()):
+                lines.append( "%-40s %10s" % (name, value) )
+        if len(snapshot['outliers']) > 0:
+            lines.append( "slowest:" )
+            for outlier in snapshot['outliers']:
+                lines.append( "%12.3f s  %-30s %s" % (outlier['seconds'], outlier['name'], outlier['key']) )
+        return "\n".join(lines)
+
+    def write(self, filepath):
+        """
+        Writes all observations to a file: in the Prometheus text exposition format if the file name ends with '.prom'
+        (for the textfile collector of the node exporter), otherwise as JSON.
+        The file is replaced atomically, so that it is never read while partially written.
+        """
+
+        snapshot = self.snapshot()
+        if filepath.endswith(".prom"):
+            content = _toPrometheus(snapshot)
+        else:
+            content = json.dumps(snapshot, indent=2, sort_keys=True)
+
+        tmpfile = "%s.%s.tmp" % (filepath, os.getpid())
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, filepath)
+
+    def _addOutlier(self, outlier):
+        '''Keeps the outlier if it is among the slowest ones (the lock must be held).'''
+
+        if len(self._outliers) < self.numOutliers:
+            heapq.heappush(self._outliers, outlier)
+        elif self.numOutliers > 0:
+            heapq.heappushpop(self._outliers, outlier)
+
+class _Timer(object):
+    '''Context manager that records the duration of a block.'''
+
+    def __init__(self, instrumentation, name, key):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.key = key
+
+    def __enter__(self):
+        self.startTime = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.instrumentation.observe(self.name, time.time() - self.startTime, self.key)
+        return False
+
+class _NoTimer(object):
+    '''Context manager that does nothing, used while the instrumentation is disabled.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+def _toPrometheus(snapshot):
+    '''Formats a snapshot in the Prometheus text exposition format.'''
+
+    lines = [ "# HELP esgfpy_publish_seconds Time spent in each stage of publishing.",
+              "# TYPE esgfpy_publish_seconds histogram" ]
+    for (name, timer) in sorted(snapshot['timers'].items()):
+        cumulative = 0
+        for (bound, count) in zip(Instrumentation.BUCKETS + ["+Inf"], timer['buckets']):
+            cumulative += count
+            lines.append( 'esgfpy_publish_seconds_bucket{stage="%s",le="%s"} %s' % (_label(name), bound, cumulative) )
+        lines.append( 'esgfpy_publish_seconds_sum{stage="%s"} %s' % (_label(name), repr(timer['seconds'])) )
+        lines.append( 'esgfpy_publish_seconds_count{stage="%s"} %s' % (_label(name), timer['count']) )
+
+    lines += [ "# HELP esgfpy_publish_total Number of items processed by each stage of publishing.",
+               "# TYPE esgfpy_publish_total counter" ]
+    for (name, value) in sorted(snapshot['counters'].items()):
+        lines.append( 'esgfpy_publish_total{name="%s"} %s' % (_label(name), value) )
+    return "\n".join(lines) + "\n"
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# instrumentation shared by all stages of publishing (disabled by default)
+stats = Instrumentation()
@@ -0,0 +1,135 @@
+'''
+Module :mod:`esgfpy.publish.manifest`
+=====================================
+
+Module containing a local store of the state of published files, used for incremental publishing.
+'''
+
+import sqlite3
+import hashlib
+import json
+import os
+import threading
+
+from esgfpy.publish.models import XmlRecordSerializer
+
+class FileStateManifest(object):
+    """
+    Class that records, in a local sqlite database keyed by file path, the state of each published file:
+    size, modification time and inode, the metadata fields of its record,
+    and the fingerprint of the record that was last published.
+    A file whose size, modification time and inode are unchanged since it was last published
+    does not need to be parsed and published again.
+    """
+
+    def __init__(self, dbpath):
+        """
+        :param dbpath: location of the sqlite database file (created if not existing)
+        """
+
+        self.dbpath = dbpath
+        # the connection may be used by the different threads of a publishing pipeline, one at a time
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.expanduser(dbpath), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                           "path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime REAL, inode INTEGER, "
+                           "record_id TEXT, dataset_id TEXT, metadata TEXT, fingerprint TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+        self._conn.commit()
+
+        # file states of records generated but not yet published, keyed by record id
+        self._pending = {}
+
+    def isUnchanged(self, path, stat):
+        '''Returns True if the file was published with the same size, modification time and inode.'''
+
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime, inode FROM files WHERE path=?", (path,)).fetchone()
+            return row is not None and row == (stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def getMetadata(self, path):
+        '''Returns the metadata fields of the record last published for the file.'''
+
+        with self._lock:
+            row = self._conn.execute("SELECT metadata FROM files WHERE path=?", (path,)).fetchone()
+            return json.loads(row[0])
+
+    def isPublished(self, path, fingerprint):
+        '''Returns True if a record with the same fingerprint was last published for the file.'''
+
+        with self._lock:
+            row = self._conn.execute("SELECT fingerprint FROM files WHERE path=?", (path,)).fetchone()
+            return row is not None and row[0] == fingerprint
+
+    def stage(self, path, stat, record, fingerprint):
+        '''Holds the state of a file whose record has been generated, until markPublished() is invoked for that record.'''
+
+        with self._lock:
+            self._pending[record.id] = (path, os.path.dirname(path), stat.st_size, stat.st_mtime, stat.st_ino,
+                                        record.id, record.datasetId, json.dumps(dict(record.fields.iteritems()), default=str), fingerprint)
+
+    def discard(self, recordIds):
+        '''Forgets the state of the files whose records have been generated, but will not be published (for example, rejected).'''
+
+        with self._lock:
+            for recordId in recordIds:
+                self._pending.pop(recordId, None)
+
+    def update(self, path, stat):
+        '''Updates the size, modification time and inode of a file whose published record has not changed.'''
+
+        with self._lock:
+            self._conn.execute("UPDATE files SET size=?, mtime=?, inode=? WHERE path=?",
+                               (stat.st_size, stat.st_mtime, stat.st_ino, path))
+            self._conn.commit()
+
+    def markPublished(self, recordIds):
+        '''Stores the state of the files whose records have been published.'''
+
+        with self._lock:
+            rows = [self._pending.pop(recordId) for recordId in recordIds if recordId in self._pending]
+            self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def markUnpublished(self, recordIds):
+        '''Removes the state of the files whose records have been unpublished.'''
+
+        with self._lock:
+            self._conn.executemany("DELETE FROM files WHERE record_id=?", [(recordId,) for recordId in recordIds])
+            self._conn.commit()
+
+    def markUnpublishedDatasets(self, datasetIds):
+        '''Removes the state of all files of the datasets that have been unpublished.'''
+
+        with self._lock:
+            self._conn.executemany("DELETE FROM files WHERE dataset_id=?", [(datasetId,) for datasetId in datasetIds])
+            self._conn.commit()
+
+    def listDirectory(self, directory):
+        '''Returns the list of (path, record id, dataset id) of the files published from a directory.'''
+
+        with self._lock:
+            return self._conn.execute("SELECT path, record_id, dataset_id FROM files WHERE directory=?",
+                                      (directory,)).fetchall()
+
+    def listDirectories(self, startDirectory):
+        '''Returns the list of directories containing published files, under the given directory.'''
+
+        with self._lock:
+            # sub-directories sort between '<startDirectory>/' and '<startDirectory>0' ('0' follows '/')
+            startDirectory = startDirectory.rstrip('/')
+            rows = self._conn.execute("SELECT DISTINCT directory FROM files WHERE directory=? OR (directory>? AND directory<?)",
+                                      (startDirectory, startDirectory + '/', startDirectory + '0')).fetchall()
+            return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def fingerprint(record):
+    '''Returns a digest of the serialized record, used to detect whether it has changed since it was last published.'''
+
+    return hashlib.md5(_serializer.serialize(record)).hexdigest()
+
+# serializer shared by all fingerprints (it only caches the escaped field names)
+_serializer = XmlRecordSerializer()
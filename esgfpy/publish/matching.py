@@ -0,0 +1,116 @@
+'''
+Module :mod:`esgfpy.publish.matching`
+=====================================
+
+Module containing a compiled matcher of file names against a list of regular expressions,
+shared by the file record factory and the metadata parsers, so that each file name is matched only once.
+The patterns are compiled once, and indexed by their literal prefix (for example 'oco2_L2Std' in 'oco2_L2Std.+\.h5'):
+only the patterns whose prefix starts the file name are evaluated.
+'''
+
+import re
+import sre_parse
+import sre_constants
+
+class FilenameMatch(object):
+    '''Result of matching a file name: the pattern that matched, its owner (if any), and the values of its named groups.'''
+
+    __slots__ = ('pattern', 'owner', 'groups')
+
+    def __init__(self, pattern, owner, groups):
+        self.pattern = pattern
+        self.owner = owner
+        self.groups = groups
+
+class FilenameMatcher(object):
+    """
+    Matcher of file names against an ordered list of regular expressions, with re.match() semantics
+    (the pattern must match at the start of the file name). Each pattern may be associated with an owner,
+    for example the metadata parser of the matching files.
+    The results of the most recently matched file names are cached, so that a file name matched by several consumers
+    (the file record factory, then its metadata parsers) is only evaluated once.
+    The cache is a plain dictionary (whose operations are atomic), emptied whenever it is full.
+    """
+
+    def __init__(self, patterns, maxCacheSize=1024):
+        """
+        :param patterns: list of regular expressions (as strings or compiled), or of (regular expression, owner) tuples
+        :param maxCacheSize: maximum number of file names whose results are cached
+        """
+
+        self.patterns = []
+        self.owners = []
+        self.maxCacheSize = maxCacheSize
+
+        # index of the patterns by literal prefix: prefix --> indexes of the patterns, and the distinct prefix lengths
+        self._prefixes = {}
+
+        for (index, pattern) in enumerate(patterns):
+            owner = None
+            if isinstance(pattern, tuple):
+                (pattern, owner) = pattern
+            regex = re.compile(pattern)
+            self.patterns.append(regex)
+            self.owners.append(owner)
+
+            prefix = _literalPrefix(regex)
+            self._prefixes.setdefault(prefix, []).append(index)
+        self._prefixLengths = sorted(set(len(prefix) for prefix in self._prefixes))
+
+        self._cache = {}
+
+    def match(self, filename):
+        '''Returns the FilenameMatch of the first pattern matching the file name, or None.'''
+
+        matches = self.matchAll(filename)
+        return matches[0] if len(matches) > 0 else None
+
+    def matchAll(self, filename):
+        '''Returns the FilenameMatch of all the patterns matching the file name, in the order of the patterns.'''
+
+        matches = self._cache.get(filename)
+        if matches is not None:
+            return matches
+
+        matches = []
+        for index in self._candidates(filename):
+            match = self.patterns[index].match(filename)
+            if match:
+                matches.append( FilenameMatch(self.patterns[index].pattern, self.owners[index], match.groupdict()) )
+
+        if len(self._cache) >= self.maxCacheSize:
+            self._cache = {}
+        self._cache[filename] = matches
+        return matches
+
+    def _candidates(self, filename):
+        '''Returns the sorted indexes of the patterns whose literal prefix starts the file name.'''
+
+        candidates = []
+        for length in self._prefixLengths:
+            if length > len(filename):
+                break
+            candidates += self._prefixes.get(filename[:length], [])
+        candidates.sort()
+        return candidates
+
+    def __getstate__(self):
+        # the cache is not copied to other processes
+        return dict(self.__dict__, _cache={})
+
+def _literalPrefix(regex):
+    '''Returns the literal characters that any string matched by the compiled regular expression must start with.'''
+
+    # case-insensitive (or locale dependent) patterns are not indexed
+    if regex.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE):
+        return ''
+
+    prefix = []
+    for (op, av) in sre_parse.parse(regex.pattern, regex.flags):
+        if op == sre_constants.LITERAL:
+            prefix.append(unichr(av) if av > 255 else chr(av))
+        elif op == sre_constants.AT and av == sre_constants.AT_BEGINNING:
+            continue
+        else:
+            break
+    return ''.join(prefix)
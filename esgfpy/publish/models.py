@@ -9,22 +9,259 @@ Module containing classes representing ESGF searchable metadata records.
 '''
 
 from xml.etree.ElementTree import Element, SubElement
+from xml.sax.saxutils import escape, quoteattr
+from json.encoder import encode_basestring_ascii
 
-from esgfpy.publish.consts import TYPE_DATASET, TYPE_FILE, TYPE_AGGREGATION, SOLR_CORES
+from esgfpy.publish.consts import TYPE_DATASET, TYPE_FILE, TYPE_AGGREGATION, SOLR_CORES, FORMAT_XML, FORMAT_JSON
 from esgfpy.publish.utils import isNull
 
+class RecordFields(object):
+    """
+    Dictionary-like container of the metadata fields of a record, as (name, values) pairs.
+    The fields specific to the record are layered over an optional dictionary of shared fields
+    (for example, the constant fields of a record factory), which is referenced instead of copied:
+    assigning or deleting a field only changes the record's own layer.
+    
+    The own fields are stored compactly: their names (interned) in a _FieldLayout shared by all the records
+    whose fields were assigned in the same order, and their values in a tuple, where a single value is stored as is.
+    The values are returned as tuples (or as a list, while a field is being extended), so that they can be shared
+    between records (see share()); the tuples of strings and numbers are untracked by the cyclic garbage collector.
+    """
+    
+    __slots__ = ('_layout', '_values', '_shared')
+    
+    def __init__(self, fields=None, shared=None):
+        """
+        :param fields: dictionary of the record's own fields as (name, values) pairs (copied)
+        :param shared: dictionary of shared fields as (name, values) pairs (referenced), as returned by freezeFields()
+        """
+        
+        self._shared = shared if shared is not None else _NO_FIELDS
+        if fields:
+            self._layout = _FieldLayout.get(tuple(fields))
+            self._values = tuple([_pack(values) for values in fields.values()])
+        else:
+            self._layout = _EMPTY_LAYOUT
+            self._values = ()
+    
+    def __getitem__(self, name):
+        i = self._layout.index.get(name)
+        if i is None:
+            return self._shared[name]
+        values = self._values[i]
+        if values is _DELETED:
+            raise KeyError(name)
+        return _unpack(values)
+    
+    def __setitem__(self, name, values):
+        self._set(name, _pack(values))
+    
+    def __delitem__(self, name):
+        i = self._layout.index.get(name)
+        if name in self._shared:
+            if i is not None and self._values[i] is _DELETED:
+                raise KeyError(name)
+            self._set(name, _DELETED)
+        elif i is not None:
+            self._layout = _FieldLayout.get(self._layout.names[:i] + self._layout.names[i+1:])
+            self._values = self._values[:i] + self._values[i+1:]
+        else:
+            raise KeyError(name)
+    
+    def __contains__(self, name):
+        i = self._layout.index.get(name)
+        if i is None:
+            return name in self._shared
+        return self._values[i] is not _DELETED
+    
+    def __iter__(self):
+        return (name for name, values in self.iteritems())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+    
+    def iteritems(self):
+        '''Generator of the (name, values) pairs of all fields: the shared fields first, then the record's own fields.'''
+        
+        index = self._layout.index
+        for name, values in self._shared.iteritems():
+            if not name in index:
+                yield (name, values)
+        for name, values in zip(self._layout.names, self._values):
+            if values.__class__ in _SEQUENCES:
+                yield (name, values)
+            elif values is not _DELETED:
+                yield (name, (values,))
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def keys(self):
+        return [name for name, values in self.iteritems()]
+    
+    def values(self):
+        return [values for name, values in self.iteritems()]
+    
+    def update(self, fields):
+        '''Assigns all the given fields, rebuilding the tuple of values only once.'''
+        
+        layout = self._layout
+        values = list(self._values)
+        for name, fieldValues in fields.items():
+            i = layout.index.get(name)
+            if i is None:
+                layout = layout.add(name)
+                values.append(_pack(fieldValues))
+            else:
+                values[i] = _pack(fieldValues)
+        self._layout = layout
+        self._values = tuple(values)
+    
+    def extend(self, name, values):
+        '''Appends values to a field (created if not existing), in constant time per value.'''
+        
+        i = self._layout.index.get(name)
+        if i is not None and self._values[i].__class__ is list:
+            self._values[i].extend(values)
+        else:
+            # a list is kept while the field is being extended
+            self._set(name, list(self.get(name, ())) + list(values))
+    
+    def share(self, name):
+        '''Returns the values of a field as a tuple, that can be assigned to other records without being copied.'''
+        
+        values = self[name]
+        if values.__class__ is list:
+            values = tuple(values)
+            self._set(name, _pack(values))
+        return values
+    
+    def mapValues(self, metadataMapper):
+        '''Maps the values of the record's own fields to controlled vocabulary (the shared fields are mapped by freezeFields()).'''
+        
+        self._values = tuple([ values if values is _DELETED
+                               else _pack([metadataMapper.mappit(name, value) for value in _unpack(values)])
+                               for name, values in zip(self._layout.names, self._values) ])
+    
+    def _set(self, name, packedValues):
+        '''Assigns the packed values of a field in the record's own layer.'''
+        
+        i = self._layout.index.get(name)
+        if i is None:
+            self._layout = self._layout.add(name)
+            self._values = self._values + (packedValues,)
+        else:
+            self._values = self._values[:i] + (packedValues,) + self._values[i+1:]
+    
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+    
+class _FieldLayout(object):
+    """
+    Names of the own fields of records (see RecordFields), and their index, shared by all the records
+    whose fields were assigned in the same order. Each layout caches the layouts obtained by adding a field,
+    so that assigning a field to a record does not create a new layout.
+    """
+    
+    __slots__ = ('names', 'index', '_next')
+    
+    # all layouts, keyed by their field names (at most MAX_LAYOUTS, after which new layouts are not shared)
+    _layouts = {}
+    MAX_LAYOUTS = 10000
+    
+    def __init__(self, names):
+        self.names = tuple([_intern(name) for name in names])
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self._next = {}
+        
+    @classmethod
+    def get(cls, names):
+        '''Returns the layout of the given field names.'''
+        
+        try:
+            return cls._layouts[names]
+        except KeyError:
+            layout = _FieldLayout(names)
+            if len(cls._layouts) < cls.MAX_LAYOUTS:
+                cls._layouts[names] = layout
+            return layout
+        
+    def add(self, name):
+        '''Returns the layout of these field names followed by the given name.'''
+        
+        try:
+            return self._next[name]
+        except KeyError:
+            layout = _FieldLayout.get(self.names + (name,))
+            self._next[name] = layout
+            return layout
+    
+def freezeFields(fields, metadataMapper=None):
+    '''
+    Returns a copy of a dictionary of fields, with interned names and tuple values,
+    to be shared by many records (see RecordFields).
+    
+    :param metadataMapper: optional class to map the metadata values to controlled vocabulary
+    '''
+    
+    frozenFields = {}
+    if fields is not None:
+        for name, values in fields.items():
+            if metadataMapper is not None:
+                values = [metadataMapper.mappit(name, value) for value in values]
+            frozenFields[_intern(name)] = tuple(values)
+    return frozenFields
+
+def _intern(name):
+    '''Interns the field names that are byte strings, so that each name is stored only once.'''
+    
+    if type(name) is str:
+        return intern(name)
+    return name
+
+def _pack(values):
+    '''Returns the values of a field as stored by RecordFields: a single value as is, otherwise a tuple.'''
+    
+    if len(values) == 1 and values[0].__class__ not in _SEQUENCES:
+        return values[0]
+    return tuple(values)
+
+def _unpack(values):
+    '''Returns the values of a field stored by RecordFields as a tuple (or a list, while the field is extended).'''
+    
+    if values.__class__ in _SEQUENCES:
+        return values
+    return (values,)
+
+_SEQUENCES = frozenset([tuple, list])
+
+# marker of the shared fields deleted from a record
+_DELETED = object()
+
+# empty shared layer, and layout of records without own fields
+_NO_FIELDS = {}
+_EMPTY_LAYOUT = _FieldLayout.get(())
+
 class Record(object):
     """
     Class representing a basic ESGF metadata record with the minimum required fields.
     This is the superclass of all Record classes.
     """
     
-    def __init__(self, id, title, type, fields={}):
+    __slots__ = ('id', 'title', 'type', 'fields')
+    
+    def __init__(self, id, title, type, fields=None):
         """
         :param id: globally unique identifier for the record
         :param title: short record title to display in search results
         :param type: valid record type
-        :param fields: dictionary of record metadata fields as (name, values) pairs
+        :param fields: dictionary of record metadata fields as (name, values) pairs, or RecordFields object
         """
         
         # arguments validation
@@ -37,7 +274,7 @@ class Record(object):
         if not type in SOLR_CORES:
             raise Exception("Unknown record type: %s" % type)
         self.type = type
-        self.fields = fields
+        self.fields = fields if isinstance(fields, RecordFields) else RecordFields(fields)
         
         #! TODO: remove these mandatory fields from core schema ?
         if not 'index_node' in self.fields:
@@ -62,12 +299,21 @@ class Record(object):
         Record._add_field(docEl, 'type', self.type)
                 
         # <field name="model">mymodel</field>
-        for name, values in self.fields.items():
+        for name, values in self.fields.iteritems():
             for value in values:
                 Record._add_field(docEl, name, value)
         
+        # <field name="dataset_id">....</field>
+        for name, value in self.referenceFields():
+            Record._add_field(docEl, name, value)
+        
         return docEl
     
+    def referenceFields(self):
+        """Returns the list of (name, value) single-valued fields that reference other records."""
+        
+        return []
+    
     @staticmethod
     def _add_field(docEl, name, value):
         """Method to add a single-valued field to an XML element."""
@@ -78,66 +324,325 @@ class Record(object):
 class DatasetRecord(Record):
     """Class representing an ESGF metadata record of type 'Dataset'."""
     
-    def __init__(self, id, title, fields={}):
+    __slots__ = ('fileIds',)
+    
+    def __init__(self, id, title, fields=None):
         """
         :param id: globally unique identifier for the record
         :param title: short record title to display in search results
-        :param fields: dictionary of record metadata fields as (name, values) pairs
+        :param fields: dictionary of record metadata fields as (name, values) pairs, or RecordFields object
         """
         super(DatasetRecord,self).__init__(id, title, TYPE_DATASET, fields)
         
-        # start with empty files list
-        self.files = []
+        # start with empty list of file identifiers
+        self.fileIds = []
         
 class FileRecord(Record):
     """Class representing an ESGF metadata record of type 'File'."""
     
-    def __init__(self, datasetRecord, id, title, fields={}):
+    __slots__ = ('datasetId',)
+    
+    def __init__(self, datasetRecord, id, title, fields=None):
         """
         :param datasetRecord: the parent Dataset record
         :param id: globally unique identifier for the record
         :param title: short record title to display in search results
-        :param fields: dictionary of record metadata fields as (name, values) pairs
+        :param fields: dictionary of record metadata fields as (name, values) pairs, or RecordFields object
         """
         super(FileRecord,self).__init__(id, title, TYPE_FILE, fields)
         
         # store parent dataset
         self.datasetId = datasetRecord.id
         
-        # update dataset-file relationships
-        self.dataset = datasetRecord
-        datasetRecord.files.append(self)
-        
-    def toXML(self):
-        """Overridden superclass method to serialize File specific metadata."""
-        
-        docEl = super(FileRecord,self).toXML()
+        # update dataset-file relationships (by identifier, without reference cycles)
+        datasetRecord.fileIds.append(id)
         
-        # add "dataset_id" field
-        # <field name="dataset_id">....</field>
-        Record._add_field(docEl, 'dataset_id', self.datasetId)
+    def referenceFields(self):
+        """Overridden superclass method to reference the parent Dataset."""
         
-        return docEl
+        return [('dataset_id', self.datasetId)]
     
 class AggregationRecord(Record):
     """Class representing an ESGF metadata record of type 'Aggregation'."""
     
-    def __init__(self, id, title, fields={}):
+    __slots__ = ('datasetId',)
+    
+    def __init__(self, datasetRecord, id, title, fields=None):
         """
         :param datasetRecord: the parent Dataset record
         :param id: globally unique identifier for the record
         :param title: short record title to display in search results
-        :param fields: dictionary of record metadata fields as (name, values) pairs
+        :param fields: dictionary of record metadata fields as (name, values) pairs, or RecordFields object
         """
-        super(DatasetRecord,self).__init__(id, title, TYPE_AGGREGATION, fields)
+        super(AggregationRecord,self).__init__(id, title, TYPE_AGGREGATION, fields)
         
-    def toXML(self):
-        """Overridden superclass method to serialize Aggregation specific metadata."""
+        # store parent dataset
+        self.datasetId = datasetRecord.id
+        
+    def referenceFields(self):
+        """Overridden superclass method to reference the parent Dataset."""
+        
+        return [('dataset_id', self.datasetId)]
+
+
+class RecordSerializer(object):
+    """
+    API for serializing records into the body of Solr update requests.
+    Unlike Record.toXML(), serializers write each document straight into a string,
+    without building an intermediate element tree.
+    Each record is serialized on its own, so that documents can be grouped into requests of any size,
+    or streamed into a single request by the iterAdd() and iterDelete() generators.
+    """
+    
+    # HTTP content type of the update requests
+    contentType = None
+    
+    def serialize(self, record):
+        '''Returns the serialized document that adds a record.'''
+        raise NotImplementedError("Error: serialize() method must be implemented by subclasses.")
+    
+    def serializeUpdate(self, id, fields, update='set'):
+        '''
+        Returns the serialized document that atomically updates some fields of an existing record.
+        
+        :param id: identifier of the record to update
+        :param fields: list of (name, values) pairs, where None or an empty list removes the field
+        :param update: 'set' to replace the previous values of each field, 'add' to append to them
+        '''
+        raise NotImplementedError("Error: serializeUpdate() method must be implemented by subclasses.")
+    
+    def serializeDelete(self, id):
+        '''Returns the serialized instruction that deletes a record.'''
+        raise NotImplementedError("Error: serializeDelete() method must be implemented by subclasses.")
+    
+    def add(self, docs, commitWithin=-1):
+        '''Returns the body of a request adding (or updating) the serialized documents.'''
+        return ''.join(self.iterAdd(docs, commitWithin=commitWithin))
+    
+    def delete(self, docs):
+        '''Returns the body of a request executing the serialized delete instructions.'''
+        return ''.join(self.iterDelete(docs))
+    
+    def iterAdd(self, docs, commitWithin=-1):
+        '''Generator of the pieces of the body of a request adding the documents, consuming them one at a time.'''
+        raise NotImplementedError("Error: iterAdd() method must be implemented by subclasses.")
+    
+    def iterDelete(self, docs):
+        '''Generator of the pieces of the body of a request executing the delete instructions, consuming them one at a time.'''
+        raise NotImplementedError("Error: iterDelete() method must be implemented by subclasses.")
+    
+    def deleteQuery(self, query):
+        '''Returns the body of a request deleting all records matching a query.'''
+        raise NotImplementedError("Error: deleteQuery() method must be implemented by subclasses.")
+    
+    def commit(self):
+        '''Returns the body of a request committing all changes.'''
+        raise NotImplementedError("Error: commit() method must be implemented by subclasses.")
+    
+class XmlRecordSerializer(RecordSerializer):
+    """Serializer of records into Solr/XML update documents, identical in content to Record.toXML()."""
+    
+    contentType = 'text/xml; charset=UTF-8'
+    
+    def __init__(self):
         
-        docEl = super(FileRecord,self).toXML()
+        # escaped opening tags, keyed by field name (and update operation)
+        self._tags = {}
+    
+    def serialize(self, record):
+        
+        # <doc>
+        parts = ['<doc>']
+        
+        # <field name="id">obs4MIPs.NASA-JPL.AIRS.mon.v1|esg-datanode.jpl.nasa.gov</field>
+        for name, value in [('id', record.id), ('title', record.title), ('type', record.type)]:
+            parts += [self._tag(name), _xmlText(value), '</field>']
+        
+        # <field name="model">mymodel</field>
+        for name, values in record.fields.iteritems():
+            tag = self._tag(name)
+            for value in values:
+                parts += [tag, _xmlText(value), '</field>']
         
-        # add "dataset_id" field
         # <field name="dataset_id">....</field>
-        Record._add_field(docEl, 'dataset_id', self.datasetId)
+        for name, value in record.referenceFields():
+            parts += [self._tag(name), _xmlText(value), '</field>']
+        
+        parts.append('</doc>')
+        return ''.join(parts)
+    
+    def serializeUpdate(self, id, fields, update='set'):
+        
+        parts = ['<doc>', self._tag('id'), _xmlText(id), '</field>']
+        for name, values in fields:
+            # <field name="xlink" update="set">...</field>
+            if values is not None and len(values) > 0:
+                tag = self._tag(name, update)
+                for value in values:
+                    parts += [tag, _xmlText(value), '</field>']
+            # <field name="xlink" update="set" null="true"/>
+            else:
+                parts.append(self._tag(name, update)[:-1] + ' null="true"/>')
+        parts.append('</doc>')
+        return ''.join(parts)
+    
+    def serializeDelete(self, id):
+        
+        # <query>id:...</query>
+        return '<query>%s</query>' % _xmlText("id:%s" % id)
+    
+    def iterAdd(self, docs, commitWithin=-1):
+        
+        if commitWithin > 0:
+            yield '<add commitWithin="%s">' % commitWithin
+        else:
+            yield '<add>'
+        for doc in docs:
+            yield doc
+        yield '</add>'
+    
+    def iterDelete(self, docs):
+        
+        yield '<delete>'
+        for doc in docs:
+            yield doc
+        yield '</delete>'
+    
+    def deleteQuery(self, query):
         
-        return docEl
\ No newline at end of file
+        # <delete><query>...</query></delete>
+        return '<delete><query>%s</query></delete>' % _xmlText(query)
+    
+    def commit(self):
+        
+        return '<commit/>'
+    
+    def _tag(self, name, update=None):
+        '''Returns the opening <field> tag for the given field name, escaped only once per name.'''
+        
+        try:
+            return self._tags[(name, update)]
+        except KeyError:
+            if update is None:
+                tag = '<field name=%s>' % _xmlText(name, quoteattr)
+            else:
+                tag = '<field name=%s update=%s>' % (_xmlText(name, quoteattr), _xmlText(update, quoteattr))
+            self._tags[(name, update)] = tag
+            return tag
+    
+class JsonRecordSerializer(RecordSerializer):
+    """
+    Serializer of records into Solr/JSON update documents.
+    Multi-valued fields are serialized as arrays, and records are deleted by identifier.
+    """
+    
+    contentType = 'application/json'
+    
+    def __init__(self):
+        
+        # escaped field names (including the following ':'), keyed by field name
+        self._keys = {}
+    
+    def serialize(self, record):
+        
+        # {"id":"...","title":"...","type":"Dataset",...
+        parts = [self._key('id'), _jsonText(record.id), ',',
+                 self._key('title'), _jsonText(record.title), ',',
+                 self._key('type'), _jsonText(record.type)]
+        
+        # ..."model":["mymodel"],...
+        for name, values in record.fields.iteritems():
+            if len(values) > 0:
+                parts += [',', self._key(name), '[', ','.join([_jsonText(value) for value in values]), ']']
+        
+        # ..."dataset_id":"..."}
+        for name, value in record.referenceFields():
+            parts += [',', self._key(name), _jsonText(value)]
+        
+        return '{%s}' % ''.join(parts)
+    
+    def serializeUpdate(self, id, fields, update='set'):
+        
+        # {"id":"...","xlink":{"set":["..."]},"rcm_name":{"set":null}}
+        parts = [self._key('id'), _jsonText(id)]
+        operation = self._key(update)
+        for name, values in fields:
+            if values is not None and len(values) > 0:
+                parts += [',', self._key(name), '{', operation, '[', ','.join([_jsonText(value) for value in values]), ']}']
+            else:
+                parts += [',', self._key(name), '{', operation, 'null}']
+        return '{%s}' % ''.join(parts)
+    
+    def serializeDelete(self, id):
+        
+        return _jsonText(id)
+    
+    def iterAdd(self, docs, commitWithin=-1):
+        
+        # the object syntax allows the "add" key to be repeated
+        if commitWithin > 0:
+            (start, item, end) = ('{', '"add":{"commitWithin":%s,"doc":%%s}' % commitWithin, '}')
+        else:
+            (start, item, end) = ('[', '%s', ']')
+        yield start
+        separator = ''
+        for doc in docs:
+            yield separator + item % doc
+            separator = ','
+        yield end
+    
+    def iterDelete(self, docs):
+        
+        yield '{"delete":['
+        separator = ''
+        for doc in docs:
+            yield separator + doc
+            separator = ','
+        yield ']}'
+    
+    def deleteQuery(self, query):
+        
+        return '{"delete":{"query":%s}}' % _jsonText(query)
+    
+    def commit(self):
+        
+        return '{"commit":{}}'
+    
+    def _key(self, name):
+        '''Returns the JSON key for the given field name, escaped only once per name.'''
+        
+        try:
+            return self._keys[name]
+        except KeyError:
+            key = _jsonText(name) + ':'
+            self._keys[name] = key
+            return key
+    
+# dictionary that maps each wire format to the class serializing records in that format
+SERIALIZERS = { FORMAT_XML: XmlRecordSerializer,
+                FORMAT_JSON: JsonRecordSerializer }
+
+def getSerializer(format):
+    '''Returns a new RecordSerializer for the given wire format.'''
+    
+    if not format in SERIALIZERS:
+        raise Exception("Unknown serialization format: %s" % format)
+    return SERIALIZERS[format]()
+
+def _xmlText(value, escape=escape):
+    '''Returns the value converted to string (as in Record.toXML()), XML-escaped and UTF-8 encoded.'''
+    
+    if isinstance(value, unicode):
+        return escape(value).encode('UTF-8')
+    elif isinstance(value, str):
+        return escape(value)
+    else:
+        return escape(str(value))
+    
+def _jsonText(value):
+    '''Returns the value converted to string (as in Record.toXML()) as a JSON string literal.'''
+    
+    if isinstance(value, basestring):
+        return encode_basestring_ascii(value)
+    else:
+        return encode_basestring_ascii(str(value))
@@ -13,3 +13,5 @@ from acos_parser import AcosFileParser, AcosLiteFileParser_v34r02, AcosLiteFileP
 from oco2_parser import Oco2L2StdFileParser, Oco2LtCO2FileParser, Oco2LtSIFFileParser, Xco2FileParser
 from tes_parser import TesFileParser, TesFileParserLite
 from airs_parser import AirsFileParser
+from registry import ParserRegistry
+from caching_parser import MetadataCache, CachingMetadataFileParser
@@ -1,9 +1,25 @@
 import abc
 
 class AbstractMetadataFileParser(object):
-    """API for parsing metadata from files and directories."""
+    """
+    API for parsing metadata from files and directories.
+    Implementations must be reentrant: parseMetadata() must not store any per-file state on the parser instance,
+    since the same parser is used for many files, and may be copied to several worker processes.
+    """
     
     __metaclass__ = abc.ABCMeta
+    
+    # files parsed by this class, as regular expressions matched against the file name and/or file extensions
+    # (see ParserRegistry): the parsers that declare neither are invoked for all files
+    FILENAME_PATTERNS = None
+    EXTENSIONS = None
+    
+    # version of the metadata extracted by this class, to be incremented whenever it changes
+    # (so that the metadata cached by earlier versions is ignored, see CachingMetadataFileParser)
+    VERSION = 1
+    
+    # True if the metadata depends only on the file path and content, so that it may be cached by file
+    CACHEABLE = False
         
     @abc.abstractmethod
     def parseMetadata(self, filepath):
@@ -3,13 +3,9 @@ HDF parser specific to ACOS files.
 
 @author: Luca Cinquini
 '''
-import datetime as dt
 from esgfpy.publish.parsers import HdfMetadataFileParser
-#from esgfpy.publish.consts import TAI93_DATETIME_START
-import os
-import re
-from dateutil.tz import tzutc
-import numpy as np
+from esgfpy.publish.parsers.extents import getExtent
+from esgfpy.publish.parsers.times import decodeIsoStrings, decodeTimeArrays, decodeUnixSeconds
 
 FILENAME_PATTERN_V33 = "acos_L2s_(?P<yymmdd>\d+)_\d\d_Production_.+\.h5"
 FILENAME_PATTERN_V34 = "acos_L2s_(?P<yymmdd>\d+)_\d\d_Evaluation_.+\.h5"
@@ -24,129 +20,89 @@ FILENAME_PATTERN_V9_LITE = "acos_LtCO2_(?P<yyyymmdd>\d+)_.+.nc4"
 class AcosFileParser(HdfMetadataFileParser):
     '''Works for: ACOSv3.3, ACOSv3.4_r01, ACOSv3.4_r02.'''
     
-    def matches(self, filepath):
-        '''Example filename: acos_L2s_100129_16_Evaluation_v150151_L2s30400_r01_PolB_130904152222c.h5'''
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN_V33, filename) or re.match(
-            FILENAME_PATTERN_V34, filename) or re.match(
-                FILENAME_PATTERN_V9, filename)
+    # example filename: acos_L2s_100129_16_Evaluation_v150151_L2s30400_r01_PolB_130904152222c.h5
+    FILENAME_PATTERNS = [FILENAME_PATTERN_V33, FILENAME_PATTERN_V34, FILENAME_PATTERN_V9]
     
     def getLatitudes(self, h5file):
-        return h5file['SoundingGeometry']['sounding_latitude'][:]
+        return h5file['SoundingGeometry']['sounding_latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['SoundingGeometry']['sounding_longitude'][:]
+        return h5file['SoundingGeometry']['sounding_longitude']
     
     def getTimes(self, h5file):
         
         # use TAI93 time
-        #seconds = h5file['RetrievalHeader']['sounding_time_tai93'][:]
-        #times = np.empty( len(seconds), dtype=dt.datetime)
-        #for i, secs in enumerate(seconds):
-        #    times[i] = TAI93_DATETIME_START + dt.timedelta(seconds=int(secs))
-        #return times
+        #return getExtent(h5file['RetrievalHeader']['sounding_time_tai93'], decode=decodeTai93)
         
-        # use UTC time
-        dateStrings = h5file['RetrievalHeader']['sounding_time_string'][:]
-        datasetTimes = []
-        for x in dateStrings:
-            try:
-                datasetTimes.append( dt.datetime.strptime(x[:19],"%Y-%m-%dT%H:%M:%S").replace(tzinfo=tzutc()) )
-            except:
-                pass  # bad date
-        return datasetTimes
+        # use UTC time (bad dates are ignored)
+        return getExtent(h5file['RetrievalHeader']['sounding_time_string'], decode=decodeIsoStrings)
 
 
 class AcosLiteFileParser_v34r02(HdfMetadataFileParser):
     
-    def matches(self, filepath):
-        '''Example filename: acos_b34_L2lite_20090601_r02c.nc'''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_LITE_PATTERN_V34R02, filename)
+    # example filename: acos_b34_L2lite_20090601_r02c.nc
+    FILENAME_PATTERNS = [FILENAME_LITE_PATTERN_V34R02]
     
     def getLatitudes(self, h5file):
-        return h5file['Sounding']['latitude'][:]
+        return h5file['Sounding']['latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['Sounding']['longitude'][:]
+        return h5file['Sounding']['longitude']
     
     def getTimes(self, h5file):
                 
         # string time:comment = "Array of seven integers containing the observation time: 
         # year, month (1-12), day (1-31), hour (0-23), minute (0-59), second (0-59), millisecond(0-999)"
         # example: [2009    6    1    0   25   47    4]
-        datasetTimes = []
-        times = h5file['Sounding']['time'][:]
-        for time in times:
-            datasetTimes.append( dt.datetime(time[0], time[1], time[2], time[3], time[4], time[5], time[6]) )
-        return np.asarray( datasetTimes )
+        return getExtent(h5file['Sounding']['time'], decode=decodeTimeArrays)
 
 class AcosLiteFileParser_v34r03(HdfMetadataFileParser):
     
-    def matches(self, filepath):
-        '''Example filename: acos_b34_L2lite_20090601_r03n.nc'''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_LITE_PATTERN_V34R03, filename)
+    # example filename: acos_b34_L2lite_20090601_r03n.nc
+    FILENAME_PATTERNS = [FILENAME_LITE_PATTERN_V34R03]
     
     def getLatitudes(self, h5file):
-        return h5file['latitude'][:]
+        return h5file['latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['longitude'][:]
+        return h5file['longitude']
     
     def getTimes(self, h5file):
-                
-        datasetTimes = []
-        times = h5file['time'][:]
-        for time in times:
-            datasetTimes.append( dt.datetime.utcfromtimestamp(time) )
-        return np.asarray( datasetTimes )
+        
+        # use Unix time
+        return getExtent(h5file['time'], decode=decodeUnixSeconds)
     
 class AcosLiteFileParser_v35r02(HdfMetadataFileParser):
     
-    def matches(self, filepath):
-        '''Example filename: acos_b35_L2lite_20140607_r02.nc'''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_LITE_PATTERN_V35R02, filename)
+    # example filename: acos_b35_L2lite_20140607_r02.nc
+    FILENAME_PATTERNS = [FILENAME_LITE_PATTERN_V35R02]
     
     def getLatitudes(self, h5file):
-        return h5file['latitude'][:]
+        return h5file['latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['longitude'][:]
+        return h5file['longitude']
     
     def getTimes(self, h5file):
-                
-        datasetTimes = []
-        times = h5file['time'][:]
-        for time in times:
-            datasetTimes.append( dt.datetime.utcfromtimestamp(time) )
-        return np.asarray( datasetTimes )
+        
+        # use Unix time
+        return getExtent(h5file['time'], decode=decodeUnixSeconds)
     
 class AcosLiteFileParser_v9(HdfMetadataFileParser):
     
-    def matches(self, filepath):
-        '''Example filename: acos_LtCO2_180120_v205205_B9213A_200311112033s.nc4'''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN_V9_LITE, filename)
+    # example filename: acos_LtCO2_180120_v205205_B9213A_200311112033s.nc4
+    FILENAME_PATTERNS = [FILENAME_PATTERN_V9_LITE]
     
     def getLatitudes(self, h5file):
-        return h5file['latitude'][:]
+        return h5file['latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['longitude'][:]
+        return h5file['longitude']
     
     def getTimes(self, h5file):
-                
-        datasetTimes = []
-        times = h5file['time'][:]
-        for time in times:
-            datasetTimes.append( dt.datetime.utcfromtimestamp(time) )
-        return np.asarray( datasetTimes )
+        
+        # use Unix time
+        return getExtent(h5file['time'], decode=decodeUnixSeconds)
 
 if __name__ == '__main__':
     
@@ -6,9 +6,9 @@ HDF parser specific to AIRS files.
 
 from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
 from esgfpy.publish.parsers.hdf_parser import storeMetadata
+from esgfpy.publish.matching import FilenameMatcher
 
 import os
-import re
 import logging
 import datetime as dt
 from dateutil.tz import tzutc
@@ -23,16 +23,20 @@ except ImportError:
     pass
 
 FILENAME_PATTERN = "AIRS\.(?P<yyyy>\d+)\.(?P<mm>\d+)\.(?P<dd>\d+)\..+\.hdf"
+FILENAME_MATCHER = FilenameMatcher([FILENAME_PATTERN])
 INVALID_VALUE = -9999.
 
 class AirsFileParser(AbstractMetadataFileParser):
 
+    FILENAME_PATTERNS = [FILENAME_PATTERN]
+    CACHEABLE = True
+
     def parseMetadata(self, filepath):
 
         metadata = {}
     
         dir, filename = os.path.split(filepath)
-        if re.match(FILENAME_PATTERN, filename):
+        if FILENAME_MATCHER.match(filename):
             logging.info("Parsing HDF file=%s" % filepath)
 
             # open HDF file
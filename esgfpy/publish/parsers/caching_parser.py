@@ -0,0 +1,218 @@
+'''
+Module :mod:`esgfpy.publish.parsers.caching_parser`
+===================================================
+
+Module containing a persistent cache of the metadata extracted from the data files, and a metadata parser that
+wraps another parser with this cache: as long as a file keeps the same size and modification time, its metadata is
+read from the cache, and the file is not opened again (for example, when republishing a collection,
+or re-running a publishing driver after a crash). Example:
+
+    cache = MetadataCache("~/.esgfpy/metadata_cache.db")
+    fileRecordFactory.metadataParsers = [ CachingMetadataFileParser(Oco2L2StdFileParser(), cache),
+                                          XMLMetadataFileParser() ]
+
+Only the parsers whose metadata depends on the content of the file alone may be cached
+(not, for example, the XMLMetadataFileParser, whose metadata is read from other files).
+'''
+
+import os
+import time
+import sqlite3
+import cPickle
+import threading
+
+from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
+from esgfpy.publish.instrumentation import stats
+
+class MetadataCache(object):
+    """
+    Local sqlite database of the metadata extracted by each parser from each file, keyed by (file path, parser name),
+    and valid for the size and modification time of the file, and the version of the parser, it was extracted with.
+    The metadata is stored pickled, so that it is returned with the same types as extracted.
+    The size of the stored metadata is bounded: the least recently used entries are evicted when it is exceeded.
+    The cache may be shared by the worker processes of a FilepathFileRecordFactory (each process opens its own connection).
+    The stored entries are written in batches, so flush() (or close()) must be invoked before the process exits.
+    """
+
+    # number of insertions between two checks of the size of the cache
+    EVICTION_INTERVAL = 256
+
+    # number of cache hits whose time of use is held in memory before being written
+    TOUCH_INTERVAL = 256
+
+    # number of stored entries held in memory before being written in a single transaction
+    INSERT_INTERVAL = 64
+
+    def __init__(self, dbpath, maxBytes=512 * 1024 * 1024):
+        """
+        :param dbpath: location of the sqlite database file (created if not existing)
+        :param maxBytes: maximum size of the stored metadata (beyond which the least recently used entries are evicted)
+        """
+
+        self.dbpath = dbpath
+        self.maxBytes = maxBytes
+
+        # number of lookups that found valid metadata, and that did not (in this process)
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self._touched = {} # (path, parser) --> time of use, not yet written
+        self._inserted = {} # (path, parser) --> row of the stored metadata, not yet written
+        self._numInserts = 0
+        self._getConnection()
+
+    def get(self, path, parser, version, stat):
+        '''Returns the metadata extracted from the file by the named parser, or None if missing or no longer valid.'''
+
+        with self._lock:
+            row = self._inserted.get( (path, parser) )
+            if row is not None:
+                row = row[2:6]
+            else:
+                row = self._getConnection().execute("SELECT version, size, mtime, metadata FROM metadata WHERE path=? AND parser=?",
+                                                    (path, parser)).fetchone()
+            if row is None or row[0:3] != (str(version), stat.st_size, stat.st_mtime):
+                self.misses += 1
+                stats.count('metadata_cache.misses')
+                return None
+
+            self.hits += 1
+            stats.count('metadata_cache.hits')
+            self._touched[(path, parser)] = time.time()
+            if len(self._touched) >= MetadataCache.TOUCH_INTERVAL:
+                self.flush()
+            return cPickle.loads(str(row[3]))
+
+    def put(self, path, parser, version, stat, metadata):
+        '''Stores the metadata extracted from the file by the named parser (written every INSERT_INTERVAL entries, or by flush()).'''
+
+        data = cPickle.dumps(metadata, cPickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._getConnection()
+            self._inserted[(path, parser)] = (path, parser, str(version), stat.st_size, stat.st_mtime,
+                                              sqlite3.Binary(data), len(data), time.time())
+            if len(self._inserted) >= MetadataCache.INSERT_INTERVAL:
+                self.flush()
+
+    def flush(self):
+        '''Writes the entries recently stored, and the time of use of the entries recently returned, in a single transaction.'''
+
+        with self._lock:
+            if len(self._inserted) == 0 and len(self._touched) == 0:
+                return
+
+            conn = self._getConnection()
+            conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._inserted.values())
+            conn.executemany("UPDATE metadata SET last_used=? WHERE path=? AND parser=?",
+                             [(lastUsed, path, parser) for ((path, parser), lastUsed) in self._touched.items()])
+            conn.commit()
+
+            numInserts = self._numInserts + len(self._inserted)
+            evict = numInserts // MetadataCache.EVICTION_INTERVAL > self._numInserts // MetadataCache.EVICTION_INTERVAL
+            self._numInserts = numInserts
+            self._inserted = {}
+            self._touched = {}
+            if evict:
+                self._evict()
+
+    def clear(self):
+        '''Removes all entries.'''
+
+        with self._lock:
+            conn = self._getConnection()
+            conn.execute("DELETE FROM metadata")
+            conn.commit()
+            self._touched = {}
+            self._inserted = {}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self.flush()
+                self._evict()
+                self._conn.close()
+            self._conn = None
+
+    def _evict(self):
+        '''Removes the least recently used entries, until the stored metadata is within 90% of its maximum size.'''
+
+        conn = self._getConnection()
+        excess = (conn.execute("SELECT SUM(bytes) FROM metadata").fetchone()[0] or 0) - self.maxBytes
+        if excess <= 0:
+            return
+
+        excess += self.maxBytes // 10
+        rowids = []
+        for (rowid, numBytes) in conn.execute("SELECT rowid, bytes FROM metadata ORDER BY last_used"):
+            rowids.append( (rowid,) )
+            excess -= numBytes
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM metadata WHERE rowid=?", rowids)
+        conn.commit()
+        stats.count('metadata_cache.evictions', len(rowids))
+
+    def _getConnection(self):
+        '''Returns the connection to the database of this process, opened on demand (the lock must be held).'''
+
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(os.path.expanduser(self.dbpath), timeout=60, check_same_thread=False)
+            self._pid = os.getpid()
+            self._touched = {}
+            self._inserted = {}
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS metadata ("
+                               "path TEXT, parser TEXT, version TEXT, size INTEGER, mtime REAL, "
+                               "metadata BLOB, bytes INTEGER, last_used REAL, PRIMARY KEY (path, parser))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)")
+            self._conn.commit()
+        return self._conn
+
+    def __getstate__(self):
+        # the connection is not copied to other processes
+        state = dict(self.__dict__, _conn=None, _pid=None, _touched={}, _inserted={})
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+class CachingMetadataFileParser(AbstractMetadataFileParser):
+    """
+    Metadata parser that returns the metadata extracted by another parser from a file, from a MetadataCache
+    if the file has not changed (and the parser has the same VERSION), otherwise parses the file and stores its metadata.
+    The wrapper claims the same files as the wrapped parser (see ParserRegistry).
+    """
+
+    def __init__(self, parser, cache, name=None):
+        """
+        :param parser: wrapped AbstractMetadataFileParser
+        :param cache: MetadataCache
+        :param name: name of the parser in the cache (by default, its class name): must be different
+                     for parsers of the same class configured differently
+        """
+
+        self.parser = parser
+        self.cache = cache
+        self.name = name or "%s.%s" % (parser.__class__.__module__, parser.__class__.__name__)
+        self.FILENAME_PATTERNS = getattr(parser, 'FILENAME_PATTERNS', None)
+        self.EXTENSIONS = getattr(parser, 'EXTENSIONS', None)
+
+    def parseMetadata(self, filepath):
+
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return self.parser.parseMetadata(filepath) # let the parser handle missing files
+
+        version = getattr(self.parser, 'VERSION', None)
+        metadata = self.cache.get(filepath, self.name, version, stat)
+        if metadata is None:
+            with stats.timer('parse.%s' % self.parser.__class__.__name__, filepath):
+                metadata = self.parser.parseMetadata(filepath)
+            self.cache.put(filepath, self.name, version, stat, metadata)
+        return metadata
@@ -1,5 +1,6 @@
 from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
 from collections import OrderedDict
+from esgfpy.publish.templates import DirectoryTemplates
 import re
 import os
 import logging
@@ -10,6 +11,7 @@ class DirectoryMetadataParser(AbstractMetadataFileParser):
     def __init__(self, rootDirectory, subDirs):
         self.rootDirectory = rootDirectory
         self.subDirs = subDirs
+        self.templates = DirectoryTemplates(subDirs)
                 
     def parseMetadata(self, filepath):
         logging.debug('DirectoryMetadataParser: parsing directory=%s' % filepath)
@@ -21,7 +23,7 @@ class DirectoryMetadataParser(AbstractMetadataFileParser):
         if directory.startswith("/"):
             directory = directory[1:]
         parts = directory.split(os.sep)
-        for subDirs in self.subDirs:
+        for subDirs in self.templates.matching(parts):
             if len(parts) == len(subDirs):      
                 print 'Parsing directory: %s'  % directory  
                 # loop over sub-directories bottom-to-top
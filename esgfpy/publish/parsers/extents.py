@@ -0,0 +1,179 @@
+'''
+Module :mod:`esgfpy.publish.parsers.extents`
+============================================
+
+Module containing the computation of the extents (minimum and maximum of the valid values) of the latitude,
+longitude and time arrays of the data files, block by block: HDF5 datasets are read in blocks aligned to their
+chunk layout, with read_direct() into buffers that are reused across datasets and files, so that the memory
+used to parse a file is bounded by the block size, whatever the size of the file.
+Each value is read once, and the values outside of the valid range (or NaN) are excluded without filtered copies
+of the whole array.
+'''
+
+import threading
+import numpy as np
+
+# default maximum size (in bytes) of the blocks read at once (a block holds at least one HDF5 chunk)
+BLOCK_BYTES = 4 * 1024 * 1024
+
+# kinds of the numpy data types that are read with read_direct() into the reusable buffers
+_NUMERIC_KINDS = 'biuf'
+
+class Extent(object):
+    """
+    Minimum and maximum of the values of one or more arrays, accumulated block by block.
+    The values lower than 'lower', or greater than 'upper', and NaN values, are excluded.
+    """
+
+    def __init__(self, lower=None, upper=None):
+        self.lower = lower
+        self.upper = upper
+        self.min = None
+        self.max = None
+        self.count = 0 # number of valid values
+
+    def isEmpty(self):
+        return self.count == 0
+
+    def update(self, values):
+        '''Accumulates the valid values of an array (or sequence) into this extent.'''
+
+        values = np.asarray(values)
+        if values.size == 0:
+            return
+
+        if values.dtype.kind in _NUMERIC_KINDS:
+            mask = _validMask(values, self.lower, self.upper)
+            if mask is not None:
+                values = values[mask]
+                if values.size == 0:
+                    return
+
+        vmin = values.min()
+        vmax = values.max()
+        if self.min is None or vmin < self.min:
+            self.min = vmin
+        if self.max is None or vmax > self.max:
+            self.max = vmax
+        self.count += values.size
+
+    def merge(self, other):
+        '''Accumulates the values of another extent into this extent.'''
+
+        if other.isEmpty():
+            return
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+
+def getExtent(data, lower=None, upper=None, decode=None, blockBytes=BLOCK_BYTES):
+    """
+    Returns the Extent of the valid values of an HDF5 dataset, numpy array or sequence,
+    reading it block by block (an Extent is returned as is).
+    :param decode: optional function applied to each block, returning the values to accumulate
+                   (for example, a time decoder of :mod:`esgfpy.publish.parsers.times`)
+    """
+
+    if isinstance(data, Extent):
+        return data
+    extent = Extent(lower, upper)
+    reduceExtent(data, extent, decode=decode, blockBytes=blockBytes)
+    return extent
+
+def reduceExtent(data, extent, decode=None, blockBytes=BLOCK_BYTES):
+    '''Accumulates the values of an HDF5 dataset, numpy array or sequence into the extent, block by block.'''
+
+    if isinstance(data, Extent):
+        extent.merge(data)
+        return extent
+
+    if hasattr(data, 'read_direct'):
+        blocks = _readBlocks(data, blockBytes)
+    else:
+        data = np.asarray(data)
+        if data.ndim == 0:
+            blocks = [data]
+        else:
+            rows = _blockRows(data.shape, data.dtype.itemsize, None, blockBytes)
+            blocks = ( data[start:start + rows] for start in xrange(0, data.shape[0], rows) ) # views, not copies
+
+    for block in blocks:
+        extent.update(decode(block) if decode is not None else block)
+    return extent
+
+def _readBlocks(dataset, blockBytes):
+    '''Generator that reads an HDF5 dataset in blocks of rows aligned to its chunks (each block is only valid until the next one).'''
+
+    shape = dataset.shape
+    if shape is None or len(shape) == 0:
+        yield dataset[()]
+        return
+    if shape[0] == 0:
+        return
+
+    dtype = dataset.dtype
+    chunkRows = dataset.chunks[0] if dataset.chunks is not None else None
+    rows = _blockRows(shape, dtype.itemsize, chunkRows, blockBytes)
+
+    # strings and other non numeric types are sliced (still block by block)
+    if dtype.kind not in _NUMERIC_KINDS:
+        for start in xrange(0, shape[0], rows):
+            yield dataset[start:start + rows]
+        return
+
+    buffer = _buffers.get('values', (rows,) + shape[1:], dtype)
+    for start in xrange(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+        dataset.read_direct(buffer, source_sel=np.s_[start:stop], dest_sel=np.s_[0:stop - start])
+        yield buffer[0:stop - start]
+
+def _blockRows(shape, itemsize, chunkRows, blockBytes):
+    '''Returns the number of rows (along the first axis) of each block: a multiple of the chunk rows, if any.'''
+
+    rowBytes = itemsize * int(np.prod(shape[1:], dtype=np.int64)) if len(shape) > 1 else itemsize
+    rows = max(1, blockBytes // max(1, rowBytes))
+    if chunkRows:
+        rows = max(chunkRows, rows - rows % chunkRows)
+    return rows
+
+def _validMask(values, lower, upper):
+    '''Returns the mask of the values within [lower, upper] and not NaN (in a reused buffer), or None if all are valid.'''
+
+    isFloat = values.dtype.kind == 'f'
+    if lower is None and upper is None and not isFloat:
+        return None
+
+    mask = _buffers.get('mask', values.shape, np.bool_)
+    with np.errstate(invalid='ignore'):
+        if lower is not None:
+            np.greater_equal(values, lower, out=mask)
+            if upper is not None:
+                other = _buffers.get('other', values.shape, np.bool_)
+                np.less_equal(values, upper, out=other)
+                np.logical_and(mask, other, out=mask)
+        elif upper is not None:
+            np.less_equal(values, upper, out=mask)
+        else:
+            np.equal(values, values, out=mask) # excludes NaN
+    return mask
+
+class _BlockBuffers(threading.local):
+    '''Buffers reused by all the reads of the current thread, grown to the largest block read.'''
+
+    def __init__(self):
+        self._raw = {}
+
+    def get(self, name, shape, dtype):
+        '''Returns a C-contiguous array with the given shape and type, over the named buffer.'''
+
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        raw = self._raw.get(name)
+        if raw is None or raw.size < size:
+            raw = np.empty(max(size, 1), dtype=np.uint8)
+            self._raw[name] = raw
+        return raw[0:size].view(dtype).reshape(shape)
+
+_buffers = _BlockBuffers()
@@ -1,5 +1,5 @@
 from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
-import re
+from esgfpy.publish.matching import FilenameMatcher
 import os
 import logging
 
@@ -7,7 +7,15 @@ class FilenameMetadataParser(AbstractMetadataFileParser):
     '''Parses a filename into metadata fields.'''
     
     def __init__(self, filenamePatterns):
-        self.filenamePatterns = filenamePatterns
+        '''
+        :param filenamePatterns: list of filename patterns (with named groups),
+                                 or FilenameMatcher shared with the file record factory (so that each file is matched once)
+        '''
+        if isinstance(filenamePatterns, FilenameMatcher):
+            self.matcher = filenamePatterns
+        else:
+            self.matcher = FilenameMatcher(filenamePatterns)
+        self.filenamePatterns = [regex.pattern for regex in self.matcher.patterns]
                 
     def parseMetadata(self, filepath):
         logging.debug('FilenameMetadataParser: parsing filename=%s' % filepath)
@@ -17,16 +25,13 @@ class FilenameMetadataParser(AbstractMetadataFileParser):
         # obtain filename from filepath
         dir, filename = os.path.split(filepath)
         
-        match = False
-        for pattern in self.filenamePatterns:
-            match = re.match(pattern, filename)
-            if match:
-                #print '\tFilename: %s matches template: %s' % (filename, pattern)
-                for key in match.groupdict().keys():
-                    #print 'File Metadata: key=%s value=%s' % (key,  match.group(key))
-                    metadata[key] = [ match.group(key) ]
-                break # no more matching
-        if not match:
+        match = self.matcher.match(filename)
+        if match:
+            #print '\tFilename: %s matches template: %s' % (filename, match.pattern)
+            for key, value in match.groups.items():
+                #print 'File Metadata: key=%s value=%s' % (key, value)
+                metadata[key] = [ value ]
+        else:
             logging.warn('\tNo matching pattern found for filename: %s' % filename)
             
         return metadata
\ No newline at end of file
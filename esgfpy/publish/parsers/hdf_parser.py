@@ -3,6 +3,9 @@ Parses metadata from HDF files.
 '''
 
 from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
+from esgfpy.publish.parsers.extents import getExtent
+from esgfpy.publish.parsers.times import toDatetime
+from esgfpy.publish.matching import FilenameMatcher
 from esgfpy.publish.consts import (DATETIME_START, DATETIME_STOP, GEO,
                                    NORTH_DEGREES, SOUTH_DEGREES, EAST_DEGREES, WEST_DEGREES,
                                    VARIABLE)
@@ -10,9 +13,9 @@ try:
     import h5py
 except ImportError:
     pass
-import numpy as np
 import logging
 import abc
+import os
 
 INVALID_VALUE = -9999.
 
@@ -20,6 +23,12 @@ class HdfMetadataFileParser(AbstractMetadataFileParser):
     '''Currently fake implementation: all metadata is hard-wired'''
     
     __metaclass__ = abc.ABCMeta
+    
+    # regular expressions of the names of the files parsed by this class (compiled once per class):
+    # None for the subclasses that only override matches(), which are then passed all files
+    FILENAME_PATTERNS = None
+    
+    CACHEABLE = True
         
     def parseMetadata(self, filepath):
         
@@ -31,44 +40,54 @@ class HdfMetadataFileParser(AbstractMetadataFileParser):
             
             # open HDF file
             h5file = h5py.File(filepath,'r')
+            try:
             
-            # extract data from file
-            lats = self.getLatitudes(h5file)
-            lons = self.getLongitudes(h5file)
-            datetimes = self.getTimes(h5file)
-            variables = self.getVariables(h5file)
-            extras = self.getExtras(h5file)
-            
-            # store metadata
-            storeMetadata(metadata, lons, lats, datetimes, variables,
-                          extras=extras)
+                # extract data from file
+                # (the latitudes and longitudes may be HDF5 datasets, read block by block while the file is open)
+                lats = self.getLatitudes(h5file)
+                lons = self.getLongitudes(h5file)
+                datetimes = self.getTimes(h5file)
+                variables = self.getVariables(h5file)
+                extras = self.getExtras(h5file)
+                
+                # store metadata
+                storeMetadata(metadata, lons, lats, datetimes, variables,
+                              extras=extras)
             
-            # close HDF file
-            h5file.close()
+            finally:
+                # close HDF file
+                h5file.close()
 
         return metadata        
     
-    @abc.abstractmethod
     def matches(self, filepath):
         '''
         Returns true if the file matches a regular expression,
         and therefore needs to be parsed.
         '''
-        pass
+        return self.getFilenameMatcher().match(os.path.basename(filepath)) is not None
+    
+    @classmethod
+    def getFilenameMatcher(cls):
+        '''Returns the compiled FILENAME_PATTERNS of this class.'''
+        
+        if cls.__dict__.get('_filenameMatcher') is None:
+            cls._filenameMatcher = FilenameMatcher(cls.FILENAME_PATTERNS or [])
+        return cls._filenameMatcher
         
     @abc.abstractmethod
     def getLatitudes(self, h5file):
-        '''Returns a numpy array of latitude values.'''
+        '''Returns the latitude values: an HDF5 dataset (read block by block), a numpy array, or an Extent.'''
         pass
 
     @abc.abstractmethod
     def getLongitudes(self, h5file):
-        '''Returns a numpy array of longitude values.'''
+        '''Returns the longitude values: an HDF5 dataset (read block by block), a numpy array, or an Extent.'''
         pass
     
     @abc.abstractmethod
     def getTimes(self, h5file):
-        '''Returns a numpy array of python datetime values.'''
+        '''Returns the time values: python datetime values, or an Extent (see :mod:`esgfpy.publish.parsers.times`).'''
         pass
 
     def getExtras(self, h5file):
@@ -101,33 +120,34 @@ class HdfMetadataFileParser(AbstractMetadataFileParser):
         return variables
         
 def storeMetadata(metadata, lons, lats, datetimes, variables, extras={}):
-    '''Utility method to process the numeric arrays and extract metadata values to store.'''
+    '''
+    Utility method to process the numeric arrays and extract metadata values to store.
+    The longitudes, latitudes and datetimes may be HDF5 datasets, numpy arrays, sequences or Extent objects:
+    their minimum and maximum valid values are computed block by block (see :mod:`esgfpy.publish.parsers.extents`).
+    '''
     
-    # latitudes
+    # latitudes (excluding missing values)
     minLat = INVALID_VALUE
     maxLat = INVALID_VALUE
-    if len(lats)>0:
-        lats = lats[ np.where( lats >= -90) ] # exclude missing values
-        lats = lats[ np.where( lats <=  90 )] 
-        if len(lats)>0:
-            minLat = np.min(lats) 
-            maxLat = np.max(lats)
-            logging.debug("Latitude min=%s max=%s" % (minLat, maxLat))
+    latExtent = getExtent(lats, -90, 90)
+    if not latExtent.isEmpty():
+        minLat = latExtent.min
+        maxLat = latExtent.max
+        logging.debug("Latitude min=%s max=%s" % (minLat, maxLat))
         
-    # longitudes
+    # longitudes (excluding missing values)
     minLon = INVALID_VALUE
     maxLon = INVALID_VALUE
-    if len(lons)>0:
-        lons = lons[ np.where( lons >= -180) ] # exclude missing values
-        lons = lons[ np.where( lons <=  360) ] 
-        if len(lons)>0:
+    lonExtent = getExtent(lons, -180, 360)
+    if not lonExtent.isEmpty():
+        minLon = lonExtent.min
+        maxLon = lonExtent.max
         
-            if np.max(lons) > 180: # shift longitudes ?
-                lons = lons - 360
-                
-            minLon = np.min(lons)
-            maxLon = np.max(lons)
-            logging.debug("Longitude min=%s max=%s" % (minLon, maxLon))
+        if maxLon > 180: # shift longitudes ?
+            minLon = minLon - minLon.dtype.type(360) # in the type of the longitudes
+            maxLon = maxLon - maxLon.dtype.type(360)
+            
+        logging.debug("Longitude min=%s max=%s" % (minLon, maxLon))
     
     if minLon >= -180 and maxLon<=180 and minLat>=-90 and maxLat<=90:
         
@@ -142,14 +162,15 @@ def storeMetadata(metadata, lons, lats, datetimes, variables, extras={}):
         metadata[GEO] = ["ENVELOPE(%s, %s, %s, %s)" % (minLon, maxLon, maxLat, minLat)]
     
     # datetimes
-    try:
-        minDateTime = np.min(datetimes)
-        maxDateTime = np.max(datetimes)
+    timeExtent = getExtent(datetimes)
+    if not timeExtent.isEmpty():
+        minDateTime = toDatetime(timeExtent.min)
+        maxDateTime = toDatetime(timeExtent.max)
         logging.debug("Datetime min=%s max=%s" % (minDateTime, maxDateTime))
         metadata[DATETIME_START] = [ minDateTime.strftime('%Y-%m-%dT%H:%M:%SZ') ]
         metadata[DATETIME_STOP] = [ maxDateTime.strftime('%Y-%m-%dT%H:%M:%SZ') ]
-    except ValueError as e:
-        logging.warn(e)
+    else:
+        logging.warn("No valid datetime values")
     
     # variables
     metadata[VARIABLE] = variables
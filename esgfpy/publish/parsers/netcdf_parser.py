@@ -5,6 +5,9 @@ from esgfpy.publish.consts import COORDINATES
 
 class NetcdfMetadataFileParser(AbstractMetadataFileParser):
     '''Parses metadata from NetCDF files.'''
+    
+    EXTENSIONS = ['nc', 'nc4']
+    CACHEABLE = True
         
     def parseMetadata(self, filepath):
         
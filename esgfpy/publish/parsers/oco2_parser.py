@@ -5,11 +5,10 @@ HDF parser specific to OCO-2 and OCO-3 files.
 '''
 import datetime as dt
 from esgfpy.publish.parsers import HdfMetadataFileParser
+from esgfpy.publish.parsers.extents import getExtent
+from esgfpy.publish.parsers.times import decodeIsoStrings, decodeTai93, decodeUnixSeconds
 import os
-import re
 from dateutil.tz import tzutc
-from esgfpy.publish.consts import TAI93_DATETIME_START
-import numpy as np
 
 # standard L2 files (HDF5)
 FILENAME_PATTERN_STD = "oco[23]_L2Std.+\.h5" # oco2_L2StdGL_89234a_100924_B3500_140205185958n.h5
@@ -43,29 +42,19 @@ class Oco2FileParser(HdfMetadataFileParser):
 class Oco2L2StdFileParser(Oco2FileParser):
     '''Parser for OCO-2 L2 Standard files (HDF5 format)'''
     
-    def matches(self, filepath):
-        '''Example filename: oco2_L2StdGL_89234a_100924_B3500_140205185958n.h5'''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN_STD, filename)
+    # example filename: oco2_L2StdGL_89234a_100924_B3500_140205185958n.h5
+    FILENAME_PATTERNS = [FILENAME_PATTERN_STD]
     
     def getLatitudes(self, h5file):
-        return h5file['RetrievalGeometry']['retrieval_latitude'][:]
+        return h5file['RetrievalGeometry']['retrieval_latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['RetrievalGeometry']['retrieval_longitude'][:]
+        return h5file['RetrievalGeometry']['retrieval_longitude']
     
     def getTimes(self, h5file):
         
-        # use UTC time
-        datasetTimes = []
-        dateStrings = h5file['RetrievalHeader']['retrieval_time_string'][:]
-        for x in dateStrings:
-            try:
-                datasetTimes.append( dt.datetime.strptime(x,"%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=tzutc()) )
-            except:
-                pass # ignore one bad time stamp
-        return datasetTimes
+        # use UTC time (bad time stamps are ignored)
+        return getExtent(h5file['RetrievalHeader']['retrieval_time_string'], decode=decodeIsoStrings)
     
     def getExtras(self, h5file):
 
@@ -79,78 +68,51 @@ class Oco2L2StdFileParser(Oco2FileParser):
 class Oco2LtSIFFileParser(Oco2FileParser):
     ''' Parser for OCO-2 Level 2 Lite SIF files (NetCDF)'''
     
-    def matches(self, filepath):
-        '''Example filename: oco2_LtSIF_200101_B10206r_200728210139s.nc4 '''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN_LTSIF, filename)
+    # example filename: oco2_LtSIF_200101_B10206r_200728210139s.nc4
+    FILENAME_PATTERNS = [FILENAME_PATTERN_LTSIF]
     
     def getLatitudes(self, h5file):
         #return h5file['latitude'][:]
-        return h5file['Geolocation']['latitude'][:]
+        return h5file['Geolocation']['latitude']
 
     def getLongitudes(self, h5file):
         #return h5file['longitude'][:]
-        return h5file['Geolocation']['longitude'][:]
+        return h5file['Geolocation']['longitude']
     
     def getTimes(self, h5file):
         
-        datasetTimes = []
-        
         # use TAI93 time
-        #seconds = h5file['time'][:]
-        seconds = h5file['Geolocation']['time_tai93'][:]
-
-        # loop over data points
-        for secs in seconds:
-            datasetTimes.append(TAI93_DATETIME_START + dt.timedelta(seconds=int(secs)) ) 
-                                    
-        return datasetTimes
+        #return getExtent(h5file['time'], decode=decodeTai93)
+        return getExtent(h5file['Geolocation']['time_tai93'], decode=decodeTai93)
     
 class Oco2LtCO2FileParser(Oco2FileParser):
     '''Parser for OCO-2 L2 Lite files (NetCDF4 format)'''
     
-    def matches(self, filepath):
-        '''Example filename: oco2_LtCO2_150831_B7101A_150903021130s.nc4'''
-        
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN_LTCO2, filename)
+    # example filename: oco2_LtCO2_150831_B7101A_150903021130s.nc4
+    FILENAME_PATTERNS = [FILENAME_PATTERN_LTCO2]
     
     def getLatitudes(self, h5file):
-        return h5file['latitude'][:]
+        return h5file['latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['longitude'][:]
+        return h5file['longitude']
     
     def getTimes(self, h5file):
         
-        # use UTC time
-        datasetTimes = []
-        seconds = h5file['time'][:]
-        for x in seconds:
-            try:
-                datasetTimes.append( dt.datetime.utcfromtimestamp(int(x)).replace(tzinfo=tzutc()) )
-            except:
-                pass # ignore one bad time stamp
-            
-        return datasetTimes
+        # use UTC time (bad time stamps are ignored)
+        return getExtent(h5file['time'], decode=decodeUnixSeconds)
     
 class Xco2FileParser(HdfMetadataFileParser):
     '''Parser for XCO2 (NetCDF4 format)'''
     
-    def matches(self, filepath):
-        '''Example filename: ocoX_L3CO2_170105_170112_B8101_a7310Ao7305Br_170721052306s.nc4'''
-                
-        dir, filename = os.path.split(filepath)
-        # store filename to extract dates later
-        self.filename = filename
-        return re.match(FILENAME_PATTERN_XCO2, filename)
+    # example filename: ocoX_L3CO2_170105_170112_B8101_a7310Ao7305Br_170721052306s.nc4
+    FILENAME_PATTERNS = [FILENAME_PATTERN_XCO2]
     
     def getLatitudes(self, h5file):
-        return h5file['latitude'][:]
+        return h5file['latitude']
 
     def getLongitudes(self, h5file):
-        return h5file['longitude'][:]
+        return h5file['longitude']
     
     def getTimes(self, h5file):
         
@@ -158,7 +120,8 @@ class Xco2FileParser(HdfMetadataFileParser):
         datasetTimes = []
         
         # extract start, stop times from file name
-        parts = self.filename.split('_')
+        dir, filename = os.path.split(h5file.filename)
+        parts = filename.split('_')
         dtStart = "20%sT00:00:00" % parts[2]
         dtStop = "20%sT23:59:59" % parts[3]
         datasetTimes.append( dt.datetime.strptime(dtStart,"%Y%m%dT%H:%M:%S").replace(tzinfo=tzutc()) )
@@ -5,6 +5,10 @@ class OptOutMetadataFileParser(AbstractMetadataFileParser):
     Implementation of AbstractMetadataFileParser that does nothing
     (i.e. doesn't parse metadata from any file).
     """
+    
+    # claims no file
+    FILENAME_PATTERNS = []
+    EXTENSIONS = []
         
     def parseMetadata(self, filepath):
         """Returns an empty dictionary."""
@@ -0,0 +1,58 @@
+'''
+Module :mod:`esgfpy.publish.parsers.registry`
+=============================================
+
+Module containing the dispatch index of a list of metadata parsers: each parser declares the files it parses
+(by FILENAME_PATTERNS and/or EXTENSIONS), so that each file is only passed to the parsers that claim it,
+and adding parsers for other kinds of files adds no cost per file.
+'''
+
+import os
+import logging
+
+from esgfpy.publish.matching import FilenameMatcher
+
+class ParserRegistry(object):
+    """
+    Dispatch index of an ordered list of metadata parsers.
+    A parser claims a file if the file name matches one of the parser's FILENAME_PATTERNS,
+    or if the file extension is one of the parser's EXTENSIONS; the parsers that declare neither claim all files.
+    To claim no file, a parser must declare both as empty lists.
+    The file name patterns of all parsers are evaluated at once, by a single FilenameMatcher.
+    """
+
+    def __init__(self, parsers):
+        """
+        :param parsers: list of AbstractMetadataFileParser objects (later parsers override the metadata of earlier ones)
+        """
+
+        self.parsers = list(parsers)
+
+        # indexes of the parsers claiming all files, and of the parsers claiming each file extension
+        self._generic = []
+        self._extensions = {}
+        patterns = []
+        for (index, parser) in enumerate(self.parsers):
+            filenamePatterns = getattr(parser, 'FILENAME_PATTERNS', None)
+            extensions = getattr(parser, 'EXTENSIONS', None)
+            if filenamePatterns is None and extensions is None:
+                self._generic.append(index)
+            elif extensions is None and len(filenamePatterns) == 0:
+                logging.warn("Metadata parser %s declares no FILENAME_PATTERNS and no EXTENSIONS: it will parse no file "
+                             "(set FILENAME_PATTERNS = None to pass it all files)" % parser.__class__.__name__)
+            for pattern in filenamePatterns or []:
+                patterns.append( (pattern, index) )
+            for extension in extensions or []:
+                self._extensions.setdefault(extension, []).append(index)
+        self._matcher = FilenameMatcher(patterns)
+
+    def getParsers(self, filepath):
+        '''Returns the parsers claiming the given file, in their configured order.'''
+
+        filename = os.path.basename(filepath)
+        extension = os.path.splitext(filename)[1][1:]
+
+        indexes = set(self._generic)
+        indexes.update( self._extensions.get(extension, []) )
+        indexes.update( match.owner for match in self._matcher.matchAll(filename) )
+        return [self.parsers[index] for index in sorted(indexes)]
@@ -3,13 +3,9 @@ HDF parser specific to TES files.
 
 @author: Luca Cinquini
 '''
-import datetime as dt
 from esgfpy.publish.parsers import HdfMetadataFileParser
-import os
-import re
-from dateutil.tz import tzutc
-import numpy as np
-from esgfpy.publish.consts import TAI93_DATETIME_START
+from esgfpy.publish.parsers.extents import getExtent
+from esgfpy.publish.parsers.times import decodeTai93
 
 # TL2CO2Nv6: TES-Aura_L2-CO2-Nadir_r0000015508_C01_F07_10.he5
 # FILENAME_PATTERN = "TES-Aura_L2-CO2-Nadir_.+10\.he5"
@@ -20,29 +16,25 @@ FILENAME_PATTERN = "TES-Aura_L2-CO2-Nadir_.+12\.he5"
 # TL2CO2Nv7: TES-Aura_L2-CO2-Nadir_2004-08_v007_Lite-v02.00.nc
 FILENAME_PATTERN_LITE = "TES-Aura_L2-CO2-Nadir_.+00\.nc"
 
+def decodeTesTimes(seconds):
+    '''Converts TES times (TAI93 seconds) to UTC by subtracting 35 seconds (Time:MissingValue = -999. is dropped).'''
+    return decodeTai93(seconds, leapSeconds=False, offset=35)
+
 class TesFileParser(HdfMetadataFileParser):
     
-    def matches(self, filepath):
-        '''Example filename: TES-Aura_L2-CO2-Nadir_r0000015508_C01_F07_10.he5'''
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN, filename)
+    # example filename: TES-Aura_L2-CO2-Nadir_r0000015508_C01_F07_10.he5
+    FILENAME_PATTERNS = [FILENAME_PATTERN]
     
     def getLatitudes(self, h5file):
-        return h5file['HDFEOS']['SWATHS']['CO2NadirSwath']['Geolocation Fields']['Latitude'][:]
+        return h5file['HDFEOS']['SWATHS']['CO2NadirSwath']['Geolocation Fields']['Latitude']
  
     def getLongitudes(self, h5file):
-        return h5file['HDFEOS']['SWATHS']['CO2NadirSwath']['Geolocation Fields']['Longitude'][:]
+        return h5file['HDFEOS']['SWATHS']['CO2NadirSwath']['Geolocation Fields']['Longitude']
     
     def getTimes(self, h5file):
         
         # uses TAI time
-        seconds = h5file['HDFEOS']['SWATHS']['CO2NadirSwath']['Geolocation Fields']['Time'][:]
-        times = []
-        for secs in seconds:
-            if secs>0: # avoid Time:MissingValue = -999. ;
-                utcdateTime = TAI93_DATETIME_START + dt.timedelta(seconds=int(secs)) - dt.timedelta(seconds=35)
-                times.append( utcdateTime )
-        return np.asarray(times, dtype=dt.datetime)
+        return getExtent(h5file['HDFEOS']['SWATHS']['CO2NadirSwath']['Geolocation Fields']['Time'], decode=decodeTesTimes)
     
     def getVariables(self, h5file):
         
@@ -55,27 +47,19 @@ class TesFileParser(HdfMetadataFileParser):
 
 class TesFileParserLite(HdfMetadataFileParser):
     
-    def matches(self, filepath):
-        '''Example filename: TES-Aura_L2-CO2-Nadir_r0000015508_C01_F07_10.he5'''
-        dir, filename = os.path.split(filepath)
-        return re.match(FILENAME_PATTERN_LITE, filename)
+    # example filename: TES-Aura_L2-CO2-Nadir_r0000015508_C01_F07_10.he5
+    FILENAME_PATTERNS = [FILENAME_PATTERN_LITE]
     
     def getLatitudes(self, h5file):
-        return h5file['Latitude'][:]
+        return h5file['Latitude']
  
     def getLongitudes(self, h5file):
-        return h5file['Longitude'][:]
+        return h5file['Longitude']
     
     def getTimes(self, h5file):
         
         # uses TAI time
-        seconds = h5file['Time'][:]
-        times = []
-        for secs in seconds:
-            if secs>0: # avoid Time:MissingValue = -999. ;
-                utcdateTime = TAI93_DATETIME_START + dt.timedelta(seconds=int(secs)) - dt.timedelta(seconds=35)
-                times.append( utcdateTime )
-        return np.asarray(times, dtype=dt.datetime)
+        return getExtent(h5file['Time'], decode=decodeTesTimes)
     
     def getVariables(self, h5file):
         
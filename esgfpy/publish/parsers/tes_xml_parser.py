@@ -4,10 +4,11 @@ Metadata parser specific to TES XML schema.
 
 from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
 import logging
-import os
 import datetime as dt
 from xml.etree.ElementTree import fromstring
 from esgfpy.publish.consts import (CHECKSUM, CHECKSUM_TYPE)
+from esgfpy.publish.walker import listings
+from esgfpy.publish.checksums import HEX_LENGTHS
 
 class TesXmlMetadataFileParser(AbstractMetadataFileParser):
     
@@ -18,7 +19,7 @@ class TesXmlMetadataFileParser(AbstractMetadataFileParser):
         
         if "TES" in filepath:
             xmlpath = "%s.xml" % filepath
-            if os.path.exists(xmlpath):
+            if listings.exists(xmlpath):
                 logging.debug("TesXmlMetadataFileParser: parsing file=%s" % xmlpath)
                     
                 xmlFile = open(xmlpath, 'r')
@@ -63,7 +64,14 @@ class TesXmlMetadataFileParser(AbstractMetadataFileParser):
                 
                 # <ChecksumType>MD5</ChecksumType>
                 # <Checksum>a7fc67ad798c9a4ea61eda96f3545d6b</Checksum>
-                metadata[CHECKSUM] = ['a7fc67ad798c9a4ea61eda96f3545d6b']
-                metadata[CHECKSUM_TYPE] = ['MD5']
+                # (trusted by the checksum engine instead of reading the data file: only set if present)
+                checksum = (rootEl.findtext('.//Checksum') or '').strip()
+                if checksum:
+                    checksumType = (rootEl.findtext('.//ChecksumType') or '').strip()
+                    if not checksumType:
+                        # infer the algorithm from the number of hexadecimal digits
+                        checksumType = dict( (length, algorithm) for (algorithm, length) in HEX_LENGTHS.items() ).get(len(checksum), 'MD5')
+                    metadata[CHECKSUM] = [checksum]
+                    metadata[CHECKSUM_TYPE] = [checksumType]
             
         return metadata
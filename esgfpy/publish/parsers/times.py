@@ -0,0 +1,109 @@
+'''
+Module :mod:`esgfpy.publish.parsers.times`
+==========================================
+
+Module containing the vectorized decoding of the time arrays of the data files into numpy datetime64 arrays
+(in seconds, UTC), without a python datetime object per sounding:
+
+- TAI93 seconds (seconds since 1993-01-01T00:00:00, including the leap seconds inserted since then)
+- Unix seconds (seconds since 1970-01-01T00:00:00)
+- fixed-width ISO 8601 strings (for example: '2014-09-06T12:34:56.789Z', decoded up to the seconds)
+- arrays of seven integers (year, month, day, hour, minute, second, millisecond), as in the ACOS Lite files
+
+Each decoder takes a block of values and returns the datetime64 values of the valid ones (the missing values are
+dropped by mask), so that it can be applied block by block while computing an extent. Example:
+
+    timeExtent = getExtent(h5file['Geolocation']['time_tai93'], decode=decodeTai93)
+'''
+
+import datetime as dt
+import numpy as np
+
+UNIX_EPOCH = np.datetime64('1970-01-01T00:00:00', 's')
+TAI93_EPOCH = np.datetime64('1993-01-01T00:00:00', 's')
+
+# UTC dates of the leap seconds inserted since the TAI93 epoch (at the end of the previous day)
+LEAP_SECOND_DATES = ['1993-07-01', '1994-07-01', '1996-01-01', '1997-07-01', '1999-01-01',
+                     '2006-01-01', '2009-01-01', '2012-07-01', '2015-07-01', '2017-01-01']
+
+# TAI93 seconds from which each additional leap second has elapsed
+_LEAP_SECOND_TAI93 = np.array([ (np.datetime64(date, 's') - TAI93_EPOCH).astype(np.int64) + count
+                                for (count, date) in enumerate(LEAP_SECOND_DATES, 1) ], dtype=np.int64)
+
+# width of the ISO 8601 strings decoded, up to the seconds: YYYY-MM-DDTHH:MM:SS
+ISO_WIDTH = 19
+
+def decodeTai93(seconds, leapSeconds=True, offset=0):
+    """
+    Decodes TAI93 seconds into UTC datetime64 values. The values that are not finite, or not positive, are dropped.
+    :param leapSeconds: True to subtract the leap seconds inserted between the TAI93 epoch and each time
+    :param offset: additional number of seconds subtracted from each time
+    """
+
+    seconds = _validSeconds(seconds)
+    if leapSeconds:
+        seconds -= np.searchsorted(_LEAP_SECOND_TAI93, seconds, side='right')
+    if offset:
+        seconds -= offset
+    return TAI93_EPOCH + seconds
+
+def decodeUnixSeconds(seconds):
+    '''Decodes Unix seconds into UTC datetime64 values. The values that are not finite, or not positive, are dropped.'''
+
+    return UNIX_EPOCH + _validSeconds(seconds)
+
+def decodeIsoStrings(strings):
+    '''Decodes ISO 8601 strings (truncated to the seconds) into datetime64 values. The invalid strings are dropped.'''
+
+    strings = np.asarray(strings).ravel().astype('S%s' % ISO_WIDTH)
+    try:
+        times = strings.astype('datetime64[s]')
+    except ValueError:
+        # at least one bad time stamp: decode one by one
+        times = np.array([_parseIsoString(string) for string in strings], dtype='datetime64[s]')
+    return times[~np.isnat(times)]
+
+def decodeTimeArrays(fields):
+    """
+    Decodes arrays of seven integers (year, month (1-12), day (1-31), hour (0-23), minute (0-59), second (0-59),
+    millisecond (0-999)), one per row, into datetime64 values (without the milliseconds).
+    The rows that are not valid dates are dropped.
+    """
+
+    fields = np.asarray(fields).reshape(-1, 7)[:, 0:6].astype(np.int64)
+    (years, months, days, hours, minutes, seconds) = fields.T
+
+    valid = ( (years >= 1) & (months >= 1) & (months <= 12) & (days >= 1) & (days <= 31)
+              & (hours >= 0) & (hours <= 23) & (minutes >= 0) & (minutes <= 59) & (seconds >= 0) & (seconds <= 60) )
+    if not valid.all():
+        (years, months, days, hours, minutes, seconds) = fields[valid].T
+
+    yearMonths = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    dates = yearMonths.astype('datetime64[D]') + (days - 1)
+    times = dates.astype('datetime64[s]') + (hours * 3600 + minutes * 60 + seconds)
+
+    # exclude the days past the end of their month (for example, February 30)
+    return times[dates.astype('datetime64[M]') == yearMonths]
+
+def toDatetime(value):
+    '''Returns a python datetime for a datetime64 value (other values are returned as is).'''
+
+    if isinstance(value, np.datetime64):
+        return value.astype('datetime64[us]').astype(dt.datetime)
+    return value
+
+def _validSeconds(seconds):
+    '''Returns the finite and positive values as int64 seconds (truncating the fractions of seconds).'''
+
+    seconds = np.asarray(seconds).ravel()
+    with np.errstate(invalid='ignore'):
+        valid = np.isfinite(seconds) & (seconds > 0)
+    if not valid.all():
+        seconds = seconds[valid]
+    return seconds.astype(np.int64)
+
+def _parseIsoString(string):
+    try:
+        return np.datetime64(string, 's')
+    except ValueError:
+        return np.datetime64('NaT')
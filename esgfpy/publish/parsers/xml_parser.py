@@ -1,8 +1,12 @@
 from esgfpy.publish.parsers.abstract_parser import AbstractMetadataFileParser
 from os.path import splitext, expanduser
-from xml.etree.ElementTree import fromstring
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 import ConfigParser
 from esgfpy.publish.consts import METADATA_MAPPING_FILE
+from esgfpy.publish.walker import listings
 import os
 import re
 import logging
@@ -12,11 +16,15 @@ class XMLMetadataFileParser(AbstractMetadataFileParser):
     Implementation of AbstractMetadataFileParser that parses metadata from ancillary XML files.
     :param startDirectory: optional parent directory where metadata XML files can be located
                            (new values for the same metadata key will be added to the list).
+    The XML files of directories are shared by all their sub-directories: their metadata (with the mappings applied),
+    or their absence, is cached for the current walk of the tree, so that each one is read at most once per run.
     """
     
-    def __init__(self, metadata_mapping_file=METADATA_MAPPING_FILE, startDirectory=None):
+    def __init__(self, metadata_mapping_file=METADATA_MAPPING_FILE, startDirectory=None, maxCachedFiles=4096):
         
         # read optional mappings for facet keys and values
+        self.metadataKeyMappings = {}
+        self.metadataValueMappings = {}
         config = ConfigParser.RawConfigParser()
         try:
             config.read( expanduser(metadata_mapping_file) )
@@ -30,6 +38,12 @@ class XMLMetadataFileParser(AbstractMetadataFileParser):
         # starting directory to look for XML metadata files
         self.startDirectory = startDirectory    
         
+        # cache of the directory XML files: path --> tuple of (key, value) items, or None if the file does not exist
+        # (emptied at the start of each walk of the tree, and whenever it holds more than maxCachedFiles files)
+        self.maxCachedFiles = maxCachedFiles
+        self._cache = {}
+        self._cacheGeneration = listings.generation
+        
     def parseMetadata(self, filepath):
         """Parses the XML tag <tag_name>tag_value</tag_name> into the dictionary entry tag_name=tag_value."""
         
@@ -38,29 +52,72 @@ class XMLMetadataFileParser(AbstractMetadataFileParser):
         # look for XML metadata files associated with this file or directory
         metadataFilepaths = self._metadataFilePaths(filepath)
         
+        # the XML files of directories are cached, not the XML files of files (each one is read only once anyway)
+        isDirectory = listings.isDirectory(filepath)
+        
         for metadataFilepath in metadataFilepaths:
         
-            if os.path.exists(metadataFilepath):
-                logging.debug("XMLMetadataFileParser: parsing file=%s" % metadataFilepath)
+            if isDirectory:
+                items = self._getCachedItems(metadataFilepath)
+            elif listings.exists(metadataFilepath):
+                items = self._readItems(metadataFilepath)
+            else:
+                items = None
+            
+            for (key, value) in items or ():
+                self._addMetadata(metadata, key, value)
+            
+        return metadata
+    
+    def _getCachedItems(self, metadataFilepath):
+        '''Returns the (key, value) items of a directory XML file, read at most once per walk of the tree (None if missing).'''
+        
+        if self._cacheGeneration != listings.generation or len(self._cache) >= self.maxCachedFiles:
+            self._cache = {}
+            self._cacheGeneration = listings.generation
+        
+        try:
+            return self._cache[metadataFilepath]
+        except KeyError:
+            items = self._readItems(metadataFilepath) if listings.exists(metadataFilepath) else None
+            self._cache[metadataFilepath] = items
+            return items
+    
+    def _readItems(self, metadataFilepath):
+        '''Parses the children of the root element of an XML file into a tuple of (key, value) items, with the mappings applied.'''
+        
+        logging.debug("XMLMetadataFileParser: parsing file=%s" % metadataFilepath)
+        
+        items = []
+        with open(metadataFilepath, 'rb') as xmlFile:
             
-                xmlFile = open(metadataFilepath, 'r')
-                xml = xmlFile.read()
-                rootEl = fromstring(xml)
+            # stream the file, discarding each child of the root element once parsed
+            depth = 0
+            rootEl = None
+            for (event, element) in iterparse(xmlFile, events=('start', 'end')):
+                if event == 'start':
+                    if rootEl is None:
+                        rootEl = element
+                    depth += 1
+                    continue
                 
-                # loop over children of root element
-                for childEl in rootEl:
-                    key = childEl.tag
-                    value = childEl.text
+                depth -= 1
+                if depth == 1:
+                    key = element.tag
+                    value = element.text
                     # apply optional mappings for key, value
                     if key in self.metadataKeyMappings:
                         key = self.metadataKeyMappings[key]           
                     if value in self.metadataValueMappings:
                         value = self.metadataValueMappings[value]
-                    self._addMetadata(metadata, key, value)
-            
-                xmlFile.close()
-            
-        return metadata
+                    items.append( (key, value) )
+                    rootEl.clear()
+        
+        return tuple(items)
+    
+    def __getstate__(self):
+        # the cache is not copied to other processes
+        return dict(self.__dict__, _cache={})
     
     def _metadataFilePaths(self, filepath):
         '''Method to build the paths of the XML metadata files associated to the requested filepath.'''
@@ -69,7 +126,7 @@ class XMLMetadataFileParser(AbstractMetadataFileParser):
         xmlFiles = []
                 
         # for directories: <dirpath>/<lastsubdirename>.xml
-        if os.path.isdir(filepath):
+        if listings.isDirectory(filepath):
             
             # traverse the directory tree from self.startDirectory, if provided
             if self.startDirectory is None:
@@ -0,0 +1,243 @@
+'''
+Module :mod:`esgfpy.publish.pipeline`
+=====================================
+
+Module containing a publishing client that runs the indexing and publishing stages concurrently.
+'''
+
+import threading
+import Queue
+import sys
+import logging
+
+from esgfpy.publish.consts import TYPE_DATASET, TYPE_FILE
+from esgfpy.publish.services import PublishingClient, build_solr_update_url
+
+# marker for the end of the items in a queue
+_END = object()
+
+class PipelineStopped(Exception):
+    '''Raised inside a stage when another stage of the pipeline has failed.'''
+    pass
+
+class PipelinedPublishingClient(PublishingClient):
+    """
+    PublishingClient that publishes records through a pipeline of concurrent stages connected by bounded queues:
+    the walker finds the directories, the parser generates their records, the serializer groups the serialized records
+    into requests, and a pool of poster threads sends the requests to the publishing service.
+    When a stage falls behind (for example, a slow Solr), the bounded queues stop the upstream stages,
+    so that memory does not grow with the size of the backlog.
+    """
+
+    def __init__(self, indexer, publishing_service_url='http://localhost:8984/solr', numPosters=2, queueSize=16,
+                 reportInterval=30, **kwargs):
+        """
+        :param numPosters: number of threads posting requests to the publishing service concurrently
+        :param queueSize: maximum number of items (directories, datasets, requests) waiting in each queue
+        :param reportInterval: number of seconds between reports of the queue depths (0 to disable)
+        Other arguments are passed to PublishingClient
+        (streaming only applies to unpublish(): published records are always sent in requests sized by the BatchSizers).
+        """
+
+        super(PipelinedPublishingClient, self).__init__(indexer, publishing_service_url, **kwargs)
+        self.numPosters = numPosters
+        self.queueSize = queueSize
+        self.reportInterval = reportInterval
+
+    def publish(self, uri, force=False):
+        """
+        Overridden superclass method to run the walker, parser, serializer and posters concurrently.
+
+        :param uri: URI of metadata repository to be indexed
+        :param force: True to republish all records, even if unchanged since they were last published
+        """
+
+        self._force = force
+        self._stopped = threading.Event()
+        self._errors = []
+        self._datasetIds = []
+        self._queues = [ ("directories", Queue.Queue(self.queueSize)),
+                         ("records", Queue.Queue(self.queueSize)),
+                         ("requests", Queue.Queue(self.queueSize)) ]
+        self._maxDepths = dict( (name, 0) for (name, queue) in self._queues )
+        (directories, records, requests) = [queue for (name, queue) in self._queues]
+
+        threads = [ self._start(self._walk, uri, directories),
+                    self._start(self._parse, directories, records),
+                    self._start(self._serialize_requests, records, requests) ]
+        posters = [ self._start(self._send_requests, requests) for i in range(self.numPosters) ]
+        reporter = self._start(self._report) if self.reportInterval > 0 else None
+
+        for thread in threads + posters:
+            thread.join()
+        self._stopped.set()
+        if reporter is not None:
+            reporter.join()
+
+        if len(self._errors) > 0:
+            (excType, excValue, excTraceback) = self._errors[0]
+            raise excType, excValue, excTraceback
+
+        logging.info("Maximum queue depths: %s" % self._formatDepths(self._maxDepths))
+        self.indexer.markUnpublished( [recordId for recordId in self.indexer.deletedRecords()[TYPE_FILE]
+                                       if recordId not in self.rejectedIds] )
+
+        # commit all records at once
+        self._commit(TYPE_DATASET)
+        self._commit(TYPE_FILE)
+        self._report_rejects()
+
+        # update datasets from the committed files
+        if self.updateDatasets:
+            self._update( self._datasetIds, sizes=self.updateSizes )
+
+    def _walk(self, uri, outQueue):
+        '''Walker stage: finds the units of work to be processed by the indexer.'''
+
+        for work in self.indexer.walk(uri, maxRecords=self.maxRecords, incremental=True, force=self._force):
+            self._put(outQueue, work)
+        self._put(outQueue, _END)
+
+    def _parse(self, inQueue, outQueue):
+        '''Parser stage: generates the records for each unit of work.'''
+
+        for work in self._iterate(inQueue):
+            records = self.indexer.process(work)
+            if records is not None:
+                self._put(outQueue, records)
+        self.indexer.finish()
+        self._put(outQueue, _END)
+
+    def _serialize_requests(self, inQueue, outQueue):
+        '''Serializer stage: groups the serialized records of each type into requests.'''
+
+        batches = {}
+        for record_type in (TYPE_DATASET, TYPE_FILE):
+            batches[record_type] = _Batch(record_type, self._add_envelope)
+
+        for (datasetRecord, fileRecords) in self._iterate(inQueue):
+            if len(datasetRecord.fileIds) > 0:
+                self._datasetIds.append(datasetRecord.id)
+            for record in [datasetRecord] + fileRecords:
+                for (id, doc) in self._serialize([record]):
+                    batches[record.type] = self._add(outQueue, batches[record.type], id, doc, record)
+
+        # unpublish records that have disappeared since they were last published
+        deletedRecords = self.indexer.deletedRecords()
+        for record_type in (TYPE_FILE, TYPE_DATASET):
+            batch = _Batch(record_type, self.serializer.iterDelete)
+            for (id, doc) in self._serialize_deletes(deletedRecords[record_type], record_type):
+                batch = self._add(outQueue, batch, id, doc)
+            batches["delete-%s" % record_type] = batch
+
+        for batch in batches.values():
+            if len(batch.docs) > 0:
+                self._put(outQueue, batch)
+        for i in range(self.numPosters):
+            self._put(outQueue, _END)
+
+    def _send_requests(self, inQueue):
+        '''Poster stage: sends each request to the publishing service.'''
+
+        for batch in self._iterate(inQueue):
+            solr_url = build_solr_update_url(self.publishing_service_url, batch.record_type)
+            self._post_docs(solr_url, self._getBatchSizer(batch.record_type), batch.envelope, batch.docs, batch.ids)
+            if batch.record_type == TYPE_FILE:
+                self.indexer.markPublished( [record for record in batch.records if record.id not in self.rejectedIds] )
+                self.indexer.markRejected( [record.id for record in batch.records if record.id in self.rejectedIds] )
+
+    def _add(self, outQueue, batch, id, doc, record=None):
+        '''Adds a serialized record to a batch, sending the batch to the posters when full. Returns the current batch.'''
+
+        batchSizer = self._getBatchSizer(batch.record_type)
+        if not batchSizer.fits(len(batch.docs), batch.numBytes, len(doc)):
+            self._put(outQueue, batch)
+            batch = batch.next()
+
+        batch.add(id, doc, record)
+
+        if batchSizer.isFull(len(batch.docs), batch.numBytes):
+            self._put(outQueue, batch)
+            batch = batch.next()
+
+        return batch
+
+    def _report(self):
+        '''Periodically reports the number of items waiting in each queue.'''
+
+        while not self._stopped.wait(self.reportInterval):
+            logging.info("Queue depths: %s" % self._formatDepths(self._depths()))
+
+    def _depths(self):
+        return dict( (name, queue.qsize()) for (name, queue) in self._queues )
+
+    def _formatDepths(self, depths):
+        return ", ".join( "%s=%s" % (name, depths[name]) for (name, queue) in self._queues )
+
+    def _start(self, target, *args):
+        '''Starts a pipeline stage in a new thread.'''
+
+        thread = threading.Thread(target=self._run, args=(target,) + args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self, target, *args):
+        '''Runs a pipeline stage, stopping all other stages if it fails.'''
+
+        try:
+            target(*args)
+        except PipelineStopped:
+            pass
+        except:
+            self._errors.append( sys.exc_info() )
+            self._stopped.set()
+
+    def _put(self, queue, item):
+        '''Puts an item in a queue, waiting for space unless the pipeline is stopped.'''
+
+        while not self._stopped.is_set():
+            try:
+                queue.put(item, timeout=1)
+                for (name, _queue) in self._queues:
+                    if _queue is queue:
+                        self._maxDepths[name] = max(self._maxDepths[name], queue.qsize())
+                return
+            except Queue.Full:
+                pass
+        raise PipelineStopped()
+
+    def _iterate(self, queue):
+        '''Generator of the items in a queue, until its end marker.'''
+
+        while not self._stopped.is_set():
+            try:
+                item = queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+        raise PipelineStopped()
+
+class _Batch(object):
+    '''Serialized records of the same type to be sent in one request.'''
+
+    def __init__(self, record_type, envelope):
+        self.record_type = record_type
+        self.envelope = envelope
+        self.docs = []
+        self.ids = []
+        self.records = []
+        self.numBytes = 0
+
+    def add(self, id, doc, record=None):
+        self.docs.append(doc)
+        self.ids.append(id)
+        self.numBytes += len(doc)
+        if record is not None:
+            self.records.append(record)
+
+    def next(self):
+        '''Returns a new empty batch with the same type and envelope.'''
+        return _Batch(self.record_type, self.envelope)
@@ -10,28 +10,79 @@ Module containing service classes for publishing/unpublishing metadata records t
 import urllib
 import urllib2
 import string
+import time
 import os
 import json
-from xml.etree.ElementTree import Element, SubElement, tostring
+import itertools
 import logging
 
-from esgfpy.publish.consts import TYPE_DATASET, TYPE_FILE, SOLR_CORES
+from esgfpy.publish.consts import TYPE_DATASET, TYPE_FILE, TYPE_AGGREGATION, SOLR_CORES, FORMAT_XML, SIZE, MASTER_ID
+from esgfpy.publish.utils import escapeQuery
+from esgfpy.publish.models import getSerializer, RecordFields
+from esgfpy.publish.connections import ConnectionPool
+from esgfpy.publish.batching import BatchSizer
+from esgfpy.publish.failures import RetryPolicy, RejectFile, getErrorMessage
+from esgfpy.publish.manifest import fingerprint
+from esgfpy.publish.checksums import SIDECAR_SUFFIXES
+from esgfpy.publish.instrumentation import stats
+from esgfpy.publish import walker
 
 class PublishingClient(object):
     """
     Client to remote ESGF publishing service.
-    This implementation publishes 10 records at a time, divided by type,
+    This implementation consumes the records from the indexer in batches,
+    publishes them divided by type, in requests whose size adapts to the response latency of each Solr core,
     then commits all records at once.
     """
 
-    # number of max records for publishing/unpublishing operations
+    # initial number of records for publishing/unpublishing operations
     MAX_RECORDS_PER_REQUEST = 10
 
-    def __init__(self, indexer, publishing_service_url='http://localhost:8984/solr', maxRecords=-1):
+    # default max payload size for publishing/unpublishing operations
+    MAX_BYTES_PER_REQUEST = 1024*1024
+
+    # number of max records held in memory before being sent to the publishing service
+    MAX_RECORDS_PER_BATCH = 1000
+
+    # max number of datasets whose files are counted by each query
+    MAX_DATASETS_PER_QUERY = 1000
+
+    def __init__(self, indexer, publishing_service_url='http://localhost:8984/solr', maxRecords=-1,
+                 commitWithin=-1, connectionPool=None, batchLimits={}, format=FORMAT_XML, streaming=False,
+                 updateDatasets=False, updateSizes=False, retryPolicy=None, rejectFile=None, outbox=None):
         """
         :param indexer: Indexer instance responsible for generating the XML records.
         :param publishing_service_url: URL of publishing service where XML records are sent.
+        :param maxRecords: if greater than 0, maximum number of File records published/unpublished
+        :param commitWithin: if greater than 0, number of milliseconds within which Solr will make
+                             the published records searchable (before the final commit)
+        :param connectionPool: optional ConnectionPool used to send all requests
+                               (by default, a pool of keep-alive connections with uncompressed request bodies)
+        :param batchLimits: optional dictionary of record type to (max records, max bytes) per request
+                            (by default, MAX_RECORDS_PER_BATCH records and MAX_BYTES_PER_REQUEST bytes)
+        :param format: wire format of the update requests, FORMAT_XML or FORMAT_JSON
+        :param streaming: True to send all records of each type and batch in a single request,
+                          streamed with chunked transfer encoding as the records are serialized
+                          (instead of several requests sized by the BatchSizer)
+        :param updateDatasets: True to recompute the "number_of_files" field of the published datasets
+                               from the committed files, with atomic updates (Solr 4 or later)
+        :param updateSizes: True to also recompute the total "size" of the published datasets
+                            (requires the JSON Facet API, Solr 5 or later)
+        :param retryPolicy: optional RetryPolicy for the requests failing with transient errors
+                            (by default, up to 5 retries with jittered exponential backoff)
+        :param rejectFile: optional path of a local file where the records rejected by the publishing service are
+                           quarantined: a failing request is split in halves until the bad records are isolated,
+                           while the other records are published (by default, a rejected request aborts publishing)
+        :param outbox: optional Outbox where the update requests are spooled instead of being sent,
+                       to be replayed later by an OutboxDrainer (queries, as used by unpublishByQuery(), are still sent
+                       to the publishing service). The spooled file records are marked as published in the manifest
+                       of the indexer, if any, as soon as they are spooled (not when the outbox is drained).
+                       Cannot be combined with updateDatasets, whose counts would be queried from the index
+                       before the spooled records are added to it.
         """
+        if outbox is not None and updateDatasets:
+            raise Exception("The dataset fields cannot be updated when the requests are spooled to an outbox")
+
         #! TODO: change from Solr to the ESGF publishing service.
 
         # class responsible for creating the Solr records
@@ -43,27 +94,79 @@ class PublishingClient(object):
         # maximum number of records published/unpublished
         self.maxRecords = maxRecords
 
-    def publish(self, uri):
+        # optional Solr soft commit interval
+        self.commitWithin = commitWithin
+
+        # persistent connections to the publishing service
+        if connectionPool is None:
+            connectionPool = ConnectionPool()
+        self.connectionPool = connectionPool
+
+        # limits on the size of each request, by record type
+        self.batchLimits = batchLimits
+        self.batchSizers = {}
+
+        # serializer of the records into update requests
+        self.serializer = getSerializer(format)
+        self.streaming = streaming
+
+        # optional recomputation of dataset fields after publishing
+        self.updateDatasets = updateDatasets
+        self.updateSizes = updateSizes
+
+        # handling of failed requests
+        if retryPolicy is None:
+            retryPolicy = RetryPolicy()
+        self.retryPolicy = retryPolicy
+        self.rejectFile = RejectFile(rejectFile) if rejectFile is not None else None
+        self.rejectedIds = set()
+
+        # optional spool of update requests
+        self.outbox = outbox
+
+    def publish(self, uri, force=False):
         """
         Method to publish records from a metadata repository to the ESGF publishing service.
+        Records are consumed from the indexer as they are generated,
+        and sent in batches of at most MAX_RECORDS_PER_BATCH records.
+        If the indexer supports incremental indexing, only new or changed records are published,
+        and the records whose source has disappeared are unpublished.
 
         :param uri: URI of metadata repository to be indexed
+        :param force: True to republish all records, even if unchanged since they were last published
+                      (for example, after changing the XML metadata files, the constant fields, the metadata mappings
+                      or the parsers, which incremental indexing does not detect)
         """
 
-        # generate records from repository
-        records = self.indexer.index(uri, self.maxRecords)
+        # publish records to remote publishing service as they are generated, one type at a time
+        datasetIds = []
+        for datasetRecords, fileRecords in self._batches(uri, incremental=True, force=force):
 
-        # publish records to remote publishing service, one type at a time
-        # first Datasets
-        self._post( records[TYPE_DATASET], TYPE_DATASET )
+            # first Datasets
+            self._post( datasetRecords, TYPE_DATASET, commit=False )
+            datasetIds += [datasetRecord.id for datasetRecord in datasetRecords if len(datasetRecord.fileIds) > 0]
 
-        # then Files
-        self._post( records[TYPE_FILE], TYPE_FILE )
-        
-        # update datasets
+            # then Files
+            self._post( fileRecords, TYPE_FILE, commit=False )
+            self.indexer.markPublished( [fileRecord for fileRecord in fileRecords if fileRecord.id not in self.rejectedIds] )
+            self.indexer.markRejected( [fileRecord.id for fileRecord in fileRecords if fileRecord.id in self.rejectedIds] )
+
+        # unpublish records that have disappeared since they were last published
+        deletedRecords = self.indexer.deletedRecords()
+        self._delete( deletedRecords[TYPE_FILE], TYPE_FILE, commit=False )
+        self.indexer.markUnpublished( [recordId for recordId in deletedRecords[TYPE_FILE] if recordId not in self.rejectedIds] )
+        self._delete( deletedRecords[TYPE_DATASET], TYPE_DATASET, commit=False )
+
+        # commit all records at once
+        self._commit(TYPE_DATASET)
+        self._commit(TYPE_FILE)
+        self._report_rejects()
+
+        # update datasets from the committed files
         # NOTE: atomic updates only supported in Solr 4
-        #self._update( records[TYPE_DATASET] )
-        
+        if self.updateDatasets:
+            self._update( datasetIds, sizes=self.updateSizes )
+
     def unpublish(self, uri):
         """
         Method to unpublish records from a metadata repository to the ESGF publishing service.
@@ -71,130 +174,499 @@ class PublishingClient(object):
         :param uri: URI of metadata repository to be indexed
         """
 
-        # generate records from repository
-        records = self.indexer.index(uri, self.maxRecords)
+        for datasetRecords, fileRecords in self._batches(uri):
 
-        # unpublish Files first
-        self._post( records[TYPE_FILE], TYPE_FILE, publish=False )
+            # unpublish Files first
+            self._post( fileRecords, TYPE_FILE, publish=False, commit=False )
+            self.indexer.markUnpublished( [fileRecord.id for fileRecord in fileRecords if fileRecord.id not in self.rejectedIds] )
 
-        # then unpublish Datasets
-        self._post( records[TYPE_DATASET], TYPE_DATASET, publish=False )
-        
-    def _update(self, datasetRecords):
-        ''' Updates the "number_of_files" field for each dataset (in one cumulative request).'''
-        
-        # <add>...</add>
-        rootEl = Element("add")
-        for datasetRecord in datasetRecords:
-            
-            solr_url = build_solr_query_url(self.publishing_service_url, TYPE_FILE)
-            jobj = self._query_json(solr_url, {"q":"dataset_id:%s" % datasetRecord.id} )
-            numberOfFiles = jobj["response"]["numFound"]
-            
-            # <doc>...</doc>
-            docEl = SubElement(rootEl, "doc")
-            
-            # <field name="id>$dataset_id</field>
-            fieldIdEl = SubElement(docEl, "field")
-            fieldIdEl.attrib["name"] = "id"
-            fieldIdEl.text = "%s" % datasetRecord.id
-            
-            # <field name="number_of_files" update="set">$number_of_files</update>
-            fieldNumEl = SubElement(docEl, "field")
-            fieldNumEl.attrib["name"] = "number_of_files"
-            fieldNumEl.attrib["update"] = "set"
-            fieldNumEl.text = "%s" % numberOfFiles
-            print "Updating dataset=%s number of files=%s" % (datasetRecord.id, numberOfFiles)
-            
-        xml = tostring(rootEl, encoding="UTF-8")
-        solr_url = build_solr_update_url(self.publishing_service_url, TYPE_DATASET)
-        self._post_xml(solr_url, xml)
+            # then unpublish Datasets
+            self._post( datasetRecords, TYPE_DATASET, publish=False, commit=False )
+
+        self._commit(TYPE_FILE)
         self._commit(TYPE_DATASET)
+        self._report_rejects()
 
-    def _post(self, records, record_type, publish=True):
-        """Method to publish/unpublish a list of records of the same type to the publishing service."""
+    def unpublishByQuery(self, query, dryRun=False):
+        """
+        Method to unpublish all datasets matching a query, together with their files and aggregations,
+        with a few delete-by-query requests (without indexing the metadata repository).
+        The number of matching records in each core is reported before anything is deleted.
 
-        #! TODO: use the same publishing_service_url for all records
-        solr_url = build_solr_update_url(self.publishing_service_url, record_type)
+        :param query: Solr query selecting the records in the datasets core
+        :param dryRun: True to only report the number of records that would be unpublished
+        :return: dictionary of record type, number of matching records
+        """
+
+        # identifiers of the matching datasets, to select their files and aggregations
+        datasetIds = self._query_ids(build_solr_query_url(self.publishing_service_url, TYPE_DATASET), query)
+        return self._unpublishDatasets(datasetIds, [query], "query=%s" % query, dryRun)
+
+    def _unpublishDatasets(self, datasetIds, datasetQueries, description, dryRun=False):
+        """
+        Method to unpublish the datasets selected by the given queries, whose identifiers are given,
+        together with their files and aggregations (see unpublishByQuery()).
+        """
+
+        childQueries = self._terms_queries("dataset_id", datasetIds)
+        queries = [ (TYPE_FILE, childQueries), (TYPE_AGGREGATION, childQueries), (TYPE_DATASET, datasetQueries) ]
+
+        # preview
+        counts = {}
+        for record_type, _queries in queries:
+            counts[record_type] = sum([self._count(record_type, _query) for _query in _queries])
+            print "Number of %s records matching %s: %s" % (record_type, description, counts[record_type])
+        if dryRun:
+            return counts
+
+        # unpublish Files and Aggregations first, then Datasets
+        for record_type, _queries in queries:
+            if counts[record_type] > 0:
+                solr_url = build_solr_update_url(self.publishing_service_url, record_type)
+                for _query in _queries:
+                    self._post_body(solr_url, self.serializer.deleteQuery(_query))
+                self._commit(record_type)
+        self.indexer.markUnpublishedDatasets(datasetIds)
+
+        return counts
+
+    def unpublishByPrefix(self, datasetIdPrefix, dryRun=False):
+        """Method to unpublish all datasets whose identifier starts with the given prefix (see unpublishByQuery())."""
+
+        return self.unpublishByQuery("id:%s*" % escapeQuery(datasetIdPrefix), dryRun=dryRun)
 
-        # enclosing <add>/<delete> instruction
-        if publish:
-            rootEl = Element("add")
+    def unpublishByProject(self, project, dryRun=False):
+        """Method to unpublish all datasets of the given project (see unpublishByQuery())."""
+
+        return self.unpublishByQuery("project:%s" % escapeQuery(project), dryRun=dryRun)
+
+    def unpublishByUri(self, uri, dryRun=False):
+        """
+        Method to unpublish all datasets generated from a metadata repository (see unpublishByQuery()),
+        selected by the identifier prefix that the indexer derives from the URI (for example, a directory template).
+        """
+
+        prefix = self.indexer.getIdentifierPrefix(uri)
+        if prefix is None:
+            raise Exception("Cannot determine the dataset identifiers for: %s" % uri)
+
+        # the identifier itself, followed by the version, the data node, or the identifiers of sub-directories
+        # (which also matches the datasets of sibling directories whose name extends the last part after a '.':
+        # only the datasets whose master identifier may have been generated from the URI are unpublished)
+        escapedPrefix = escapeQuery(prefix)
+        query = "id:(%s OR %s.* OR %s\\|*)" % (escapedPrefix, escapedPrefix, escapedPrefix)
+        datasetIds = []
+        for doc in self._query_docs(build_solr_query_url(self.publishing_service_url, TYPE_DATASET), query, ["id", MASTER_ID]):
+            masterId = doc.get(MASTER_ID)
+            if isinstance(masterId, list):
+                masterId = masterId[0] if len(masterId) > 0 else None
+            if masterId is not None and self.indexer.containsIdentifier(uri, masterId):
+                datasetIds.append(doc["id"])
+            else:
+                logging.info("Dataset %s was not generated from: %s, it is not unpublished" % (doc["id"], uri))
+
+        return self._unpublishDatasets(datasetIds, self._terms_queries("id", datasetIds), "uri=%s" % uri, dryRun)
+
+    def _batches(self, uri, incremental=False, force=False):
+        """
+        Generator that groups the (dataset, files) records streamed by the indexer
+        into batches of (dataset records, file records) lists holding at most MAX_RECORDS_PER_BATCH records
+        (a single dataset with more files than that is never split across batches).
+        """
+
+        datasetRecords = []
+        fileRecords = []
+        for datasetRecord, _fileRecords in self.indexer.iterIndex(uri, self.maxRecords, incremental=incremental, force=force):
+
+            datasetRecords.append(datasetRecord)
+            fileRecords += _fileRecords
+
+            if len(datasetRecords) + len(fileRecords) >= PublishingClient.MAX_RECORDS_PER_BATCH:
+                yield (datasetRecords, fileRecords)
+                datasetRecords = []
+                fileRecords = []
+
+        if len(datasetRecords) > 0:
+            yield (datasetRecords, fileRecords)
+
+    def _update(self, datasetIds, sizes=False):
+        """
+        Updates the "number_of_files" field (and optionally the total "size") of each dataset, with atomic updates.
+        The files of up to MAX_DATASETS_PER_QUERY datasets are counted by a single facet query on "dataset_id",
+        then all datasets are updated in one batch of requests.
+
+        :param datasetIds: identifiers of the datasets to update
+        :param sizes: True to also sum the size of the files of each dataset
+        """
+
+        solr_url = build_solr_query_url(self.publishing_service_url, TYPE_FILE)
+        docs = []
+        for i in range(0, len(datasetIds), PublishingClient.MAX_DATASETS_PER_QUERY):
+            _datasetIds = datasetIds[i:i+PublishingClient.MAX_DATASETS_PER_QUERY]
+            counts = self._count_files(solr_url, _datasetIds, sizes=sizes)
+
+            for datasetId in _datasetIds:
+                (numberOfFiles, size) = counts.get(datasetId, (0, 0))
+                fields = [('number_of_files', [numberOfFiles])]
+                if sizes:
+                    fields.append( (SIZE, [size]) )
+                    print "Updating dataset=%s number of files=%s size=%s" % (datasetId, numberOfFiles, size)
+                else:
+                    print "Updating dataset=%s number of files=%s" % (datasetId, numberOfFiles)
+                docs.append( (datasetId, self.serializer.serializeUpdate(datasetId, fields, update='set')) )
+
+        self._post_batches(docs, TYPE_DATASET, self._add_envelope, commit=False)
+        self._commit(TYPE_DATASET)
+
+    def _count_files(self, solr_url, datasetIds, sizes=False):
+        """
+        Method to count the files (and optionally sum their sizes) of the given datasets with one facet query.
+        Returns a dictionary of dataset id to (number of files, total size) tuples (datasets without files are missing).
+        """
+
+        # the list of identifiers is sent in the body of the request, to avoid exceeding the URL length
+        params = [("q", "*:*"), ("fq", "{!terms f=dataset_id}%s" % ",".join(datasetIds)), ("rows", 0)]
+        if sizes:
+            # JSON Facet API: one bucket per dataset, with the sum of the sizes of its files
+            params.append( ("json.facet", json.dumps({"datasets": {"type": "terms", "field": "dataset_id", "limit": -1,
+                                                                   "facet": {"size": "sum(%s)" % SIZE}}})) )
         else:
-            rootEl = Element("delete")
+            params += [("facet", "true"), ("facet.field", "dataset_id"), ("facet.limit", -1), ("facet.mincount", 1)]
+        jobj = self._query_json(solr_url, params, post=True)
+
+        counts = {}
+        if sizes:
+            for bucket in jobj.get("facets", {}).get("datasets", {}).get("buckets", []):
+                counts[bucket["val"]] = (bucket["count"], int(bucket.get("size", 0)))
+        else:
+            # flat list of alternating dataset id, number of files
+            values = jobj["facet_counts"]["facet_fields"]["dataset_id"]
+            for i in range(0, len(values), 2):
+                counts[values[i]] = (values[i+1], 0)
+        return counts
+
+    def _post(self, records, record_type, publish=True, commit=True):
+        """
+        Method to publish/unpublish a list of records of the same type to the publishing service.
+        Records are sent in batches limited by number of records and payload size, as determined by the BatchSizer for that type.
+
+        :param commit: False to leave the commit to the caller (when posting several batches of records)
+        """
+
+        if not publish:
+            self._delete([record.id for record in records], record_type, commit=commit)
+            return
 
-        # loop over records, publish/unpublish "MAX_RECORDS_PER_REQUEST" records at once
         print "Total number of %s records: %s" % (record_type, len(records))
-        for i, record in enumerate(records):
-
-            # add/delete this record
-            if publish:
-                
-                # only pubilsh datasets if they contain files
-                if (record.type != TYPE_DATASET) or (record.type == TYPE_DATASET and len(record.files) > 0):
-                    print "Adding record: type=%s id=%s" % (record.type, record.id)
-                    #print tostring(record.toXML(), encoding="UTF-8")
-                    rootEl.append(record.toXML())
-                else:
-                    print 'Skipping record type=%s id=%s because it contains no files' % (record.type, record.id)
-            else:
-                print "Deleting record: type=%s id=%s" % (record.type, record.id)
-                queryEl = SubElement(rootEl, "query")
-                queryEl.text = "id:%s" % record.id
+        self._post_batches(self._serialize(records), record_type, self._add_envelope, commit=commit)
+
+    def _delete(self, recordIds, record_type, commit=True):
+        """Method to unpublish a list of records of the same type, given their identifiers."""
+
+        print "Total number of %s records: %s" % (record_type, len(recordIds))
+        self._post_batches(self._serialize_deletes(recordIds, record_type), record_type, self.serializer.iterDelete,
+                           commit=commit)
 
-            # send every MAX_RECORDS_PER_REQUEST records
-            if ( (i+1) % PublishingClient.MAX_RECORDS_PER_REQUEST) == 0:
+    def _add_envelope(self, docs):
+        """Encloses the serialized records in an add instruction (returns the pieces of the request body)."""
 
-                #logging.debug("Posting XML:\n%s" % tostring(rootEl, encoding="UTF-8") )
+        return self.serializer.iterAdd(docs, commitWithin=self.commitWithin)
 
-                # post these records
-                self._post_xml(solr_url, tostring(rootEl, encoding="UTF-8") )
+    def _serialize(self, records):
+        """Generator of the (identifier, serialized record) of the records to be published."""
 
-                # remove all children
-                rootEl.clear()
+        for record in records:
+
+            # only pubilsh datasets if they contain files
+            if (record.type != TYPE_DATASET) or (record.type == TYPE_DATASET and len(record.fileIds) > 0):
+                print "Adding record: type=%s id=%s" % (record.type, record.id)
+                with stats.timer('serialize.%s' % record.type):
+                    doc = self.serializer.serialize(record)
+                yield (record.id, doc)
+            else:
+                print 'Skipping record type=%s id=%s because it contains no files' % (record.type, record.id)
+
+    def _serialize_deletes(self, recordIds, record_type):
+        """Generator of the (identifier, serialized instruction) to unpublish each record."""
+
+        for recordId in recordIds:
+            print "Deleting record: type=%s id=%s" % (record_type, recordId)
+            yield (recordId, self.serializer.serializeDelete(recordId))
+
+    def _post_batches(self, docs, record_type, envelope, commit=True):
+        """
+        Method to post (identifier, serialized document) pairs of the same type, enclosed in a request body by the
+        envelope function, as many at once as allowed by the BatchSizer for that type, or all at once in a streamed request
+        (which cannot be retried or split on failure).
+        """
 
-        if len(list(rootEl)) > 0:
-            #logging.debug("Posting XML:\n%s" % tostring(rootEl, encoding="UTF-8") )
-            self._post_xml(solr_url, tostring(rootEl, encoding="UTF-8") )
+        #! TODO: use the same publishing_service_url for all records
+        solr_url = build_solr_update_url(self.publishing_service_url, record_type)
+        batchSizer = self._getBatchSizer(record_type)
+
+        # stream all documents in one request, as they are generated (unless there are none)
+        if self.streaming:
+            docs = iter(docs)
+            for first in docs:
+                self._post_body(solr_url, envelope(doc for (id, doc) in itertools.chain([first], docs)))
+                break
+            if commit:
+                self._commit(record_type)
+            return
+
+        batch = []
+        ids = []
+        numBytes = 0
+        for (id, doc) in docs:
+
+            # send the current batch if this record does not fit
+            if not batchSizer.fits(len(batch), numBytes, len(doc)):
+                self._post_docs(solr_url, batchSizer, envelope, batch, ids)
+                batch = []
+                ids = []
+                numBytes = 0
+
+            batch.append(doc)
+            ids.append(id)
+            numBytes += len(doc)
+
+            # send the current batch if full
+            if batchSizer.isFull(len(batch), numBytes):
+                self._post_docs(solr_url, batchSizer, envelope, batch, ids)
+                batch = []
+                ids = []
+                numBytes = 0
+
+        if len(batch) > 0:
+            self._post_docs(solr_url, batchSizer, envelope, batch, ids)
 
         # commit all records of this type at once
-        self._commit(record_type)
-        
-    def _post_xml(self, url, xml):
-        """Method to post an XML document to the publishing service."""
-
-        #print '\nPosting to URL=%s\nXML=\n%s' % (url, xml)
-        request = urllib2.Request(url=url,
-                                  data=xml,
-                                  headers={'Content-Type': 'text/xml; charset=UTF-8'})
-        response = urllib2.urlopen(request)
-        response.read()
-        
-    def _query_json(self, url, params):
-        '''Executes HTTP GET request and return results as json object.'''
+        if commit:
+            self._commit(record_type)
+
+    def _post_docs(self, url, batchSizer, envelope, docs, ids):
+        """
+        Method to post a batch of serialized documents (with the given identifiers),
+        enclosed in a request body by the envelope function. Transient errors are retried by _post_body().
+        If the batch is rejected as too large, or rejected as invalid (400) when a reject file is configured,
+        it is split in two halves which are posted separately, until the rejected records are isolated
+        and written to the reject file. Any other error (for example, a wrong URL or a server failure) is raised.
+        """
+
+        body = "".join(envelope(docs))
+        startTime = time.time()
+        try:
+            self._post_body(url, body)
+
+        except urllib2.HTTPError as e:
+            if e.code in RejectFile.REJECTED_STATUS_CODES:
+                if len(docs) > 1 and (e.code == 413 or self.rejectFile is not None):
+                    if e.code == 413:
+                        batchSizer.tooLarge(len(body))
+                    half = len(docs) // 2
+                    self._post_docs(url, batchSizer, envelope, docs[:half], ids[:half])
+                    self._post_docs(url, batchSizer, envelope, docs[half:], ids[half:])
+                    return
+                elif self.rejectFile is not None:
+                    self.rejectFile.write(url, ids[0], docs[0], getErrorMessage(e))
+                    self.rejectedIds.add(ids[0])
+                    return
+            raise
+
+        batchSizer.update(len(docs), time.time() - startTime)
+
+    def _getBatchSizer(self, record_type):
+        """Returns the BatchSizer for the given record type, creating it from the configured limits if necessary."""
+
+        if record_type not in self.batchSizers:
+            (maxRecords, maxBytes) = self.batchLimits.get(record_type, (PublishingClient.MAX_RECORDS_PER_BATCH,
+                                                                        PublishingClient.MAX_BYTES_PER_REQUEST))
+            self.batchSizers[record_type] = BatchSizer(maxRecords=maxRecords, maxBytes=maxBytes,
+                                                       initialRecords=PublishingClient.MAX_RECORDS_PER_REQUEST)
+        return self.batchSizers[record_type]
+
+    def _post_body(self, url, body):
+        """
+        Method to post a request body (a string, or an iterable of strings to be streamed) in the configured wire format.
+        Requests with a string body are retried on transient errors, as determined by the RetryPolicy.
+        If an outbox is configured, the request is written to the outbox instead.
+        """
+
+        #logging.debug("Posting:\n%s" % body )
+        headers = {'Content-Type': self.serializer.contentType}
+        stats.count('post.requests')
+        if isinstance(body, basestring):
+            stats.count('post.bytes', len(body))
+        with stats.timer('post'):
+            if self.outbox is not None:
+                self.outbox.write(url[len(self.publishing_service_url):], self.serializer.contentType, body)
+            elif isinstance(body, basestring):
+                self.retryPolicy.call(self.connectionPool.request, 'POST', url, body=body, headers=headers)
+            else:
+                self.connectionPool.request('POST', url, body=body, headers=headers)
+
+    def _report_rejects(self):
+        '''Reports the number of records quarantined in the reject file.'''
+
+        if self.rejectFile is not None and len(self.rejectedIds) > 0:
+            logging.warn("%s records were rejected and written to: %s" % (len(self.rejectedIds), self.rejectFile.filepath))
+
+    def _query_ids(self, url, query):
+        '''Returns the identifiers of all records matching a query, one page of MAX_DATASETS_PER_QUERY records at a time.'''
+
+        return [doc["id"] for doc in self._query_docs(url, query, ["id"])]
+
+    def _query_docs(self, url, query, fields):
+        '''Returns the given fields of all records matching a query, one page of MAX_DATASETS_PER_QUERY records at a time.'''
+
+        docs = []
+        numFound = 1
+        while len(docs) < numFound:
+            jobj = self._query_json(url, [("q", query), ("fl", ",".join(fields)), ("sort", "id asc"), ("start", len(docs)),
+                                          ("rows", PublishingClient.MAX_DATASETS_PER_QUERY)], post=True)
+            numFound = jobj["response"]["numFound"]
+            page = jobj["response"]["docs"]
+            if len(page) == 0:
+                break
+            docs += page
+        return docs
+
+    def _terms_queries(self, field, ids):
+        '''Returns the queries selecting the records whose field is one of the given identifiers, MAX_DATASETS_PER_QUERY at a time.'''
+
+        return ["{!terms f=%s}%s" % (field, ",".join(ids[i:i+PublishingClient.MAX_DATASETS_PER_QUERY]))
+                for i in range(0, len(ids), PublishingClient.MAX_DATASETS_PER_QUERY)]
+
+    def _count(self, record_type, query):
+        '''Returns the number of records of the given type matching a query (0 if the Solr core does not exist).'''
+
+        try:
+            jobj = self._query_json(build_solr_query_url(self.publishing_service_url, record_type),
+                                    [("q", query), ("rows", 0)], post=True)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                logging.warn("Solr core not found for record type: %s" % record_type)
+                return 0
+            raise
+        return jobj["response"]["numFound"]
+
+    def _query_json(self, url, params, post=False):
+        '''Executes HTTP GET (or POST) request and return results as json object.'''
         
-        url = url+"?"+"wt=json&"+urllib.urlencode(params)
-        #print 'Solr search URL=%s' % url
-        fh = urllib2.urlopen( url )
-        jdoc = fh.read().decode("UTF-8")
+        if post:
+            jdoc = self.retryPolicy.call(self.connectionPool.request, 'POST', url+"?wt=json", body=urllib.urlencode(params),
+                                         headers={'Content-Type': 'application/x-www-form-urlencoded'}).decode("UTF-8")
+        else:
+            url = url+"?"+"wt=json&"+urllib.urlencode(params)
+            #print 'Solr search URL=%s' % url
+            jdoc = self.retryPolicy.call(self.connectionPool.request, 'GET', url).decode("UTF-8")
         jobj = json.loads(jdoc)
         return jobj
 
     def _commit(self, record_type):
 
         solr_url = build_solr_update_url(self.publishing_service_url, record_type)
-        self._post_xml(solr_url, '<commit/>')
+        self._post_body(solr_url, self.serializer.commit())
 
 class Indexer(object):
     """API for generating ESGF metadata records by parsing a given URI location."""
 
     def index(self, uri, maxRecords=-1):
         """
+        Collects all records generated by iterIndex() into memory.
+
         :param uri: reference to records storage
         :param maxRecords: if greater than 0, maximum number of records to be published
         :return: dictionary of record type, records list
         """
-        raise NotImplementedError("Error: index() method must be implemented by subclasses.")
+
+        records = {TYPE_DATASET:[], TYPE_FILE:[]}
+        for datasetRecord, fileRecords in self.iterIndex(uri, maxRecords):
+            records[TYPE_DATASET].append( datasetRecord )
+            records[TYPE_FILE] += fileRecords
+        return records
+
+    def iterIndex(self, uri, maxRecords=-1, incremental=False, force=False):
+        """
+        Generates the records by processing each unit of work found by walk(), in order.
+
+        :param uri: reference to records storage
+        :param maxRecords: if greater than 0, maximum number of records to be published
+        :param incremental: True to generate only the records that changed since they were last published (if supported)
+        :param force: True to generate all the records, even if unchanged (the state of the records is still kept
+                      for the next incremental runs)
+        :return: generator of (dataset record, list of file records) tuples
+        """
+
+        for work in self.walk(uri, maxRecords=maxRecords, incremental=incremental, force=force):
+            records = self.process(work)
+            if records is not None:
+                yield records
+        self.finish()
+
+    def walk(self, uri, maxRecords=-1, incremental=False, force=False):
+        """
+        First stage of indexing: finds the units of work (for example, directories) to be processed.
+
+        :param uri: reference to records storage
+        :param maxRecords: if greater than 0, maximum number of records to be published
+        :param incremental: True to generate only the records that changed since they were last published (if supported)
+        :param force: True to generate all the records, even if unchanged (the state of the records is still kept
+                      for the next incremental runs)
+        :return: generator of units of work, to be passed to process()
+        """
+        raise NotImplementedError("Error: walk() method must be implemented by subclasses.")
+
+    def process(self, work):
+        """
+        Second stage of indexing: generates the records for a unit of work.
+
+        :param work: unit of work returned by walk()
+        :return: (dataset record, list of file records) tuple, or None if no records were generated
+        """
+        return work
+
+    def finish(self):
+        """Invoked after all units of work have been processed."""
+        pass
+
+    def deletedRecords(self):
+        """
+        :return: dictionary of record type, list of identifiers of the records that were published before
+                 but whose source has disappeared (as found by the last incremental iterIndex())
+        """
+        return {TYPE_DATASET:[], TYPE_FILE:[]}
+
+    def markPublished(self, fileRecords):
+        """Callback invoked after the given file records have been published."""
+        pass
+
+    def markRejected(self, recordIds):
+        """Callback invoked after the file records with the given identifiers have been rejected by the publishing service."""
+        pass
+
+    def markUnpublished(self, recordIds):
+        """Callback invoked after the file records with the given identifiers have been unpublished."""
+        pass
+
+    def markUnpublishedDatasets(self, datasetIds):
+        """Callback invoked after the datasets with the given identifiers have been unpublished with all their files."""
+        pass
+
+    def getIdentifierPrefix(self, uri):
+        """
+        :return: common prefix of the identifiers of all datasets generated from the given URI, without indexing it
+                 (or None if not supported)
+        """
+        return None
+
+    def containsIdentifier(self, uri, identifier):
+        """
+        :return: True if the dataset with the given identifier (its 'master_id') may have been generated from the given URI
+                 (by default, if the identifier extends getIdentifierPrefix() with '.' separated parts)
+        """
+        prefix = self.getIdentifierPrefix(uri)
+        return prefix is not None and (identifier == prefix or identifier.startswith(prefix + "."))
 
 
 class FileSystemIndexer(Indexer):
@@ -203,14 +675,18 @@ class FileSystemIndexer(Indexer):
     It uses the configured DatasetRecordFactory and FileRecordfactory to create the records.
     A dataset record is created whenever files are found in a directory, and associated with the corresponding file records.
     Optionally, selected File metadata can be copied into the containing Dataset metadata, and viceversa.
+    Optionally, the state of the published files can be kept in a FileStateManifest
+    so that subsequent incremental runs only parse and publish new or changed files.
     """
 
-    def __init__(self, datasetRecordFactory, fileRecordFactory, fileMetadataKeysToCopy=[], datasetMetadataKeysToCopy=[] ):
+    def __init__(self, datasetRecordFactory, fileRecordFactory, fileMetadataKeysToCopy=[], datasetMetadataKeysToCopy=[],
+                 manifest=None):
         """
         :param datasetRecordFactory: subclass of DatasetRecordFactory
         :param fileRecordFactory: subclass of FileRecordFactory
         :param fileMetadataKeysToCopy: list of metadata keys (strings)
         :param datasetMetadataKeysToCopy: list of metadata keys (strings)
+        :param manifest: optional FileStateManifest used for incremental indexing
         """
 
         # record factories
@@ -221,60 +697,202 @@ class FileSystemIndexer(Indexer):
         self.fileMetadataKeysToCopy = fileMetadataKeysToCopy
         self.datasetMetadataKeysToCopy = datasetMetadataKeysToCopy
 
-    def index(self, startDirectory, maxRecords=-1):
+        # state of published files
+        self.manifest = manifest
+        self._deletedRecords = {TYPE_DATASET:[], TYPE_FILE:[]}
+
+    def walk(self, startDirectory, maxRecords=-1, incremental=False, force=False):
         """
         This method implementation traverses the directory tree
-        and creates records whenever it finds a non-empty sub-directory.
+        and yields a unit of work for each directory that matches the dataset templates.
         The metadata file: /.../.../<subdir>/<subdir>.xml will be associated with all dataset records under /.../.../<subdir>
         The metadata file: /.../.../<subdir>/<filemname>.ext.xml will be associated with the single file <filemname>.ext
+        If incremental=True and a manifest is configured, files that are unchanged since they were last published are skipped
+        (a dataset is only generated if some of its files changed), and the records of the files that have disappeared
+        are collected into deletedRecords().
+        Only the files themselves are checked: changes to their XML metadata files, or to the configuration of the factories,
+        require a run with force=True, which regenerates the records of all files (and still updates the manifest).
         """
 
-        records = {TYPE_DATASET:[], TYPE_FILE:[]}
         if not os.path.isdir(startDirectory):
             raise Exception("Wrong starting directory: %s" % startDirectory)
         else:
             print 'Start directory=%s' % startDirectory
-            
-        for directory, subdirs, files in os.walk(startDirectory):
-            
-            # create list of one Dataset record
-            datasetRecord = self.datasetRecordFactory.create(directory)
 
+        self._startDirectory = startDirectory
+        self._maxRecords = maxRecords
+        self._incremental = incremental and self.manifest is not None
+        self._force = force
+        self._deletedRecords = {TYPE_DATASET:[], TYPE_FILE:[]}
+        self._visitedDirectories = set()
+        self._numberOfFiles = 0 # total number of File records generated so far
+        walker.listings.clear()
+
+        # skip the sub-trees where the dataset factory cannot generate any dataset
+        for directory, subdirs, files in walker.walk(startDirectory, accepts=self.datasetRecordFactory.canContainDatasets):
+
+            # stop if the maximum number of records has been generated
+            if self._isFull():
+                break
+
+            # create list of one Dataset record
+            stats.count('walk.directories')
+            with stats.timer('create.dataset', directory):
+                datasetRecord = self.datasetRecordFactory.create(directory)
 
             # directory structure matches ones of the templates
             if datasetRecord is not None:
-                
-                # loop over files in this directory
-                for file in files:
-                    if maxRecords < 0 or len(records[TYPE_FILE]) < maxRecords-1:
-                        # ignore hidden files and thumbnails
-                        if not file[0] == '.' and not 'thumbnail' in file and not file.endswith('.xml'):
-                            
-                            filepath = os.path.join(directory, file)
-                            fileRecord = self.fileRecordFactory.create(datasetRecord, filepath)
-                            
-                            # file matches one of the patterns
-                            if fileRecord is not None:
-                                
-                                # copy metadata from File --> Dataset
-                                self._copyMetadata(self.fileMetadataKeysToCopy, fileRecord, datasetRecord)
-                                # copy metadata from Dataset --> File
-                                self._copyMetadata(self.datasetMetadataKeysToCopy, datasetRecord, fileRecord)
-                                
-                                # add this File record
-                                records[TYPE_FILE].append( fileRecord )
-
-                # dataset has files
-                if len(records[TYPE_FILE]) > 0 :
-
-                    # add number of files
-                    datasetRecord.fields['number_of_files'] = [str( len(records[TYPE_FILE]) )]
-
-                    # add this Dataset record
-                    records[TYPE_DATASET].append( datasetRecord )
 
+                # select files in this directory (the directory entries are kept, to stat each file at most once)
+                filepaths = []
+                fileEntries = {}
+                for entry in files:
+                    # ignore hidden files, thumbnails, and the XML metadata and checksum sidecar files
+                    if ( not entry.name[0] == '.' and not 'thumbnail' in entry.name and not entry.name.endswith('.xml')
+                         and not entry.name.endswith(SIDECAR_SUFFIXES) ):
+                        filepaths.append( entry.path )
+                        fileEntries[entry.path] = entry
+
+                if self._incremental:
+                    self._visitedDirectories.add(directory)
+
+                stats.count('walk.files', len(filepaths))
+                yield (directory, datasetRecord, filepaths, fileEntries)
+
+    def process(self, work):
+        """Generates the File records for a directory, and associates them with the Dataset record."""
+
+        with stats.timer('index.directory', work[0]):
+            return self._process(work)
+
+    def _process(self, work):
+
+        (directory, datasetRecord, filepaths, fileEntries) = work
+        if self._isFull():
+            return None
+
+        # skip files that have not changed since they were last published
+        unchangedFilepaths = []
+        fileStats = {}
+        numberOfDeletedFiles = 0
+        if self._incremental:
+            # the files that no longer match the patterns of the factory are unpublished
+            filepaths = [filepath for filepath in filepaths if self.fileRecordFactory.canCreate(filepath)]
+            publishedFiles = self.manifest.listDirectory(directory)
+            numberOfDeletedFiles = self._addDeletedFiles(publishedFiles, filepaths)
+            for filepath in filepaths:
+                fileStats[filepath] = fileEntries[filepath].stat()
+                if not self._force and self.manifest.isUnchanged(filepath, fileStats[filepath]):
+                    unchangedFilepaths.append(filepath)
+            filepaths = [filepath for filepath in filepaths if filepath not in unchangedFilepaths]
+
+        # loop over the records generated for these files
+        fileRecords = []
+        for filepath, fileRecord in self.fileRecordFactory.createRecords(datasetRecord, filepaths, fileEntries=fileEntries):
+            if self._isFull():
+                break
+
+            # copy metadata from File --> Dataset
+            self._copyMetadata(self.fileMetadataKeysToCopy, fileRecord, datasetRecord)
+            # copy metadata from Dataset --> File
+            self._copyMetadata(self.datasetMetadataKeysToCopy, datasetRecord, fileRecord)
+
+            # the file was modified, but its record is unchanged
+            if self._incremental:
+                recordFingerprint = fingerprint(fileRecord)
+                if not self._force and self.manifest.isPublished(filepath, recordFingerprint):
+                    self.manifest.update(filepath, fileStats[filepath])
+                    unchangedFilepaths.append(filepath)
+                    continue
+                self.manifest.stage(filepath, fileStats[filepath], fileRecord, recordFingerprint)
+
+            # add this File record
+            fileRecords.append( fileRecord )
+            self._numberOfFiles += 1
+
+        # dataset has new or changed files, or has lost some of its files (its number of files must be published again)
+        if len(fileRecords) > 0 or (numberOfDeletedFiles > 0 and len(unchangedFilepaths) > 0):
+
+            # copy metadata from unchanged Files --> Dataset, and associate them with the Dataset
+            # (so that it is published, and updated, even if all its remaining files are unchanged)
+            publishedIds = dict( (filepath, recordId) for (filepath, recordId, datasetId) in publishedFiles ) if self._incremental else {}
+            fileIds = set(datasetRecord.fileIds) # the unchanged records that were generated are associated already
+            for filepath in unchangedFilepaths:
+                self._copyFields(self.fileMetadataKeysToCopy, self.manifest.getMetadata(filepath), datasetRecord.fields)
+                if filepath in publishedIds and publishedIds[filepath] not in fileIds:
+                    datasetRecord.fileIds.append(publishedIds[filepath])
+
+            # add number of files
+            datasetRecord.fields['number_of_files'] = [str( len(fileRecords) + len(unchangedFilepaths) )]
+
+            # release this Dataset record and its Files
+            return (datasetRecord, fileRecords)
+
+        # dataset has no files left
+        elif self._incremental and len(unchangedFilepaths) == 0:
+            self._addDeletedDatasets(publishedFiles)
+
+        return None
+
+    def finish(self):
+
+        # files in directories that have disappeared
+        if self._incremental and not self._isFull():
+            for directory in self.manifest.listDirectories(self._startDirectory):
+                if directory not in self._visitedDirectories:
+                    publishedFiles = self.manifest.listDirectory(directory)
+                    self._addDeletedFiles(publishedFiles, [])
+                    self._addDeletedDatasets(publishedFiles)
+
+        # release resources held by the file records factory
+        self.fileRecordFactory.close()
+
+    def deletedRecords(self):
+        return self._deletedRecords
+
+    def markPublished(self, fileRecords):
+        if self.manifest is not None:
+            self.manifest.markPublished([fileRecord.id for fileRecord in fileRecords])
+
+    def markRejected(self, recordIds):
+        if self.manifest is not None:
+            self.manifest.discard(recordIds)
+
+    def markUnpublished(self, recordIds):
+        if self.manifest is not None:
+            self.manifest.markUnpublished(recordIds)
+
+    def markUnpublishedDatasets(self, datasetIds):
+        if self.manifest is not None:
+            self.manifest.markUnpublishedDatasets(datasetIds)
+
+    def getIdentifierPrefix(self, startDirectory):
+        return self.datasetRecordFactory.getIdentifierPrefix(startDirectory)
+
+    def containsIdentifier(self, startDirectory, identifier):
+        return self.datasetRecordFactory.containsIdentifier(startDirectory, identifier)
+
+    def _isFull(self):
+        '''Returns True if the maximum number of File records has been generated.'''
+
+        return self._maxRecords >= 0 and self._numberOfFiles >= self._maxRecords
+
+    def _addDeletedFiles(self, publishedFiles, filepaths):
+        '''Collects the identifiers of the published files that are not found among the current filepaths. Returns their number.'''
+
+        filepaths = set(filepaths)
+        numberOfDeletedFiles = 0
+        for (filepath, recordId, datasetId) in publishedFiles:
+            if filepath not in filepaths:
+                self._deletedRecords[TYPE_FILE].append(recordId)
+                numberOfDeletedFiles += 1
+        return numberOfDeletedFiles
 
-        return records
+    def _addDeletedDatasets(self, publishedFiles):
+        '''Collects the identifiers of the datasets of the given published files.'''
+
+        for datasetId in set([datasetId for (filepath, recordId, datasetId) in publishedFiles]):
+            self._deletedRecords[TYPE_DATASET].append(datasetId)
 
     def _copyMetadata(self, keys, fromRecord, toRecord):
         '''Utility method to copy selected metadata fields from one record to another.
@@ -282,13 +900,23 @@ class FileSystemIndexer(Indexer):
            if append=True the field is appended to the existing values.
            '''
 
+        self._copyFields(keys, fromRecord.fields, toRecord.fields)
+
+    def _copyFields(self, keys, fromFields, toFields):
+        '''Utility method to copy selected metadata fields from one dictionary of fields to another.'''
+
+        newFields = {}
         for key, append in keys.items():
-            if key in fromRecord.fields:
-                if append or key not in toRecord.fields:
-                    if key not in toRecord.fields:
-                        toRecord.fields[key] = []
-                    for value in fromRecord.fields[key]:
-                        toRecord.fields[key].append(value)
+            if key in fromFields:
+                if key not in toFields:
+                    # the values of records are shared, not copied
+                    if isinstance(fromFields, RecordFields):
+                        newFields[key] = fromFields.share(key)
+                    else:
+                        newFields[key] = fromFields[key]
+                elif append:
+                    toFields.extend(key, fromFields[key])
+        toFields.update(newFields)
 
 
 def build_solr_update_url(solr_base_url, record_type):
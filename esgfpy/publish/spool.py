@@ -0,0 +1,229 @@
+'''
+Module :mod:`esgfpy.publish.spool`
+==================================
+
+Module containing a local outbox of update requests, written when the publishing service is unavailable
+and replayed ("drained") to the publishing service once it is back.
+
+Usage: python -m esgfpy.publish.spool <outbox directory> <Solr URL> [--threads N] [--watch SECONDS]
+'''
+
+import os
+import re
+import gzip
+import json
+import time
+import threading
+import argparse
+import logging
+from multiprocessing.pool import ThreadPool
+
+from esgfpy.publish.connections import ConnectionPool
+from esgfpy.publish.failures import RetryPolicy
+
+class Outbox(object):
+    """
+    Append-only spool directory of update requests.
+    Each request is stored as a gzip-compressed segment, numbered in the order the requests were written.
+    Segments are first written to a temporary file, then linked to their final name,
+    so that a reader never sees a partial segment, and several writers never overwrite each other's segments.
+    """
+
+    # name of completed segments: segment-<sequence number>.gz
+    SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.gz$")
+
+    def __init__(self, directory, compressLevel=6):
+        """
+        :param directory: location of the spool directory (created if not existing)
+        :param compressLevel: gzip compression level of the segments (1-9)
+        """
+
+        self.directory = os.path.expanduser(directory)
+        self.compressLevel = compressLevel
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._lock = threading.Lock()
+        segments = self.segments()
+        self._sequence = segments[-1][0] if len(segments) > 0 else 0
+
+    def write(self, path, contentType, body):
+        """
+        Appends an update request to the outbox.
+
+        :param path: URL path of the request, relative to the publishing service (for example, '/files/update')
+        :param contentType: HTTP content type of the request body
+        :param body: request body: a string, or an iterable of strings (written one at a time)
+        """
+
+        # read the beginning of a streamed body, to determine the type of request
+        if isinstance(body, basestring):
+            (start, pieces) = (body, [])
+        else:
+            (start, pieces) = ("", iter(body))
+            for piece in pieces:
+                start += piece
+                if len(start) >= 16:
+                    break
+
+        header = json.dumps({ "path": path, "contentType": contentType, "barrier": not _isAddition(start) })
+        tmpfile = os.path.join(self.directory, ".segment-%s-%s.tmp" % (os.getpid(), threading.current_thread().ident))
+        gzfile = gzip.open(tmpfile, "wb", self.compressLevel)
+        try:
+            gzfile.write(header + "\n")
+            gzfile.write(start)
+            for piece in pieces:
+                gzfile.write(piece)
+        finally:
+            gzfile.close()
+
+        # link the complete segment to the next free sequence number
+        with self._lock:
+            while True:
+                self._sequence += 1
+                try:
+                    os.link(tmpfile, self._getPath(self._sequence))
+                    break
+                except OSError:
+                    if not os.path.exists(self._getPath(self._sequence)):
+                        raise
+        os.remove(tmpfile)
+        logging.debug("Written outbox segment %s: %s" % (self._sequence, path))
+
+    def segments(self):
+        '''Returns the list of (sequence number, segment path) of the completed segments, in order.'''
+
+        segments = []
+        for filename in os.listdir(self.directory):
+            match = Outbox.SEGMENT_PATTERN.match(filename)
+            if match:
+                segments.append( (int(match.group(1)), os.path.join(self.directory, filename)) )
+        return sorted(segments)
+
+    def read(self, segment):
+        '''Returns the (header dictionary, open gzip file positioned at the request body) of a segment.'''
+
+        gzfile = gzip.open(segment, "rb")
+        header = json.loads(gzfile.readline())
+        return (header, gzfile)
+
+    def remove(self, segment):
+        os.remove(segment)
+
+    def _getPath(self, sequence):
+        return os.path.join(self.directory, "segment-%012d.gz" % sequence)
+
+class OutboxDrainer(object):
+    """
+    Class that replays the segments of an outbox to the publishing service, in order, then removes them.
+    Consecutive additions are sent concurrently by a pool of threads,
+    while deletions and commits are barriers: they are sent alone, after all previous segments have been sent.
+    The drain stops at the first segment that cannot be sent (after retries), leaving it and the following ones in the outbox.
+    """
+
+    # size of the pieces of each segment streamed to the publishing service
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, outbox, publishing_service_url, numThreads=8, connectionPool=None, retryPolicy=None):
+        """
+        :param outbox: Outbox to be drained
+        :param publishing_service_url: base URL of the publishing service where the requests are replayed
+        :param numThreads: number of segments sent concurrently
+        :param connectionPool: optional ConnectionPool used to send the segments
+        :param retryPolicy: optional RetryPolicy for the segments failing with transient errors
+        """
+
+        self.outbox = outbox
+        self.publishing_service_url = publishing_service_url
+        self.numThreads = numThreads
+        if connectionPool is None:
+            connectionPool = ConnectionPool(maxConnections=numThreads, chunkSize=OutboxDrainer.CHUNK_SIZE)
+        self.connectionPool = connectionPool
+        if retryPolicy is None:
+            retryPolicy = RetryPolicy()
+        self.retryPolicy = retryPolicy
+
+    def drain(self):
+        '''Sends all segments currently in the outbox. Returns the number of segments sent.'''
+
+        pool = ThreadPool(self.numThreads)
+        try:
+            numberOfSegments = 0
+            group = []
+            for (sequence, segment) in self.outbox.segments():
+                (header, gzfile) = self.outbox.read(segment)
+                gzfile.close()
+                if header["barrier"]:
+                    numberOfSegments += self._sendGroup(pool, group)
+                    numberOfSegments += self._sendGroup(pool, [segment])
+                    group = []
+                else:
+                    group.append(segment)
+            numberOfSegments += self._sendGroup(pool, group)
+        finally:
+            pool.close()
+            pool.join()
+
+        if numberOfSegments > 0:
+            logging.info("Drained %s segments from outbox: %s" % (numberOfSegments, self.outbox.directory))
+        return numberOfSegments
+
+    def watch(self, interval=60):
+        '''Drains the outbox every given number of seconds, forever (transient failures are retried at the next drain).'''
+
+        while True:
+            try:
+                self.drain()
+            except Exception as e:
+                logging.warn("Error draining outbox, will retry: %s" % e)
+            time.sleep(interval)
+
+    def _sendGroup(self, pool, segments):
+        '''Sends a group of segments concurrently, and waits for all of them. Returns the number of segments sent.'''
+
+        if len(segments) == 0:
+            return 0
+        elif len(segments) == 1:
+            self._send(segments[0])
+        else:
+            # map() raises the first error after all segments have been attempted
+            pool.map(self._send, segments, chunksize=1)
+        return len(segments)
+
+    def _send(self, segment):
+        '''Sends one segment (retrying on transient errors), then removes it from the outbox.'''
+
+        self.retryPolicy.call(self._stream, segment)
+        self.outbox.remove(segment)
+
+    def _stream(self, segment):
+        (header, gzfile) = self.outbox.read(segment)
+        try:
+            self.connectionPool.request('POST', self.publishing_service_url + header["path"],
+                                        body=iter(lambda: gzfile.read(OutboxDrainer.CHUNK_SIZE), ''),
+                                        headers={'Content-Type': header["contentType"]})
+        finally:
+            gzfile.close()
+
+def _isAddition(body):
+    '''Returns True if the body of an update request only adds records (Solr/XML <add> or Solr/JSON array or "add" object).'''
+
+    start = body.lstrip()[:7]
+    return start.startswith("<add") or start.startswith("[") or start.startswith('{"add"')
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Replays the update requests spooled in an outbox to Solr")
+    parser.add_argument("directory", help="outbox directory")
+    parser.add_argument("solr_url", help="base Solr URL, for example: http://localhost:8984/solr")
+    parser.add_argument("--threads", type=int, default=8, help="number of requests sent concurrently")
+    parser.add_argument("--watch", type=int, default=0, help="keep draining the outbox every given number of seconds")
+    args = parser.parse_args()
+
+    drainer = OutboxDrainer(Outbox(args.directory), args.solr_url.rstrip("/"), numThreads=args.threads)
+    if args.watch > 0:
+        drainer.watch(args.watch)
+    else:
+        drainer.drain()
@@ -0,0 +1,92 @@
+'''
+Module :mod:`esgfpy.publish.templates`
+======================================
+
+Module containing the directory templates that determine which directories of a tree are datasets,
+compiled into a trie so that the sub-trees that cannot contain any dataset are recognized (and skipped) early.
+'''
+
+import re
+
+class DirectoryTemplates(object):
+    """
+    Directory templates: each template is a list of metadata keys, one for each level of sub-directories
+    under the root directory, optionally constrained with a regular expression that the sub-directory name must match
+    ('key=regex', for example: 'instrument=OCO2.*'). A directory matches a template if it has as many levels
+    as the template, and each sub-directory name satisfies the corresponding constraint.
+    The templates are compiled into a trie of (key, constraint) elements shared by templates with a common prefix.
+    """
+
+    def __init__(self, subDirs):
+        """
+        :param subDirs: list of one or more directory templates (each a list of 'key' or 'key=regex' elements)
+        """
+
+        self.subDirs = subDirs
+
+        # metadata keys of each template, in the configured order
+        self.keys = []
+
+        self._root = _TemplateNode()
+        for (index, template) in enumerate(subDirs):
+            node = self._root
+            keys = []
+            for element in template:
+                (key, constraint) = _parseElement(element)
+                node = node.getChild(key, constraint)
+                keys.append(key)
+            node.templates.append(index)
+            self.keys.append(keys)
+
+    def matching(self, parts):
+        '''Returns the templates (as lists of metadata keys) matched by the given sub-directory names, in the configured order.'''
+
+        indexes = sorted( index for node in self._match(parts) for index in node.templates )
+        return [self.keys[index] for index in indexes]
+
+    def canContain(self, parts):
+        '''Returns True if the directory with the given sub-directory names, or any directory below it, may match a template.'''
+
+        return len(self._match(parts)) > 0
+
+    def _match(self, parts):
+        '''Returns the trie nodes reached by the given sub-directory names.'''
+
+        nodes = [self._root]
+        for part in parts:
+            nodes = [child for node in nodes for child in node.children if child.accepts(part)]
+            if len(nodes) == 0:
+                break
+        return nodes
+
+class _TemplateNode(object):
+    '''Node of the templates trie: a (key, constraint) element, its children, and the indexes of the templates ending here.'''
+
+    def __init__(self, key=None, constraint=None):
+        self.key = key
+        self.constraint = constraint
+        self.pattern = re.compile("(?:%s)$" % constraint) if constraint is not None else None
+        self.children = []
+        self.templates = []
+
+    def getChild(self, key, constraint):
+        '''Returns the child node for the given element, creating it if necessary.'''
+
+        for child in self.children:
+            if child.key == key and child.constraint == constraint:
+                return child
+        child = _TemplateNode(key, constraint)
+        self.children.append(child)
+        return child
+
+    def accepts(self, part):
+        return self.pattern is None or self.pattern.match(part) is not None
+
+def _parseElement(element):
+    '''Splits a template element into its (metadata key, regular expression or None).'''
+
+    element = element.strip()
+    if "=" in element:
+        (key, constraint) = element.split("=", 1)
+        return (key.strip(), constraint.strip())
+    return (element, None)
@@ -16,4 +16,12 @@ def isNull(s):
         return False
 
 def str2bool(v):
-    return v.lower() in ("yes", "true", "t", "1")
\ No newline at end of file
+    return v.lower() in ("yes", "true", "t", "1")
+
+# characters with a special meaning in the Solr/Lucene query syntax
+SOLR_SPECIAL_CHARACTERS = '\\+-!():^[]"{}~*?|&/ '
+
+def escapeQuery(value):
+    """Escapes the special characters of a value to be used as a term in a Solr query."""
+
+    return "".join([("\\" + c if c in SOLR_SPECIAL_CHARACTERS else c) for c in value])
\ No newline at end of file
@@ -0,0 +1,193 @@
+'''
+Module :mod:`esgfpy.publish.walker`
+===================================
+
+Module containing a directory tree walker that lists each directory only once, with os.scandir()
+(or the 'scandir' package on Python 2, a requirement of this package), and a cache of the directory listings,
+so that the files to publish and their XML metadata files are found without a metadata request (stat) per file:
+on network file systems (Lustre, NFS) these requests dominate the time spent walking the tree.
+'''
+
+import os
+import threading
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+from collections import OrderedDict
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # without it, each entry is stat'ed once (see FileEntry)
+        scandir = None
+
+class FileEntry(object):
+    """
+    Directory entry with the same interface as the entries returned by scandir()
+    (name, path, is_dir(), is_file(), is_symlink(), stat()), used when scandir() is not available
+    or when a file was not found by the walker. The file is stat'ed at most once, when first needed.
+    """
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name if name is not None else os.path.basename(path)
+        self._lstat = None
+        self._stat = None
+
+    def is_symlink(self):
+        return S_ISLNK(self._getLstat().st_mode)
+
+    def is_dir(self):
+        try:
+            return S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def stat(self):
+        '''Returns the os.stat() result of the file (following symbolic links).'''
+
+        if self._stat is None:
+            lstat = self._getLstat()
+            self._stat = os.stat(self.path) if S_ISLNK(lstat.st_mode) else lstat
+        return self._stat
+
+    def _getLstat(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+def walk(top, accepts=None):
+    """
+    Generator that traverses the directory tree top-down, like os.walk() (symbolic links to directories are listed,
+    but not followed), yielding a (directory, sub-directory names, file entries) tuple for each directory,
+    where the file entries are scandir() entries, or FileEntry objects.
+    The listing of each directory is also stored in the 'listings' cache.
+    Directories that cannot be listed are skipped.
+
+    :param top: directory where the traversal starts
+    :param accepts: optional function invoked with the path of each directory before it is listed:
+                    the directories for which it returns False are pruned (neither listed, nor yielded, nor traversed)
+    """
+
+    stack = [top] if accepts is None or accepts(top) else []
+    while len(stack) > 0:
+        directory = stack.pop()
+        try:
+            entries = _listEntries(directory)
+        except OSError:
+            continue
+
+        subdirs = []
+        files = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry)
+            else:
+                files.append(entry)
+        listings.update(directory, [(entry.name, True) for entry in subdirs] + [(entry.name, False) for entry in files])
+
+        yield (directory, [entry.name for entry in subdirs], files)
+
+        # visit the sub-directories in the order they were listed
+        for entry in reversed(subdirs):
+            if not entry.is_symlink() and (accepts is None or accepts(entry.path)):
+                stack.append(entry.path)
+
+def _listEntries(directory):
+    '''Returns the entries of a directory, with scandir() if available.'''
+
+    if scandir is not None:
+        return list(scandir(directory))
+
+    entries = []
+    for name in os.listdir(directory):
+        entry = FileEntry(os.path.join(directory, name), name)
+        try:
+            entry.stat()
+        except OSError:
+            pass # broken link: listed as a file
+        entries.append(entry)
+    return entries
+
+class DirectoryListings(object):
+    """
+    Cache of the names of the entries of the most recently listed directories (listed by walk(), or on demand),
+    used to check whether files exist, and whether they are directories, without a metadata request per file.
+    The cache is cleared at the start of each walk of the tree by the FileSystemIndexer:
+    each clear() starts a new 'generation', so that other per-run caches can detect it.
+    """
+
+    def __init__(self, maxDirectories=256):
+        """
+        :param maxDirectories: maximum number of directory listings kept (the least recently used ones are discarded)
+        """
+
+        self.maxDirectories = maxDirectories
+        self._listings = OrderedDict() # directory path --> dictionary of entry name --> True if directory (None if unknown)
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def update(self, directory, entries):
+        '''Stores the listing of a directory, as a list of (entry name, True if directory or None if unknown) tuples.'''
+
+        if len(directory) > 1:
+            directory = directory.rstrip(os.sep)
+        with self._lock:
+            self._listings.pop(directory, None)
+            self._listings[directory] = dict(entries)
+            while len(self._listings) > self.maxDirectories:
+                self._listings.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self.generation += 1
+
+    def exists(self, path):
+        '''Returns True if the file or directory exists (as of the last listing of its parent directory).'''
+
+        (directory, name) = os.path.split(path.rstrip(os.sep))
+        listing = self._getListing(directory)
+        if listing is None:
+            return os.path.exists(path)
+        return name in listing
+
+    def isDirectory(self, path):
+        '''Returns True if the path is a directory (as of the last listing of its parent directory).'''
+
+        (directory, name) = os.path.split(path.rstrip(os.sep))
+        listing = self._getListing(directory)
+        if listing is None or listing.get(name) is None:
+            return os.path.isdir(path)
+        return listing[name]
+
+    def _getListing(self, directory):
+        '''Returns the cached listing of a directory, listing it if necessary (or None if it cannot be listed).'''
+
+        if len(directory) == 0:
+            return None
+        with self._lock:
+            listing = self._listings.pop(directory, None)
+            if listing is not None:
+                self._listings[directory] = listing # most recently used
+                return listing
+        # the type of the entries is only known without a stat per entry from scandir()
+        try:
+            if scandir is not None:
+                entries = [(entry.name, entry.is_dir()) for entry in scandir(directory)]
+            else:
+                entries = [(name, None) for name in os.listdir(directory)]
+        except OSError:
+            return None
+        self.update(directory, entries)
+        return dict(entries)
+
+# listings shared by the walker and the metadata parsers of the current process
+listings = DirectoryListings()
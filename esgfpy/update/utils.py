@@ -2,18 +2,27 @@ import json
 import logging
 import urllib
 import urllib2
-from xml.etree.ElementTree import Element, SubElement, tostring
+import tempfile
+
+from esgfpy.publish.consts import FORMAT_XML
+from esgfpy.publish.models import getSerializer
+from esgfpy.publish.connections import ConnectionPool
 
 logging.basicConfig(level=logging.INFO)
 
 MAX_ROWS = 1000 # maximum number of records returned by a Solr query
+CHUNK_SIZE = 64*1024 # size of the chunks read from the spooled update document
+
+# connection used to stream the update documents
+_connectionPool = ConnectionPool(maxConnections=1, chunkSize=CHUNK_SIZE)
 
-def updateSolr(updateDict, update='set', solr_url='http://localhost:8984/solr', solr_core='datasets'):
+def updateSolr(updateDict, update='set', solr_url='http://localhost:8984/solr', solr_core='datasets', format=FORMAT_XML):
     '''
     Method to bulk-update all matching records in a Solr index.
     
     updateDict: dictionary of Solr queries to map of field name and values to be updated for all matching results
     update='set' to override the previous values of that field, update'add' to add new values to that field
+    format='xml' to send Solr/XML update documents, format='json' to send Solr/JSON update documents
 
     Example of updateDict:
     setDict = { 'id:test.test.v1.testData.nc|esgf-dev.jpl.nasa.gov': 
@@ -39,6 +48,7 @@ def updateSolr(updateDict, update='set', solr_url='http://localhost:8984/solr',
     '''
     
     solr_core_url = solr_url+"/"+solr_core
+    serializer = getSerializer(format)
     
     # process each query separately
     for query, fieldDict in updateDict.items():
@@ -48,28 +58,38 @@ def updateSolr(updateDict, update='set', solr_url='http://localhost:8984/solr',
         # VERY IMPORTANT: FIRST QUERY FOR ALL RESULTS
         # THEN UPDATE ALL RESULTS
         # BECAUSE PAGINATION DOES NOT WORK IN BETWEEN COMMITS
-        start = 0
-        numFound = start+1
-        xmlDocs = []
         
-        # 1) query for all matching records
-        while start < numFound:
-    
-            # query Solr, construct update document
-            (xmlDoc, numFound, numRecords) = _buildSolrXml(solr_core_url, queries, fieldDict, update=update, start=start)
-            xmlDocs.append( xmlDoc )
-                                    
-            # increase starting record locator
-            start += numRecords
+        # 1) query for all matching records, spooling the update document to a temporary file
+        spool = tempfile.TemporaryFile()
+        try:
+            for piece in serializer.iterAdd( _iterSolrUpdates(solr_core_url, serializer, queries, fieldDict, update=update) ):
+                spool.write(piece)
             
-        # 2) update all matching records
-        for xmlDoc in xmlDocs:
-            _sendSolrXml(solr_core_url, xmlDoc)
+            # 2) update all matching records, streaming the update document in one request
+            spool.seek(0)
+            _sendSolrUpdate(solr_core_url, iter(lambda: spool.read(CHUNK_SIZE), ''), serializer.contentType)
+        finally:
+            spool.close()
 
         # 3) commit after each separate query
         _commit(solr_core_url)
     
-def _buildSolrXml(solr_core_url, queries, fieldDict, update='set', start=0):
+def _iterSolrUpdates(solr_core_url, serializer, queries, fieldDict, update='set'):
+    '''Generator of the serialized updates of all records matching the queries, one page of results at a time.'''
+    
+    start = 0
+    numFound = start+1
+    while start < numFound:
+        
+        # query Solr, construct update documents
+        (docs, numFound, numRecords) = _buildSolrUpdate(solr_core_url, serializer, queries, fieldDict, update=update, start=start)
+        for doc in docs:
+            yield doc
+        
+        # increase starting record locator
+        start += numRecords
+    
+def _buildSolrUpdate(solr_core_url, serializer, queries, fieldDict, update='set', start=0):
     
     # /select URL
     # https://esgf-node.jpl.nasa.gov:8984/solr/datasets/select?q=*%3A*&wt=json&indent=true
@@ -97,23 +117,16 @@ def _buildSolrXml(solr_core_url, queries, fieldDict, update='set', start=0):
     logging.info("Total number of records found: %s number of records returned: %s" % (numFound, numRecords))
                 
     # update all records matching the query
-    # <add>
-    # root of global update document
-    rootEl = Element("add")
-   
+    docs = []
     for result in jobj['response']['docs']:
         logging.debug("Updating record id=%s" % result['id'])
-                
-        # <doc>
-        docEl = SubElement(rootEl, "doc")
-        # <field name="id">obs4MIPs.NASA-JPL.AIRS.mon.v1.taStderr_AIRS_L3_RetStd-v5_200209-201105.nc|esgf-node.jpl.nasa.gov</field>
-        el = SubElement(docEl, "field", attrib={ "name": 'id' })
-        el.text = str(result['id'])
 
         # loop over fields to be updated
+        fields = []
         for fieldName, fieldValues in fieldDict.items():
             
             if fieldValues is not None and len(fieldValues)>0:
+                values = []
                 for fieldValue in fieldValues:
                     
                     # special case: override 'fieldValue' with value(s) from another field
@@ -121,39 +134,40 @@ def _buildSolrXml(solr_core_url, queries, fieldDict, update='set', start=0):
                         _fieldName = fieldValue[1:] # field to copy from
                         _fieldValues = result.get(_fieldName, None)
                         if _fieldValues is not None and len(_fieldValues)>0:  
-                            for _fieldValue in _fieldValues:
-                                # <field name="xlink" update="set">https://earthsystemcog.org/.../taTechNote_AIRS_L3_RetStd-v5_200209-201105.pdf|AIRS Air Temperature Technical Note|technote</field>
-                                el = SubElement(docEl, "field", attrib={ "name": fieldName, 'update': update })
-                                el.text = _fieldValue
+                            values += _fieldValues
 
                     # otherwise use the specified value
                     else:
-                        # <field name="xlink" update="set">https://earthsystemcog.org/.../taTechNote_AIRS_L3_RetStd-v5_200209-201105.pdf|AIRS Air Temperature Technical Note|technote</field>
-                        el = SubElement(docEl, "field", attrib={ "name": fieldName, 'update': update })
-                        el.text = fieldValue
+                        values.append(fieldValue)
+                        
+                # no values to copy: leave the field unchanged
+                if len(values)>0:
+                    fields.append( (fieldName, values) )
                         
             else:
-                # <field name="xlink" update="set" null="true"/>
-                el = SubElement(docEl, "field", attrib={ "name": fieldName, 'update': update, 'null':'true' })
+                # remove the field
+                fields.append( (fieldName, None) )
                 
-    # serialize document from all queries            
-    xmlstr = tostring(rootEl)
-    #logging.debug(xmlstr)
-    return (xmlstr, numFound, numRecords)
+        # <doc>
+        #   <field name="id">obs4MIPs.NASA-JPL.AIRS.mon.v1.taStderr_AIRS_L3_RetStd-v5_200209-201105.nc|esgf-node.jpl.nasa.gov</field>
+        #   <field name="xlink" update="set">https://earthsystemcog.org/.../taTechNote_AIRS_L3_RetStd-v5_200209-201105.pdf|AIRS Air Temperature Technical Note|technote</field>
+        # </doc>
+        docs.append( serializer.serializeUpdate(result['id'], fields, update=update) )
+                
+    return (docs, numFound, numRecords)
     
 
-def _sendSolrXml(solr_core_url, xmlDoc):
-    '''Method to send a Solr/XML update document to a specific Solr server and core.'''
-    
-    logging.debug( xmlDoc )
+def _sendSolrUpdate(solr_core_url, pieces, contentType='application/xml'):
+    '''
+    Method to send a Solr update document (XML or JSON) to a specific Solr server and core.
+    The document is given as an iterable of strings, streamed with chunked transfer encoding.
+    '''
     
     # update URL (no commit)
     url = solr_core_url + '/update'
     
-    # send XML document
-    r = urllib2.Request(url, data=xmlDoc, headers={'Content-Type': 'application/xml'})
-    u = urllib2.urlopen(r)
-    response = u.read()
+    # send update document
+    response = _connectionPool.request('POST', url, body=pieces, headers={'Content-Type': contentType})
     logging.info(response)
 
 